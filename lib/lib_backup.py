@@ -0,0 +1,470 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Deduplicating, compressed snapshots of the Foundry data directory."""
+
+import hashlib
+import importlib
+import io
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import stat
+import subprocess
+import time
+import zlib
+
+from lib_tree import walk_tree
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Chunk boundaries are only considered at anchor bytes, found with bytes.find,
+# and taken where the hash of the preceding window matches the mask. NeDB and
+# other line based files are cut at line ends, so appended records only
+# change the last chunk of a file.
+ANCHOR = b"\n"
+WINDOW = 32
+CUT_MASK = (1 << 12) - 1
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+READ_RETRIES = 5
+# NeDB appends one JSON document per line, so a torn last line is a document being written
+NEDB_SUFFIX = ".db"
+
+
+class BackupError(Exception):
+    """Raise if a snapshot can't be taken or restored."""
+
+    pass
+
+
+def remove_entry(path):
+    """Remove a file, symlink or directory tree."""
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(str(path))
+    else:
+        path.unlink()
+
+
+def load_zstandard():
+    """Import zstandard if it has become available, returning True if it is."""
+    global zstandard
+
+    if zstandard is None:
+        importlib.invalidate_caches()
+        try:
+            zstandard = importlib.import_module("zstandard")
+        except ImportError:
+            return False
+
+    return True
+
+
+def cut_point(buffer):
+    """Return the length of the first chunk in buffer."""
+    limit = min(len(buffer), MAX_CHUNK)
+    position = buffer.find(ANCHOR, MIN_CHUNK, limit)
+
+    while position != -1:
+        if zlib.crc32(buffer[position - WINDOW:position]) & CUT_MASK == 0:
+            return position + 1
+        position = buffer.find(ANCHOR, position + 1, limit)
+
+    return limit
+
+
+def chunk_stream(source, throttle=None):
+    """Split a binary file object into content defined chunks."""
+    buffer = b""
+
+    while True:
+        data = source.read(MAX_CHUNK)
+
+        if throttle:
+            throttle.consume(len(data))
+        buffer += data
+
+        while len(buffer) >= MAX_CHUNK or (buffer and not data):
+            cut = cut_point(buffer)
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+
+        if not data:
+            return
+
+
+class Throttle:
+    """Limit the rate data is read at, in bytes per second."""
+
+    def __init__(self, rate=0):
+        """Initialize with a rate, 0 for unlimited."""
+        self.rate = rate
+        self.consumed = 0
+        self.started = time.monotonic()
+
+    def consume(self, size):
+        """Account for size bytes, sleeping if reading is ahead of the rate."""
+        if not self.rate:
+            return
+        self.consumed += size
+        ahead = self.consumed / self.rate - (time.monotonic() - self.started)
+
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def lower_priority():
+    """Run the current process at idle I/O priority and a lower CPU priority."""
+    os.nice(10)
+    try:
+        subprocess.check_call(
+            ["ionice", "-c", "3", "-p", str(os.getpid())],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning("Could not lower I/O priority: {}".format(e))
+
+
+class BackupStore:
+    """A store of snapshots sharing deduplicated, compressed chunks.
+
+    Files are split into content defined chunks, stored once under their
+    sha256 and compressed with zstd, or zlib where zstandard isn't
+    available. A snapshot lists each entry of the data directory with its
+    metadata and chunks. Files with the size and mtime they had in the
+    previous snapshot reuse its chunks without being read.
+    """
+
+    def __init__(self, path):
+        """Initialize the store at path."""
+        self.path = Path(path)
+        self.chunks_path = self.path / "chunks"
+        self.snapshots_path = self.path / "snapshots"
+
+    def snapshots(self):
+        """Return the snapshot ids, oldest first."""
+        if not self.snapshots_path.is_dir():
+            return []
+
+        return sorted(snapshot.stem for snapshot in self.snapshots_path.glob("*.json"))
+
+    def read_snapshot(self, snapshot):
+        """Return a snapshot by id."""
+        try:
+            with open(str(self.snapshots_path / "{}.json".format(snapshot)), "r") as snapshot_file:
+                return json.load(snapshot_file)
+        except (OSError, ValueError) as e:
+            raise BackupError("Can't read snapshot {}: {}".format(snapshot, e))
+
+    def _chunk_path(self, chunk_id, suffix):
+        """Path of a stored chunk."""
+        return self.chunks_path / chunk_id[:2] / "{}.{}".format(chunk_id, suffix)
+
+    def _find_chunk(self, chunk_id):
+        """Return the path of a stored chunk, or None."""
+        for suffix in ("zst", "z"):
+            path = self._chunk_path(chunk_id, suffix)
+
+            if path.exists():
+                return path
+
+        return None
+
+    def put_chunk(self, data, stats):
+        """Store a chunk unless it is already stored, returning its id."""
+        chunk_id = hashlib.sha256(data).hexdigest()
+
+        if self._find_chunk(chunk_id):
+            stats["chunks_reused"] += 1
+
+            return chunk_id
+
+        if zstandard is not None:
+            compressed = zstandard.ZstdCompressor(level=3).compress(data)
+            path = self._chunk_path(chunk_id, "zst")
+        else:
+            compressed = zlib.compress(data, 6)
+            path = self._chunk_path(chunk_id, "z")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(".{}.tmp".format(path.name))
+        tmp_path.write_bytes(compressed)
+        os.replace(str(tmp_path), str(path))
+        stats["chunks_stored"] += 1
+        stats["bytes_stored"] += len(compressed)
+
+        return chunk_id
+
+    def get_chunk(self, chunk_id):
+        """Return the verified content of a chunk."""
+        path = self._find_chunk(chunk_id)
+
+        if path is None:
+            raise BackupError("Chunk {} is missing".format(chunk_id))
+
+        if path.suffix == ".zst":
+            if zstandard is None:
+                raise BackupError("zstandard is needed to restore {}".format(chunk_id))
+            data = zstandard.ZstdDecompressor().decompress(path.read_bytes())
+        else:
+            data = zlib.decompress(path.read_bytes())
+
+        if hashlib.sha256(data).hexdigest() != chunk_id:
+            raise BackupError("Chunk {} is corrupt".format(chunk_id))
+
+        return data
+
+    def _read_file(self, path, throttle, stats):
+        """Chunk a file, retrying if it changes while being read.
+
+        A NeDB file is cut at its last complete line, so a document being
+        appended is left for the next snapshot rather than stored torn.
+        """
+        for attempt in range(READ_RETRIES):
+            before = os.stat(str(path))
+
+            with open(str(path), "rb") as source:
+                if path.suffix == NEDB_SUFFIX:
+                    data = source.read()
+
+                    if throttle:
+                        throttle.consume(len(data))
+                    data = data[:data.rfind(b"\n") + 1]
+                    chunks = [self.put_chunk(chunk, stats) for chunk in chunk_stream(io.BytesIO(data))]
+                    size = len(data)
+                else:
+                    chunks = []
+                    size = 0
+
+                    for chunk in chunk_stream(source, throttle):
+                        chunks.append(self.put_chunk(chunk, stats))
+                        size += len(chunk)
+            after = os.stat(str(path))
+
+            if (before.st_ino, before.st_size, before.st_mtime_ns) == (
+                after.st_ino,
+                after.st_size,
+                after.st_mtime_ns,
+            ):
+                return chunks, size, after
+            logging.info("{} changed while being read, retrying".format(path))
+            time.sleep(0.1 * (attempt + 1))
+
+        raise BackupError("{} kept changing while being backed up".format(path))
+
+    def backup(self, data_path, rate=0, follow=()):
+        """Take a snapshot of data_path, returning its id and stats.
+
+        The symlinked directories in follow, relative to data_path, are
+        backed up as the directories they link to, so a snapshot holds the
+        data of storage tiers and restores wherever they are placed.
+        """
+        data_path = Path(data_path)
+        started = time.perf_counter()
+        snapshots = self.snapshots()
+        previous = {}
+
+        if snapshots:
+            previous = {
+                entry["path"]: entry
+                for entry in self.read_snapshot(snapshots[-1])["entries"]
+                if entry["type"] == "file"
+            }
+        throttle = Throttle(rate)
+        stats = {
+            "files": 0,
+            "files_unchanged": 0,
+            "bytes": 0,
+            "bytes_read": 0,
+            "chunks_stored": 0,
+            "chunks_reused": 0,
+            "bytes_stored": 0,
+        }
+        entries = []
+
+        for root, dirs, files in walk_tree(data_path, follow):
+            dirs.sort()
+
+            for name in dirs + sorted(files):
+                path = Path(root) / name
+                relative = str(path.relative_to(data_path))
+                path_stat = path.stat() if relative in follow and path.is_dir() else path.lstat()
+                entry = {
+                    "path": relative,
+                    "mode": stat.S_IMODE(path_stat.st_mode),
+                    "uid": path_stat.st_uid,
+                    "gid": path_stat.st_gid,
+                    "mtime_ns": path_stat.st_mtime_ns,
+                }
+
+                if stat.S_ISLNK(path_stat.st_mode):
+                    entry.update(type="symlink", target=os.readlink(str(path)))
+                elif stat.S_ISDIR(path_stat.st_mode):
+                    entry["type"] = "dir"
+                elif stat.S_ISREG(path_stat.st_mode):
+                    entry["type"] = "file"
+                    stats["files"] += 1
+                    last = previous.get(relative)
+
+                    if last and (last["size"], last["mtime_ns"]) == (
+                        path_stat.st_size,
+                        path_stat.st_mtime_ns,
+                    ):
+                        entry.update(size=last["size"], chunks=last["chunks"])
+                        stats["files_unchanged"] += 1
+                    else:
+                        chunks, size, path_stat = self._read_file(path, throttle, stats)
+                        entry.update(size=size, chunks=chunks, mtime_ns=path_stat.st_mtime_ns)
+                        stats["bytes_read"] += path_stat.st_size
+                    stats["bytes"] += entry["size"]
+                else:
+                    logging.warning("Skipping special file {}".format(path))
+
+                    continue
+                entries.append(entry)
+            dirs[:] = [name for name in dirs if not (Path(root) / name).is_symlink()]
+        snapshot = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+
+        while (self.snapshots_path / "{}.json".format(snapshot)).exists():
+            snapshot += "-1"
+        stats["seconds"] = time.perf_counter() - started
+        self.snapshots_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.snapshots_path / ".{}.tmp".format(snapshot)
+        with open(str(tmp_path), "w") as snapshot_file:
+            json.dump(
+                {
+                    "snapshot": snapshot,
+                    "data_path": str(data_path),
+                    "entries": entries,
+                    "stats": stats,
+                },
+                snapshot_file,
+            )
+        os.replace(str(tmp_path), str(self.snapshots_path / "{}.json".format(snapshot)))
+        logging.info("Backed up {} to snapshot {}: {}".format(data_path, snapshot, stats))
+
+        return snapshot, stats
+
+    def restore(self, snapshot, data_path, follow=()):
+        """Make data_path match a snapshot, returning stats.
+
+        Files which already match the snapshot are left alone and anything not
+        in the snapshot is removed, so only the differences are written. The
+        symlinked directories in follow are kept and restored through.
+        """
+        data_path = Path(data_path)
+        entries = self.read_snapshot(snapshot)["entries"]
+        stats = {"files": 0, "files_written": 0, "bytes_written": 0, "removed": 0}
+        stats["removed"] = self._remove_unwanted(
+            data_path, {entry["path"] for entry in entries}, follow
+        )
+        restorers = {
+            "dir": self._restore_dir,
+            "symlink": self._restore_symlink,
+            "file": self._restore_file,
+        }
+
+        for entry in entries:
+            restorers[entry["type"]](data_path / entry["path"], entry, stats)
+
+        # Metadata is set last and children first, as writing into a directory changes it
+        for entry in reversed(entries):
+            self._set_metadata(data_path / entry["path"], entry)
+        logging.info("Restored snapshot {} to {}: {}".format(snapshot, data_path, stats))
+
+        return stats
+
+    def _remove_unwanted(self, data_path, wanted, follow=()):
+        """Remove everything under data_path which isn't wanted, returning how many entries."""
+        removed = 0
+
+        for root, dirs, files in walk_tree(data_path, follow, topdown=False):
+            for name in dirs + files:
+                path = Path(root) / name
+
+                if str(path.relative_to(data_path)) not in wanted:
+                    remove_entry(path)
+                    removed += 1
+
+        return removed
+
+    def _restore_dir(self, path, entry, stats):
+        """Restore a directory entry, keeping a symlink to a directory as a followed link."""
+        if path.is_symlink() and path.is_dir():
+            return
+
+        if path.is_symlink() or (path.exists() and not path.is_dir()):
+            path.unlink()
+        path.mkdir(exist_ok=True)
+
+    def _restore_symlink(self, path, entry, stats):
+        """Restore a symlink entry."""
+        if os.path.lexists(str(path)):
+            remove_entry(path)
+        os.symlink(entry["target"], str(path))
+
+    def _restore_file(self, path, entry, stats):
+        """Restore a file entry, unless the file already matches it."""
+        stats["files"] += 1
+        try:
+            current = path.lstat()
+        except FileNotFoundError:
+            current = None
+
+        if (
+            current
+            and stat.S_ISREG(current.st_mode)
+            and (current.st_size, current.st_mtime_ns) == (entry["size"], entry["mtime_ns"])
+        ):
+            return
+
+        if current and stat.S_ISDIR(current.st_mode):
+            shutil.rmtree(str(path))
+        tmp_path = path.with_name(".{}.restore".format(path.name))
+        with open(str(tmp_path), "wb") as target:
+            for chunk_id in entry["chunks"]:
+                target.write(self.get_chunk(chunk_id))
+        os.replace(str(tmp_path), str(path))
+        stats["files_written"] += 1
+        stats["bytes_written"] += entry["size"]
+
+    def _set_metadata(self, path, entry):
+        """Apply the ownership, permissions and mtime of an entry."""
+        try:
+            os.chown(str(path), entry["uid"], entry["gid"], follow_symlinks=False)
+        except PermissionError:
+            pass
+
+        if entry["type"] != "symlink":
+            os.chmod(str(path), entry["mode"])
+            os.utime(str(path), ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+    def prune(self, keep):
+        """Remove all but the newest keep snapshots and the chunks only they used."""
+        snapshots = self.snapshots()
+
+        if keep < 1 or len(snapshots) <= keep:
+            return 0
+
+        for snapshot in snapshots[:-keep]:
+            (self.snapshots_path / "{}.json".format(snapshot)).unlink()
+        referenced = set()
+
+        for snapshot in snapshots[-keep:]:
+            for entry in self.read_snapshot(snapshot)["entries"]:
+                referenced.update(entry.get("chunks", ()))
+        removed = 0
+
+        for path in self.chunks_path.glob("*/*"):
+            if path.name.split(".")[0] not in referenced:
+                path.unlink()
+                removed += 1
+        logging.info("Pruned {} snapshots and {} chunks".format(len(snapshots) - keep, removed))
+
+        return removed
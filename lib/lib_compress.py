@@ -0,0 +1,196 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Precompression of static Foundry client assets into .gz and .br siblings."""
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_COMPRESS_WORKERS = 8
+# Files smaller than this gain too little to be worth a second request path
+MIN_SIZE = 1024
+# Compressed copies not at least this much smaller than the original are dropped
+MAX_RATIO = 0.9
+COMPRESSIBLE = {
+    ".css",
+    ".eot",
+    ".html",
+    ".ico",
+    ".js",
+    ".json",
+    ".map",
+    ".mjs",
+    ".otf",
+    ".svg",
+    ".ttf",
+    ".txt",
+    ".wasm",
+    ".xml",
+}
+
+
+def _gzip(data):
+    """Compress with gzip, without a timestamp so output is reproducible."""
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode="wb", compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(data)
+
+    return output.getvalue()
+
+
+def _brotli(data):
+    """Compress with brotli at the highest quality."""
+    return brotli.compress(data, quality=11)
+
+
+def available_encodings():
+    """Return the encodings siblings can be written for on this host."""
+    encodings = {"gz": _gzip}
+
+    if brotli is not None:
+        encodings["br"] = _brotli
+
+    return encodings
+
+
+def is_compressible(name):
+    """Return true if the file type benefits from precompression."""
+    return Path(name).suffix.lower() in COMPRESSIBLE
+
+
+class Precompressor:
+    """Write compressed siblings of static files for a server or proxy to send as is.
+
+    Each eligible file gets a .gz sibling, and a .br sibling if the brotli
+    module is available, unless compressing doesn't make it meaningfully
+    smaller. Siblings of files unchanged from a previous release are hard
+    linked from it rather than compressed again.
+    """
+
+    def __init__(self, workers=0):
+        """Initialize with a worker count, 0 for one per core."""
+        if workers < 1:
+            workers = min(MAX_COMPRESS_WORKERS, os.cpu_count() or 1)
+        self.workers = workers
+        self.encodings = available_encodings()
+        self._lock = threading.Lock()
+
+    def _write(self, path, data, source_stat):
+        """Write a sibling atomically with the permissions and mtime of its source."""
+        tmp_path = path.with_name(".{}.tmp".format(path.name))
+        tmp_path.write_bytes(data)
+        os.chmod(str(tmp_path), source_stat.st_mode & 0o7777)
+        os.utime(str(tmp_path), (source_stat.st_atime, source_stat.st_mtime))
+        os.replace(str(tmp_path), str(path))
+
+    def _link(self, source, target):
+        """Hard link a sibling from a previous release, returning True on success."""
+        try:
+            os.link(str(source), str(target))
+        except OSError:
+            return False
+
+        return True
+
+    def compress_file(self, root, name, previous=None, stats=None):
+        """Write the siblings of one file, linking them from previous if given."""
+        path = root / name
+        source_stat = path.stat()
+
+        if source_stat.st_size < MIN_SIZE:
+            return
+        data = None
+        sizes = {}
+        linked = 0
+
+        for encoding, compress in self.encodings.items():
+            sibling = path.with_name("{}.{}".format(path.name, encoding))
+
+            if previous is not None and encoding in previous["encodings"]:
+                # The previous release already decided whether this sibling is worth it
+                previous_sibling = previous["root"] / "{}.{}".format(name, encoding)
+
+                if previous_sibling.exists() and self._link(previous_sibling, sibling):
+                    sizes[encoding] = sibling.stat().st_size
+                    linked += 1
+
+                continue
+
+            if data is None:
+                data = path.read_bytes()
+            compressed = compress(data)
+
+            if len(compressed) > len(data) * MAX_RATIO:
+                continue
+            self._write(sibling, compressed, source_stat)
+            sizes[encoding] = len(compressed)
+
+        if stats is None:
+            return
+        with self._lock:
+            stats["files"] += 1
+            stats["linked"] += linked
+            stats["bytes"] += source_stat.st_size
+
+            for encoding in self.encodings:
+                # Files without a worthwhile sibling are served uncompressed
+                stats["compressed"][encoding] += sizes.get(encoding, source_stat.st_size)
+
+    def precompress(self, root, names, previous_root=None, previous_stats=None, unchanged=()):
+        """Precompress the eligible names under root in parallel, returning stats.
+
+        Siblings of names in unchanged are linked from previous_root for the
+        encodings listed in previous_stats, the stats that release was built
+        with. The stats hold the bytes of eligible files, the bytes a client
+        downloads with each encoding and the time taken.
+        """
+        root = Path(root)
+        started = time.perf_counter()
+        stats = {
+            "files": 0,
+            "linked": 0,
+            "bytes": 0,
+            "encodings": sorted(self.encodings),
+            "compressed": {encoding: 0 for encoding in self.encodings},
+        }
+        previous = None
+
+        if previous_root is not None and previous_stats:
+            previous = {"root": Path(previous_root), "encodings": previous_stats["encodings"]}
+        unchanged = set(unchanged)
+        names = [name for name in names if is_compressible(name)]
+
+        def compress(name):
+            self.compress_file(root, name, previous if name in unchanged else None, stats)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # Consume the results so worker exceptions are raised here
+            list(pool.map(compress, names))
+        stats["seconds"] = time.perf_counter() - started
+
+        for encoding, size in stats["compressed"].items():
+            logging.info(
+                "Precompressed {} files with {}: {} -> {} bytes ({:.1%}), {} linked, in {:.1f}s".format(
+                    stats["files"],
+                    encoding,
+                    stats["bytes"],
+                    size,
+                    size / stats["bytes"] if stats["bytes"] else 1,
+                    stats["linked"],
+                    stats["seconds"],
+                )
+            )
+
+        return stats
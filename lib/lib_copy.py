@@ -0,0 +1,252 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Copy engine used to move Foundry data between filesystems."""
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import fcntl
+import logging
+import os
+from pathlib import Path
+import shutil
+import stat
+import threading
+
+# From linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+MAX_COPY_WORKERS = 16
+CHUNK_SIZE = 8 * 1024 * 1024
+STRATEGIES = ["reflink", "copy_file_range", "sendfile", "buffered"]
+# Errors meaning a strategy isn't supported for these files rather than a failed copy
+UNSUPPORTED = {
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+    errno.ENOTTY,
+    errno.EBADF,
+}
+
+
+def _reflink(source_fd, target_fd, size):
+    """Share the source blocks with the target using FICLONE."""
+    fcntl.ioctl(target_fd, FICLONE, source_fd)
+
+
+def _copy_file_range(source_fd, target_fd, size):
+    """Copy in kernel with copy_file_range."""
+    offset = 0
+
+    while offset < size:
+        copied = os.copy_file_range(source_fd, target_fd, min(CHUNK_SIZE, size - offset))
+
+        if copied == 0:
+            break
+        offset += copied
+
+    if offset == 0 and size > 0:
+        # Some filesystems report success but copy nothing
+        raise OSError(errno.EINVAL, "copy_file_range copied nothing")
+
+
+def _sendfile(source_fd, target_fd, size):
+    """Copy in kernel with sendfile."""
+    offset = 0
+
+    while offset < size:
+        sent = os.sendfile(target_fd, source_fd, offset, min(CHUNK_SIZE, size - offset))
+
+        if sent == 0:
+            break
+        offset += sent
+
+
+def _buffered(source_fd, target_fd, size):
+    """Copy through a bounded userspace buffer."""
+    os.lseek(source_fd, 0, os.SEEK_SET)
+
+    while True:
+        chunk = os.read(source_fd, 1024 * 1024)
+
+        if not chunk:
+            break
+        view = memoryview(chunk)
+
+        while view:
+            view = view[os.write(target_fd, view):]
+
+
+COPY_FUNCTIONS = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "buffered": _buffered,
+}
+
+
+def copy_metadata(source, target, source_stat=None):
+    """Copy permissions, timestamps and ownership from source to target."""
+    source_stat = source_stat or os.lstat(str(source))
+    try:
+        os.chown(str(target), source_stat.st_uid, source_stat.st_gid, follow_symlinks=False)
+    except (PermissionError, NotImplementedError):
+        pass
+    shutil.copystat(str(source), str(target), follow_symlinks=False)
+
+
+class CopyEngine:
+    """Copy files and trees using the cheapest strategy the filesystems allow.
+
+    A move is a rename when source and target share a device. Otherwise each
+    file is cloned with a reflink, then copied in kernel with copy_file_range
+    or sendfile, and only copied through userspace if all of those fail.
+    Strategies which fail as unsupported between two devices are not tried
+    again for that pair.
+    """
+
+    def __init__(self, workers=0, strategies=None):
+        """Initialize the engine with a worker count, 0 for one per core."""
+        if workers < 1:
+            workers = min(MAX_COPY_WORKERS, (os.cpu_count() or 1) * 2)
+        self.workers = workers
+        self.strategies = strategies or STRATEGIES
+        self.stats = {strategy: 0 for strategy in STRATEGIES}
+        self.stats["rename"] = 0
+        # Called with the size of each copied file, e.g. to report progress
+        self.progress = None
+        self._unsupported = set()
+        self._lock = threading.Lock()
+
+    def copy_file(self, source, target):
+        """Copy a regular file with its metadata, returning the strategy used."""
+        source_stat = os.stat(str(source))
+        devices = (source_stat.st_dev, os.stat(str(Path(target).parent)).st_dev)
+        source_fd = os.open(str(source), os.O_RDONLY)
+        try:
+            target_fd = os.open(
+                str(target), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, source_stat.st_mode & 0o7777
+            )
+            try:
+                strategy = self._copy_fd(source_fd, target_fd, source_stat.st_size, devices)
+            finally:
+                os.close(target_fd)
+        finally:
+            os.close(source_fd)
+        copy_metadata(source, target, source_stat)
+
+        with self._lock:
+            self.stats[strategy] += 1
+
+        return strategy
+
+    def _copy_fd(self, source_fd, target_fd, size, devices):
+        """Copy between open files with the first strategy that works."""
+        for strategy in self.strategies:
+            if (strategy, devices) in self._unsupported:
+                continue
+            try:
+                COPY_FUNCTIONS[strategy](source_fd, target_fd, size)
+            except (OSError, AttributeError) as e:
+                if strategy == "buffered" or getattr(e, "errno", errno.ENOSYS) not in UNSUPPORTED:
+                    raise
+                logging.debug("Copy strategy {} unsupported: {}".format(strategy, e))
+
+                with self._lock:
+                    self._unsupported.add((strategy, devices))
+                os.ftruncate(target_fd, 0)
+                os.lseek(target_fd, 0, os.SEEK_SET)
+
+                continue
+
+            return strategy
+
+        raise OSError(errno.EIO, "No copy strategy succeeded")
+
+    def copy_files(self, pairs):
+        """Copy (source, target) file pairs in parallel, returning bytes copied."""
+        pairs = list(pairs)
+
+        if not pairs:
+            return 0
+
+        def copy(pair):
+            self.copy_file(*pair)
+            size = os.stat(str(pair[1])).st_size
+
+            if self.progress:
+                self.progress(size)
+
+            return size
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(pairs))) as pool:
+            return sum(pool.map(copy, pairs))
+
+    def copy_tree(self, source, target):
+        """Copy a directory tree, preserving metadata, returning bytes copied."""
+        source = Path(source)
+        target = Path(target)
+        directories = []
+        pairs = []
+
+        for root, dirs, files in os.walk(str(source)):
+            relative = Path(root).relative_to(source)
+            (target / relative).mkdir(exist_ok=True)
+            directories.append((Path(root), target / relative))
+
+            for name in list(dirs) + files:
+                source_item = Path(root) / name
+
+                if source_item.is_symlink():
+                    os.symlink(os.readlink(str(source_item)), str(target / relative / name))
+                    copy_metadata(source_item, target / relative / name)
+                elif name in files:
+                    if stat.S_ISREG(source_item.lstat().st_mode):
+                        pairs.append((source_item, target / relative / name))
+                    else:
+                        logging.warning("Skipping special file {}".format(source_item))
+            dirs[:] = [name for name in dirs if not (Path(root) / name).is_symlink()]
+        copied = self.copy_files(pairs)
+
+        # Directory timestamps are set last, as copying into them changes them
+        for source_dir, target_dir in reversed(directories):
+            copy_metadata(source_dir, target_dir)
+
+        return copied
+
+    def move(self, source, target, copied=None):
+        """Move a file or tree, renaming when possible and copying otherwise.
+
+        copied, if given, is called once a copy is complete and before the
+        source is removed, so callers can record that target holds all of it.
+        """
+        source = Path(source)
+        target = Path(target)
+        try:
+            os.rename(str(source), str(target))
+            self.stats["rename"] += 1
+
+            return 0
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        if source.is_symlink():
+            os.symlink(os.readlink(str(source)), str(target))
+            copy_metadata(source, target)
+            copied_bytes = 0
+        elif source.is_dir():
+            copied_bytes = self.copy_tree(source, target)
+        else:
+            copied_bytes = self.copy_files([(source, target)])
+
+        if copied:
+            copied()
+
+        if source.is_dir() and not source.is_symlink():
+            shutil.rmtree(str(source))
+        else:
+            source.unlink()
+
+        return copied_bytes
@@ -0,0 +1,169 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Bookkeeping of deferred events, with a retry limit and exponential backoff."""
+
+import functools
+import logging
+import time
+
+# Longest wait between two retries of a deferred event, in seconds
+MAX_BACKOFF = 3600
+# Seconds before the first retry, and retries before an event is dropped
+DEFAULT_BACKOFF = 10
+DEFAULT_RETRY_LIMIT = 10
+
+
+def event_kind(event):
+    """Return the kind of an event, its handle path without the key."""
+    return str(event.handle).split("[")[0]
+
+
+def deferrable(handler):
+    """Decorate a charm handler whose events it defers with the charm's deferrals.
+
+    A deferred event re-emitted before its backoff has passed is deferred
+    again without running the handler, and one replaced by a later event of
+    its kind is dropped. Once the handler runs without deferring it, the
+    event is no longer tracked.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(self, event):
+        kind, handle = event_kind(event), str(event.handle)
+
+        if self.deferrals.discard_superseded(kind, handle):
+            # Not deferred again, so the framework drops it
+            return
+
+        if self.deferrals.backing_off(kind, handle):
+            event.defer()
+
+            return
+        result = handler(self, event)
+        self.deferrals.settle(kind, handle)
+
+        return result
+
+    return wrapper
+
+
+class DeferralTracker:
+    """Track the deferred event of each kind in a dict kept in stored state.
+
+    At most one event of each kind is kept deferred. A later event of that
+    kind replaces the pending one, taking over its retries and backoff, and
+    the replaced event is dropped when it is re-emitted. Each retry waits
+    twice as long as the one before, starting at backoff seconds, and after
+    retry_limit retries the event is dropped. A backoff of 0 retries on
+    every hook and a retry_limit of 0 retries until the handler succeeds.
+    """
+
+    def __init__(
+        self, deferrals, backoff=DEFAULT_BACKOFF, retry_limit=DEFAULT_RETRY_LIMIT, clock=time.time
+    ):
+        """Initialize with the stored dict of deferrals and the retry settings."""
+        self.deferrals = deferrals
+        self.backoff = backoff
+        self.retry_limit = retry_limit
+        self.clock = clock
+        self._deferred = set()
+
+    def backing_off(self, kind, handle):
+        """Return true if handle is the pending event of its kind and isn't due yet."""
+        entry = self.deferrals.get(kind)
+
+        return bool(entry) and entry["handle"] == handle and self.clock() < entry["due"]
+
+    def discard_superseded(self, kind, handle):
+        """Return true if handle was replaced by a later event of its kind, forgetting it."""
+        entry = self.deferrals.get(kind)
+
+        if not entry or handle not in entry.get("superseded", []):
+            return False
+        entry = dict(entry)
+        entry["superseded"] = [old for old in entry["superseded"] if old != handle]
+        self.deferrals[kind] = entry
+        logging.debug("Dropping {}, replaced by {}".format(handle, entry["handle"]))
+
+        return True
+
+    def defer(self, event):
+        """Defer an event unless it ran out of retries, replacing a pending one of its kind.
+
+        Returns true if the event was deferred.
+        """
+        kind, handle = event_kind(event), str(event.handle)
+        entry = self.deferrals.get(kind)
+        now = self.clock()
+
+        # Pending events are re-emitted before the hook's own event, so a
+        # pending event which is past due has already been dropped
+        if entry and entry["handle"] != handle and now < entry["due"]:
+            logging.debug("Deferring {} in place of {}".format(handle, entry["handle"]))
+            self.deferrals[kind] = {
+                "handle": handle,
+                "count": entry["count"],
+                "due": entry["due"],
+                "superseded": list(entry.get("superseded", [])) + [entry["handle"]],
+            }
+            self._deferred.add(handle)
+            event.defer()
+
+            return True
+        count = entry["count"] + 1 if entry and entry["handle"] == handle else 1
+
+        if self.retry_limit and count > self.retry_limit:
+            logging.warning("Dropping {} after {} retries".format(handle, self.retry_limit))
+            self.deferrals.pop(kind, None)
+
+            return False
+        delay = min(self.backoff * 2 ** (count - 1), MAX_BACKOFF)
+        superseded = list(entry.get("superseded", [])) if entry and entry["handle"] == handle else []
+        self.deferrals[kind] = {
+            "handle": handle,
+            "count": count,
+            "due": now + delay,
+            "superseded": superseded,
+        }
+        self._deferred.add(handle)
+        logging.debug("Deferring {}, retry {} in {}s".format(handle, count, delay))
+        event.defer()
+
+        return True
+
+    def poll(self, event):
+        """Defer an event waiting on a background job, to run again on the next hook.
+
+        Polling isn't a failed attempt, so it neither backs off nor counts
+        towards the retry limit. Retries the event already used are kept, so
+        a job failing again is deferred with the next backoff.
+        """
+        kind, handle = event_kind(event), str(event.handle)
+        entry = self.deferrals.get(kind)
+
+        if entry and entry["handle"] == handle:
+            entry = dict(entry)
+            entry.update(due=0)
+            self.deferrals[kind] = entry
+        self._deferred.add(handle)
+        event.defer()
+
+    def settle(self, kind, handle):
+        """Stop tracking an event once its handler ran without deferring it."""
+        if handle in self._deferred:
+            self._deferred.discard(handle)
+
+            return
+        entry = self.deferrals.get(kind)
+
+        if entry and entry["handle"] == handle:
+            self.deferrals.pop(kind, None)
+
+    def retry_now(self):
+        """Retry every pending event on the next hook, with its backoff starting over."""
+        for kind in list(self.deferrals):
+            entry = dict(self.deferrals[kind])
+            entry.update(count=0, due=0)
+            self.deferrals[kind] = entry
@@ -5,13 +5,86 @@
 # Distributed under terms of the GPL license.
 """Foundry Charm support library."""
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import importlib
+import json
 import logging
+import os
+from pathlib import Path
+import queue
+import re
 import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
 import zipfile
-from pathlib import Path
 
-from charmhelpers.core import host, templating
-from charmhelpers.fetch import add_source, apt_install, apt_update
+from lib_lazy import LazyModule
+from lib_tree import walk_tree
+
+host = LazyModule("charmhelpers.core.host")
+templating = LazyModule("charmhelpers.core.templating")
+fetch = LazyModule("charmhelpers.fetch")
+
+FOUNDRY_PORT = 30000
+# Subtrees of the data path each storage tier option places, by option
+STORAGE_TIERS = {
+    "worlds_path": ["Data/worlds"],
+    "packages_path": ["Data/systems", "Data/modules"],
+    "assets_path": ["Data/assets"],
+}
+# Every subtree a storage tier may place, followed by walks of the data path
+TIER_SUBTREES = [subtree for subtrees in STORAGE_TIERS.values() for subtree in subtrees]
+# Workers extracting in parallel by default, at most one per core. Measured
+# with tests/benchmarks/bench_extract.py, extraction stops gaining past a
+# couple of workers per core, and 8 on one core was a quarter slower than
+# ZipFile.extractall.
+MAX_EXTRACT_WORKERS = 4
+# Static client assets served to browsers, precompressed when enabled
+PUBLIC_ASSETS = "resources/app/public/"
+MAX_UV_THREADPOOL_SIZE = 64
+MIN_HEAP_SIZE_MB = 512
+# Resource control directives set by each resource_profile preset
+RESOURCE_PROFILES = {
+    "latency": {
+        "CPUWeight": "1000",
+        "IOWeight": "1000",
+        "Nice": "-5",
+        "IOSchedulingClass": "best-effort",
+        "IOSchedulingPriority": "0",
+        "LimitNOFILE": "65536",
+    },
+    "throughput": {
+        "CPUWeight": "100",
+        "IOWeight": "100",
+        "Nice": "0",
+        "IOSchedulingClass": "best-effort",
+        "IOSchedulingPriority": "4",
+        "LimitNOFILE": "65536",
+    },
+}
+# Config options overriding the preset, by the directive they set
+RESOURCE_OPTIONS = {
+    "CPUWeight": "cpu_weight",
+    "IOWeight": "io_weight",
+    "MemoryHigh": "memory_high",
+    "MemoryMax": "memory_max",
+    "LimitNOFILE": "limit_nofile",
+    "Nice": "nice",
+    "CPUAffinity": "cpu_affinity",
+}
+# Directives systemctl set-property can apply to the running service
+RUNTIME_PROPERTIES = {"CPUWeight", "IOWeight", "MemoryHigh", "MemoryMax"}
+INSTANCE_NAME = re.compile(r"^[a-z0-9][a-z0-9-]*$")
+# Keys of Foundry's options.json managed by the charm, by the config option setting them
+SERVER_OPTIONS = {
+    "compressStatic": "compress_static",
+    "compressSocket": "compress_socket",
+    "upnp": "upnp",
+}
 
 
 class PathError(Exception):
@@ -20,6 +93,282 @@ class PathError(Exception):
     pass
 
 
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(str(path), "rb") as source:
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def member_path(target, filename):
+    """Return the path ZipFile.extract writes a member to, sanitizing its name the same way."""
+    arcname = filename.replace("/", os.path.sep)
+
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [part for part in arcname.split(os.path.sep) if part not in ("", os.path.curdir, os.path.pardir)]
+
+    return Path(target).joinpath(*parts)
+
+
+def extract_parallel(zip_path, infos, target, workers):
+    """Extract members with a pool of threads pulling from a shared queue.
+
+    Each thread opens its own ZipFile handle. The first failure stops the
+    other threads and is raised, e.g. BadZipFile on a CRC mismatch.
+    """
+    work = queue.Queue()
+
+    for info in infos:
+        work.put(info)
+    failed = threading.Event()
+
+    def worker():
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            while not failed.is_set():
+                try:
+                    info = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    zip_ref.extract(info, str(target))
+                except Exception:
+                    failed.set()
+                    raise
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(worker) for _ in range(workers)]
+
+    for future in futures:
+        future.result()
+
+
+def write_json_atomic(path, data):
+    """Write data as JSON to path, replacing any existing file atomically."""
+    path = Path(path)
+    tmp_path = path.with_name(".{}.tmp".format(path.name))
+    with open(str(tmp_path), "w") as tmp_file:
+        json.dump(data, tmp_file, indent=1, sort_keys=True)
+    os.replace(str(tmp_path), str(path))
+
+
+def render_artifact(source, target, context, perms=0o444):
+    """Render a template to target, only writing it if the content changed.
+
+    The template is rendered in memory and its digest compared with the file
+    on disk, so callers can skip reloads and restarts when nothing changed.
+    Returns True if target was written.
+    """
+    content = templating.render(source, None, context).encode()
+    try:
+        with open(str(target), "rb") as existing:
+            unchanged = hashlib.sha256(existing.read()).digest() == hashlib.sha256(content).digest()
+    except OSError:
+        unchanged = False
+
+    if unchanged:
+        logging.debug("Rendered {} unchanged".format(target))
+
+        return False
+    logging.info("Rendered {}".format(target))
+    host.write_file(str(target), content, perms=perms)
+
+    return True
+
+
+def remove_path(path):
+    """Remove a file, symlink or directory tree."""
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(str(path))
+    else:
+        path.unlink()
+
+
+def sync_tree(source, target, engine=None, changed_since=None, prune=True):
+    """Make target an exact copy of source, copying only what differs.
+
+    Files are compared by size and modification time, and copied in parallel
+    by the CopyEngine. Files whose inode changed after changed_since, in ns,
+    are copied regardless. With prune, entries in target which are not in
+    source are removed. Returns a tuple of files copied, bytes copied and
+    entries removed.
+    """
+    if engine is None:
+        # Imported here, the copy engine is only needed to move data
+        from lib_copy import CopyEngine
+
+        engine = CopyEngine()
+    pending = []
+
+    for root, dirs, files in os.walk(str(source)):
+        root = Path(root)
+        target_root = target / root.relative_to(source)
+        _sync_dirs(root, dirs, files, target_root)
+
+        for name in files:
+            if _sync_entry(root / name, target_root / name, changed_since):
+                pending.append((root / name, target_root / name))
+    copied_bytes = engine.copy_files(pending)
+
+    return len(pending), copied_bytes, _prune_tree(source, target) if prune else 0
+
+
+def _sync_dirs(root, dirs, files, target_root):
+    """Create the directories of root which are missing from target_root.
+
+    Symlinks to directories are moved to files, so they are copied as links
+    instead of being walked.
+    """
+    for name in dirs:
+        source_dir = root / name
+        target_dir = target_root / name
+
+        if source_dir.is_symlink():
+            files.append(name)
+        elif not target_dir.is_dir() or target_dir.is_symlink():
+            if target_dir.is_symlink() or target_dir.exists():
+                remove_path(target_dir)
+            target_dir.mkdir()
+            shutil.copystat(str(source_dir), str(target_dir))
+    dirs[:] = [name for name in dirs if not (root / name).is_symlink()]
+
+
+def _up_to_date(source_stat, target_stat, changed_since):
+    """Return true if a synced file matches its source.
+
+    copy2 copies the times after the content, so a file rewritten during a
+    copy can end up with the new times and the old content. Its ctime still
+    shows the change, so files changed since changed_since never match.
+    """
+    if target_stat is None or (changed_since and source_stat.st_ctime_ns >= changed_since):
+        return False
+
+    return (
+        target_stat.st_size == source_stat.st_size
+        and target_stat.st_mtime_ns == source_stat.st_mtime_ns
+        and stat.S_IFMT(target_stat.st_mode) == stat.S_IFMT(source_stat.st_mode)
+    )
+
+
+def _sync_entry(source_file, target_file, changed_since):
+    """Bring one entry of target up to date.
+
+    Returns True if it is a regular file which still has to be copied,
+    other entries like symlinks are copied straight away.
+    """
+    source_stat = source_file.lstat()
+    try:
+        target_stat = target_file.lstat()
+    except FileNotFoundError:
+        target_stat = None
+
+    if _up_to_date(source_stat, target_stat, changed_since):
+        return False
+
+    if target_stat is not None:
+        remove_path(target_file)
+
+    if stat.S_ISREG(source_stat.st_mode):
+        return True
+    shutil.copy2(str(source_file), str(target_file), follow_symlinks=False)
+
+    return False
+
+
+def _prune_tree(source, target):
+    """Remove entries of target which are not in source, returning how many."""
+    removed = 0
+
+    for root, dirs, files in os.walk(str(target), topdown=False):
+        source_root = source / Path(root).relative_to(target)
+
+        for name in dirs + files:
+            if not os.path.lexists(str(source_root / name)):
+                remove_path(Path(root) / name)
+                removed += 1
+
+    return removed
+
+
+def tree_size(path, follow=()):
+    """Return the total size in bytes of the regular files under path.
+
+    The symlinked directories in follow, relative to path, are counted too.
+    """
+    path = Path(path)
+
+    if path.is_symlink() or not path.is_dir():
+        return path.lstat().st_size if not path.is_symlink() else 0
+    total = 0
+
+    for root, _, files in walk_tree(path, follow):
+        for name in files:
+            file_stat = os.lstat(os.path.join(root, name))
+
+            if stat.S_ISREG(file_stat.st_mode):
+                total += file_stat.st_size
+
+    return total
+
+
+def format_bytes(size):
+    """Format a byte count for humans, e.g. 12.3 GB."""
+    for unit in ("B", "kB", "MB", "GB"):
+        if abs(size) < 1000:
+            return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+        size /= 1000
+
+    return "{:.1f} TB".format(size)
+
+
+class MigrationProgress:
+    """Track bytes copied by a data migration and report throughput and ETA."""
+
+    def __init__(self, total, done=0, status=None, interval=5):
+        """Initialize with the total and already copied bytes, and a status callable."""
+        self.total = total
+        self.done = done
+        self.status = status
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last_report = 0
+        self._copied = 0
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        """Seconds since this run of the migration started."""
+        return time.monotonic() - self.start
+
+    @property
+    def message(self):
+        """Status message with progress, throughput and ETA."""
+        rate = self._copied / max(self.elapsed, 0.001)
+        message = "Relocating data: {} / {}, {}/s".format(
+            format_bytes(self.done), format_bytes(self.total), format_bytes(int(rate))
+        )
+
+        if rate > 0 and self.total > self.done:
+            message += ", ETA {}s".format(int((self.total - self.done) / rate))
+
+        return message
+
+    def add(self, size):
+        """Record size more bytes copied, reporting at most once per interval."""
+        with self._lock:
+            self.done += size
+            self._copied += size
+            now = time.monotonic()
+
+            if self.status and now - self.last_report >= self.interval:
+                self.last_report = now
+                self.status(self.message)
+
+
 class FoundryHelper:
     """Helper module"""
 
@@ -31,71 +380,1389 @@ class FoundryHelper:
         self.default_data_path = Path("/opt/foundry/userdata")
         self.service_file = Path("/etc/systemd/system/foundryvtt.service")
         self.service_name = "foundryvtt.service"
+        self.instance_service_file = Path("/etc/systemd/system/foundryvtt@.service")
+        self.instance_config_path = Path("/etc/foundryvtt/instances")
+        self.instances_data_path = Path("/opt/foundry/instances")
+        self.compaction_timer = "foundryvtt-compact-job.timer"
+        self.replication_path = Path("/etc/foundryvtt/replication")
+        self.replica_source_service = "foundryvtt-replica-source.service"
+        self.replicate_timer = "foundryvtt-replicate.timer"
+        self.exporter_service = "foundryvtt-exporter.service"
+        self.systemd_path = Path("/etc/systemd/system")
         self.node_version = "12.x"
+        self.apt_sources_path = Path("/etc/apt")
+        self.sources_updated = False
         self.dependencies = [
             "nodejs",
             "libssl-dev",
         ]
 
+        if config.get("precompress_assets"):
+            # Used to write .br siblings of static assets
+            self.dependencies.append("python3-brotli")
+
+    @property
+    def releases_path(self):
+        """Directory holding one versioned slot per installed release."""
+        return self.install_path / "releases"
+
+    @property
+    def current_path(self):
+        """Symlink to the release slot the service runs from."""
+        return self.install_path / "current"
+
+    @property
+    def current_release(self):
+        """Name of the active release slot, or None if there isn't one."""
+        if not self.current_path.is_symlink():
+            return None
+
+        return Path(os.readlink(str(self.current_path))).name
+
+    def releases(self):
+        """Return installed release slot names, most recently activated first."""
+        if not self.releases_path.is_dir():
+            return []
+        slots = [
+            slot
+            for slot in self.releases_path.iterdir()
+            if slot.is_dir() and not slot.name.startswith(".")
+        ]
+        slots.sort(key=lambda slot: slot.stat().st_mtime, reverse=True)
+
+        return [slot.name for slot in slots]
+
+    def read_manifest(self, release):
+        """Return the manifest of an installed release, or an empty one."""
+        try:
+            with open(str(self.releases_path / "{}.json".format(release)), "r") as manifest:
+                return json.load(manifest)
+        except (OSError, ValueError):
+            return {"digest": None, "members": {}}
+
     def install_zip(self, zip_path):
-        """Install the zip file."""
-        self.install_path.mkdir(parents=True, exist_ok=True)
+        """Install the zip file into its own release slot and activate it.
+
+        Each release is extracted into a slot named after the resource digest
+        while the service keeps running from the current slot. Members that
+        are unchanged from the current release are hard linked rather than
+        extracted again. Returns True if the active release changed.
+        """
+        self.releases_path.mkdir(parents=True, exist_ok=True)
         self.default_data_path.mkdir(parents=True, exist_ok=True)
 
         if not self.state.current_data_path:
             self.state.current_data_path = str(self.default_data_path)
+        digest = file_digest(zip_path)
+        release = digest[:16]
+        pinned = self.state.pinned_release
+
+        if pinned and pinned["digest"] == digest and (self.releases_path / pinned["release"]).is_dir():
+            logging.info(
+                "Keeping rolled back release {} until a new resource is attached".format(
+                    pinned["release"]
+                )
+            )
+
+            return self.activate_release(pinned["release"])
+        self.state.pinned_release = None
+
+        if self.read_manifest(release)["digest"] == digest:
+            logging.info("Resource {} is already installed".format(digest))
+        else:
+            # Imported here, most hooks don't record operations
+            from lib_metrics import record_operation
+
+            started = time.perf_counter()
+            written = self._build_release(zip_path, digest, release)
+            record_operation("extract", time.perf_counter() - started, written)
+
+        return self.activate_release(release)
+
+    def _build_release(self, zip_path, digest, release):
+        """Extract a release into a partial slot and rename it into place.
+
+        Returns the number of bytes extracted rather than linked.
+        """
+        partial = self.releases_path / ".partial-{}".format(release)
+
+        if partial.exists():
+            shutil.rmtree(str(partial))
+        partial.mkdir()
+        current = self.current_release
+        installed = self.read_manifest(current)["members"] if current else {}
+        members = {}
+        pending = []
+        linked = 0
         with zipfile.ZipFile(zip_path, "r") as zip_ref:
-            zip_ref.extractall(self.install_path)
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    zip_ref.extract(info, str(partial))
+
+                    continue
+                member = {"size": info.file_size, "crc": info.CRC}
+                members[info.filename] = member
+
+                if installed.get(info.filename) == member and self._link_member(
+                    current, partial, info.filename
+                ):
+                    linked += info.file_size
+
+                    continue
+                pending.append(info)
+        written = self.extract_members(zip_path, pending, partial)
+        manifest = {"digest": digest, "members": members}
+
+        if self.charm_config.get("precompress_assets"):
+            # Imported here, gzip is only needed when precompressing
+            from lib_compress import Precompressor
+
+            manifest["precompressed"] = Precompressor(self.extract_workers).precompress(
+                partial,
+                [name for name in members if name.startswith(PUBLIC_ASSETS)],
+                previous_root=self.releases_path / current if current else None,
+                previous_stats=self.read_manifest(current).get("precompressed"),
+                unchanged=[name for name in members if installed.get(name) == members[name]],
+            )
+        slot = self.releases_path / release
+
+        if slot.exists():
+            shutil.rmtree(str(slot))
+        os.rename(str(partial), str(slot))
+        write_json_atomic(self.releases_path / "{}.json".format(release), manifest)
+        logging.info(
+            "Installed release {}: {} bytes written, {} bytes linked from {}".format(
+                release, written, linked, current
+            )
+        )
+
+        return written
+
+    def _link_member(self, release, target, name):
+        """Hard link an unchanged member from an installed release into target."""
+        if Path(name).is_absolute() or ".." in Path(name).parts:
+            return False
+        source = self.releases_path / release / name
+        destination = target / name
+        try:
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            os.link(str(source), str(destination))
+        except OSError:
+            return False
+
+        return True
+
+    def activate_release(self, release):
+        """Atomically point the current symlink at a release slot.
+
+        Returns True if the active release changed.
+        """
+        slot = self.releases_path / release
+        os.utime(str(slot))
+        changed = self.current_release != release
+
+        if changed:
+            tmp_link = self.install_path / ".current.tmp"
+
+            if tmp_link.is_symlink():
+                tmp_link.unlink()
+            tmp_link.symlink_to(Path("releases") / release)
+            os.replace(str(tmp_link), str(self.current_path))
+            logging.info("Activated release {}".format(release))
+        self.prune_releases()
+
+        return changed
+
+    def rollback_release(self):
+        """Activate the most recent release before the current one.
+
+        The release is pinned until a different resource is attached, so
+        installing the attached resource again, as upgrade-charm does, doesn't
+        undo the rollback.
+        """
+        current = self.current_release
+        previous = [release for release in self.releases() if release != current]
+
+        if not previous:
+            raise PathError("No previous release to roll back to")
+        pinned = self.state.pinned_release
+        # Rolling back again keeps the digest of the attached resource
+        digest = pinned["digest"] if pinned else self.read_manifest(current)["digest"]
+        self.activate_release(previous[0])
+        self.state.pinned_release = {"release": previous[0], "digest": digest}
+
+        return previous[0]
+
+    def prune_releases(self):
+        """Remove release slots beyond the configured retention."""
+        retention = max(self.charm_config.get("release_retention") or 1, 1)
+        current = self.current_release
+        keep = [release for release in self.releases() if release != current]
+        keep = keep[: retention - 1]
+
+        for release in self.releases():
+            if release == current or release in keep:
+                continue
+            logging.info("Removing old release {}".format(release))
+            shutil.rmtree(str(self.releases_path / release))
+            manifest = self.releases_path / "{}.json".format(release)
+
+            if manifest.exists():
+                manifest.unlink()
+
+    def adopt_legacy_install(self):
+        """Move an install extracted directly into the install path into a slot.
+
+        Returns True if a legacy install was adopted.
+        """
+        if self.current_path.is_symlink() or not (self.install_path / "resources").exists():
+            return False
+        legacy = self.releases_path / "legacy"
+        legacy.mkdir(parents=True, exist_ok=True)
+
+        for item in self.install_path.iterdir():
+            if item.name != self.releases_path.name:
+                shutil.move(str(item), str(legacy))
+        # Manifest written by installs made before release slots existed
+        legacy_manifest = self.install_path.with_name(
+            "{}.manifest.json".format(self.install_path.name)
+        )
+
+        if legacy_manifest.exists():
+            legacy_manifest.unlink()
+        logging.info("Adopted legacy install as release {}".format(legacy.name))
+        self.activate_release(legacy.name)
+
+        return True
+
+    @property
+    def extract_workers(self):
+        """Number of extraction workers, 0 in config selects one per core."""
+        workers = self.charm_config.get("extract_workers") or 0
+
+        if workers < 1:
+            workers = min(MAX_EXTRACT_WORKERS, os.cpu_count() or 1)
+
+        return workers
+
+    def extract_members(self, zip_path, infos, target):
+        """Extract the given zip members into the target directory.
+
+        Members are streamed to disk by a bounded pool of threads, each with
+        its own ZipFile handle pulling from a shared queue. Returns the number
+        of bytes written.
+        """
+        infos = sorted(infos, key=lambda info: info.file_size, reverse=True)
+        # Parent directories are created up front so workers never race on them
+        for parent in {member_path(target, info.filename).parent for info in infos}:
+            parent.mkdir(parents=True, exist_ok=True)
+        workers = min(self.extract_workers, len(infos))
+
+        if workers <= 1:
+            with zipfile.ZipFile(zip_path, "r") as zip_ref:
+                for info in infos:
+                    zip_ref.extract(info, str(target))
+        else:
+            extract_parallel(zip_path, infos, target, workers)
+
+        return sum(info.file_size for info in infos)
+
+    @property
+    def deb_cache_path(self):
+        """Directory of .deb files to install from instead of the network, if set."""
+        path = self.charm_config.get("deb_cache_path")
+
+        return Path(path) if path else None
 
     def add_sources(self):
-        """Ensure apt repositories are configured and updated for use."""
+        """Ensure apt repositories are configured and updated for use.
+
+        The repository, key and distro are fingerprinted, and the source is
+        only added and apt updated when the fingerprint changes or the source
+        has gone missing. Returns True if apt was updated.
+        """
+        if self.deb_cache_path:
+            logging.info("Installing from {}, skipping apt sources".format(self.deb_cache_path))
+
+            return False
         distro = host.get_distrib_codename()
         apt_repo = self.charm_config.get("node_repo")
         apt_key = self.charm_config.get("node_repo_key")
         version = "node_{}".format(self.node_version)
         apt_line = "deb {}/{} {} main".format(apt_repo, version, distro)
+        digest = hashlib.sha256(
+            json.dumps([apt_line, apt_key, distro]).encode()
+        ).hexdigest()
+
+        if digest == self.state.apt_source_digest and self._source_configured(apt_line):
+            logging.info("Apt source {} unchanged, skipping update".format(apt_line))
+
+            return False
         logging.info(
             "Installing and updating apt source {} key {})".format(apt_line, apt_key)
         )
-        add_source(apt_line, apt_key)
-        apt_update()
+        fetch.add_source(apt_line, apt_key)
+        fetch.apt_update()
+        self.state.apt_source_digest = digest
+        self.sources_updated = True
+
+        return True
+
+    def _source_configured(self, apt_line):
+        """Return true if apt_line is present in the apt sources."""
+        sources = [self.apt_sources_path / "sources.list"]
+        sources += sorted((self.apt_sources_path / "sources.list.d").glob("*.list"))
+
+        for source in sources:
+            try:
+                lines = source.read_text().splitlines()
+            except OSError:
+                continue
+
+            if apt_line in (line.strip() for line in lines):
+                return True
+
+        return False
+
+    def installed_versions(self, packages):
+        """Return a dict of package name to version for installed packages."""
+        try:
+            result = subprocess.run(
+                ["dpkg-query", "-W", "-f=${Package} ${Status} ${Version}\\n"] + list(packages),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+            )
+        except FileNotFoundError:
+            return {}
+        versions = {}
+
+        for line in result.stdout.splitlines():
+            fields = line.split()
+
+            if len(fields) == 5 and fields[1:4] == ["install", "ok", "installed"]:
+                versions[fields[0]] = fields[4]
+
+        return versions
+
+    def dependencies_satisfied(self):
+        """Return true if the dependencies are installed with the expected node version."""
+        versions = self.installed_versions(self.dependencies)
+
+        if set(versions) != set(self.dependencies):
+            return False
+        node_major = self.node_version.split(".")[0]
+
+        return versions["nodejs"].split(":")[-1].startswith("{}.".format(node_major))
 
     def install_dependencies(self):
-        """Install dependencies."""
-        apt_install(self.dependencies, fatal=True)
+        """Install dependencies, unless they are installed and the sources unchanged."""
+        if not self.sources_updated and self.dependencies_satisfied():
+            logging.info("Dependencies {} already installed".format(self.dependencies))
 
-    def render_systemd_service(self):
-        """Install systemd service file."""
-        context = {}
-        context["install_path"] = self.install_path
-        context["data_path"] = self.state.current_data_path
-        templating.render(self.service_name, self.service_file, context, perms=0o440)
+            return
 
-    def migrate_data(self):
-        """Migrate data to a new path."""
+        packages = []
 
-        if not self.needs_data_migration:
-            logging.error("Cowardly refusing to migrate data unnecessarily")
+        if self.deb_cache_path:
+            packages = [str(deb) for deb in sorted(self.deb_cache_path.glob("*.deb"))]
+
+            if not packages:
+                logging.warning("No .deb files in {}".format(self.deb_cache_path))
+
+        if packages:
+            logging.info("Installing dependencies from {}".format(packages))
+            fetch.apt_install(
+                packages,
+                options=["--option=Dpkg::Options::=--force-confold", "--no-download"],
+                fatal=True,
+            )
 
             return
-        data_path = Path(self.state.current_data_path)
+        fetch.apt_install(self.dependencies, fatal=True)
+
+    def host_memory_mb(self):
+        """Return the total memory of the host in MB."""
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+
+        return 0
+
+    def _tuning_value(self, key, auto):
+        """Return an integer tuning option, calling auto for 'auto' and None if unset."""
+        value = str(self.charm_config.get(key) or "").strip()
+
+        if not value:
+            return None
+
+        if value == "auto":
+            return auto()
+        try:
+            return int(value)
+        except ValueError:
+            logging.warning("Ignoring invalid {} value {}".format(key, value))
+
+            return None
+
+    def runtime_tuning(self):
+        """Return the Node.js runtime settings derived from config and the host.
+
+        In auto mode the V8 old space is half of the host memory shared
+        between the main server and auto_heap_instances instances, at least
+        512 MB, and the libuv threadpool has two threads per core, between 4
+        and 64, as Foundry's asset and database I/O all goes through it. The
+        share doesn't depend on the instances running, so adding or removing
+        one leaves the others' settings alone.
+        """
+        ceiling = self.charm_config.get("auto_heap_instances") or 0
+        processes = 1 + ceiling
+
+        if self.charm_config.get("node_heap_size") == "auto" and len(self.instance_names) > ceiling:
+            logging.warning(
+                "{} instances run but the auto heap leaves room for {}, raise auto_heap_instances".format(
+                    len(self.instance_names), ceiling
+                )
+            )
+        heap_size = self._tuning_value(
+            "node_heap_size",
+            lambda: max(MIN_HEAP_SIZE_MB, self.host_memory_mb() // 2 // processes),
+        )
+        threadpool_size = self._tuning_value(
+            "uv_threadpool_size",
+            lambda: min(MAX_UV_THREADPOOL_SIZE, max(4, (os.cpu_count() or 1) * 2)),
+        )
+        node_flags = []
+
+        if heap_size:
+            node_flags.append("--max-old-space-size={}".format(heap_size))
+
+        return {
+            "heap_size_mb": heap_size,
+            "uv_threadpool_size": threadpool_size,
+            "node_options": (self.charm_config.get("node_options") or "").strip(),
+            "node_flags": node_flags,
+        }
+
+    @property
+    def port(self):
+        """Port the Foundry service listens on."""
+        return self.charm_config.get("foundry_port") or FOUNDRY_PORT
+
+    @property
+    def options_file(self):
+        """Foundry's server options in the data directory."""
+        return Path(self.state.current_data_path) / "Config" / "options.json"
+
+    def server_options(self, proxied=False):
+        """Return the server options managed by the charm.
+
+        The port is the one the proxy is pointed at. Behind the proxy Foundry
+        builds its links with the external port, and with https if the proxy
+        terminates TLS on 443.
+        """
+        options = {key: bool(self.charm_config.get(option)) for key, option in SERVER_OPTIONS.items()}
+        options["port"] = self.port
+        options["proxyPort"] = None
+        options["proxySSL"] = False
+
+        if proxied:
+            options["proxyPort"] = self.charm_config.get("proxy_port")
+            options["proxySSL"] = options["proxyPort"] == 443
+
+        return options
+
+    def render_server_options(self, proxied=False):
+        """Merge the managed options into options.json, returning those that changed.
+
+        Keys the charm doesn't manage are left as they are. Foundry only reads
+        the file when it starts, so changed options need a restart to apply.
+        """
+        if not self.state.current_data_path:
+            return {}
+        options_file = self.options_file
+        try:
+            with open(str(options_file), "r") as existing:
+                options = json.load(existing)
+        except FileNotFoundError:
+            options = {}
+        except (OSError, ValueError) as e:
+            logging.error("Not merging server options into {}: {}".format(options_file, e))
+
+            return {}
+        changed = {
+            key: value
+            for key, value in self.server_options(proxied).items()
+            if key not in options or options[key] != value
+        }
+
+        if not changed:
+            return changed
+        options.update(changed)
+        options_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = options_file.with_name(".{}.tmp".format(options_file.name))
+        with open(str(tmp_path), "w") as tmp_file:
+            # Indented as Foundry writes it
+            json.dump(options, tmp_file, indent=2)
+        os.replace(str(tmp_path), str(options_file))
+        logging.info("Server options changed: {}".format(changed))
+
+        return changed
+
+    def wait_until_ready(self, timeout):
+        """Wait for Foundry to serve, returning the seconds and attempts it took.
+
+        The seconds are None if Foundry didn't become ready within timeout.
+        """
+        # Imported here, only hooks which start Foundry probe it
+        from lib_probe import wait_until_ready
+
+        return wait_until_ready("127.0.0.1", self.port, timeout)
+
+    def record_cold_start(self, reason, seconds, attempts):
+        """Record how long Foundry took to serve after being started."""
+        # Imported here, only hooks which start Foundry record cold starts
+        from lib_metrics import record_operation
+        from lib_probe import record_cold_start
+
+        data_path = self.state.current_data_path
+        record = {
+            "time": time.time(),
+            "reason": reason,
+            "release": self.current_release,
+            "seconds": seconds,
+            "attempts": attempts,
+            "data_bytes": tree_size(Path(data_path), TIER_SUBTREES) if data_path else None,
+        }
+        logging.info("Foundry ready after {:.1f}s ({})".format(seconds, reason))
+        record_cold_start(record)
+        record_operation("start", seconds)
+
+    @property
+    def resource_dropin(self):
+        """Drop-in file holding the resource controls of the service."""
+        return self.service_file.with_name(self.service_file.name + ".d") / "resources.conf"
 
+    def resource_controls(self):
+        """Return the resource control directives from the profile and overrides."""
+        profile = self.charm_config.get("resource_profile") or ""
+
+        if profile and profile not in RESOURCE_PROFILES:
+            logging.warning("Ignoring unknown resource profile {}".format(profile))
+        controls = dict(RESOURCE_PROFILES.get(profile, {}))
+
+        for directive, key in RESOURCE_OPTIONS.items():
+            value = str(self.charm_config.get(key) or "").strip()
+
+            if value:
+                controls[directive] = value
+
+        return controls
+
+    def service_context(self):
+        """Return the context the service file and its drop-ins are rendered with."""
+        context = self.runtime_tuning()
+        context["current_path"] = self.current_path
+        context["data_path"] = self.state.current_data_path
+        context["resource_controls"] = self.resource_controls()
+
+        return context
+
+    def render_systemd_service(self):
+        """Install systemd service file, returning True if it changed."""
+        return render_artifact(
+            self.service_name, self.service_file, self.service_context(), perms=0o440
+        )
+
+    @property
+    def instance_resource_dropin(self):
+        """Drop-in file holding the resource controls of every instance."""
+        return (
+            self.instance_service_file.with_name(self.instance_service_file.name + ".d")
+            / "resources.conf"
+        )
+
+    def applied_resource_controls(self, dropin=None):
+        """Return the resource control directives in the installed drop-in.
+
+        The drop-in is the main service's unless another is given.
+        """
+        dropin = dropin or self.resource_dropin
+        try:
+            lines = dropin.read_text().splitlines()
+        except OSError:
+            return {}
+        controls = {}
+
+        for line in lines:
+            if "=" in line and not line.startswith("#"):
+                directive, value = line.split("=", 1)
+                controls[directive.strip()] = value.strip()
+
+        return controls
+
+    def render_resource_controls(self, dropin=None):
+        """Install the resource control drop-in, returning the directives that changed.
+
+        The drop-in is the main service's unless another is given. Directives
+        removed from the drop-in are returned with a value of None.
+        """
+        dropin = dropin or self.resource_dropin
+        previous = self.applied_resource_controls(dropin)
+        context = self.service_context()
+        controls = context["resource_controls"]
+
+        if not controls:
+            if dropin.exists():
+                logging.info("Removing {}".format(dropin))
+                dropin.unlink()
+
+            return {directive: None for directive in previous}
+        dropin.parent.mkdir(exist_ok=True)
+        render_artifact("foundryvtt-resources.conf", dropin, context)
+        changed = {
+            directive: value
+            for directive, value in controls.items()
+            if previous.get(directive) != value
+        }
+        changed.update({directive: None for directive in previous if directive not in controls})
+
+        return changed
+
+    def apply_resource_controls(self, changed, service=None):
+        """Apply changed resource controls to a running service, the main one by default.
+
+        Directives cgroups can change are set with systemctl set-property, so
+        the service keeps running. Returns False if the service has to be
+        restarted for the changes to apply.
+        """
+        if not changed:
+            return True
+
+        for directive, value in changed.items():
+            if value is None or directive not in RUNTIME_PROPERTIES:
+                return False
+        command = ["systemctl", "set-property", "--runtime", service or self.service_name]
+        command += ["{}={}".format(directive, value) for directive, value in sorted(changed.items())]
+        try:
+            subprocess.check_call(command)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning("Could not apply resource controls at runtime: {}".format(e))
+
+            return False
+        logging.info("Applied resource controls {}".format(command[4:]))
+
+        return True
+
+    @property
+    def instance_names(self):
+        """Names of the additional Foundry instances requested in config."""
+        names = []
+
+        for name in (self.charm_config.get("instances") or "").replace(",", " ").split():
+            if not INSTANCE_NAME.match(name):
+                logging.warning("Ignoring invalid instance name {}".format(name))
+            elif name not in names:
+                names.append(name)
+
+        return names
+
+    def instance_service(self, name):
+        """Name of the service running an instance."""
+        return "foundryvtt@{}.service".format(name)
+
+    def instances(self):
+        """Return the port of each configured instance, by name."""
+        ports = {}
+
+        if not self.instance_config_path.is_dir():
+            return ports
+
+        for env_file in sorted(self.instance_config_path.glob("*.env")):
+            for line in env_file.read_text().splitlines():
+                if line.startswith("FOUNDRY_PORT="):
+                    ports[env_file.stem] = int(line.split("=", 1)[1])
+
+        return ports
+
+    def render_instance_service(self):
+        """Install the instance service template, returning True if it changed."""
+        if not self.instance_names and not self.instance_service_file.exists():
+            return False
+        context = self.service_context()
+        context["instance_config_path"] = self.instance_config_path
+
+        return render_artifact(
+            "foundryvtt@.service", self.instance_service_file, context, perms=0o440
+        )
+
+    def render_instance_resource_controls(self):
+        """Install the instances' resource control drop-in, returning the directives that changed.
+
+        The drop-in is kept apart from the instance service template, so the
+        controls can change without rewriting the template every instance
+        runs from.
+        """
+        if not self.instance_names and not self.instance_service_file.exists():
+            return {}
+
+        return self.render_resource_controls(self.instance_resource_dropin)
+
+    def sync_instances(self):
+        """Add and remove instance configuration to match config.
+
+        Each new instance gets its own data directory and the lowest free port
+        from instance_base_port. Ports of existing instances never change, and
+        the data of removed instances is kept. Returns the added and removed
+        instance names.
+        """
+        ports = self.instances()
+        wanted = self.instance_names
+        removed = [name for name in ports if name not in wanted]
+        added = [name for name in wanted if name not in ports]
+
+        for name in removed:
+            logging.info(
+                "Removing instance {}, keeping its data in {}".format(
+                    name, self.instances_data_path / name
+                )
+            )
+            (self.instance_config_path / "{}.env".format(name)).unlink()
+            del ports[name]
+
+        if added:
+            self.instance_config_path.mkdir(parents=True, exist_ok=True)
+        port = self.charm_config.get("instance_base_port") or 30001
+
+        for name in added:
+            while port in ports.values() or port == self.port:
+                port += 1
+            data_path = self.instances_data_path / name
+            data_path.mkdir(parents=True, exist_ok=True)
+            host.write_file(
+                str(self.instance_config_path / "{}.env".format(name)),
+                "FOUNDRY_PORT={}\nFOUNDRY_DATA_PATH={}\n".format(port, data_path).encode(),
+                perms=0o444,
+            )
+            logging.info("Added instance {} on port {}".format(name, port))
+            ports[name] = port
+
+        return added, removed
+
+    @property
+    def migration_target(self):
+        """The path data should be migrated to."""
         if not self.charm_config.get("custom_data_path"):
             # Migrate current -> default
-            target_path = self.default_data_path
             self.default_data_path.mkdir(parents=True, exist_ok=True)
-        else:
-            # Migrate current -> custom
-            target_path = Path(self.charm_config["custom_data_path"])
 
+            return self.default_data_path
+        # Migrate current -> custom
+
+        return Path(self.charm_config["custom_data_path"])
+
+    @property
+    def background_jobs(self):
+        """Returns true if long operations should run outside of the hook."""
+        return bool(self.charm_config.get("background_jobs"))
+
+    @property
+    def copy_engine(self):
+        """A CopyEngine configured from charm config."""
+        # Imported here, the copy engine is only needed to move data
+        from lib_copy import CopyEngine
+
+        return CopyEngine(self.charm_config.get("copy_workers") or 0)
+
+    @property
+    def live_migration(self):
+        """Returns true if data should be pre-copied while the service runs."""
+        return self.charm_config.get("data_migration_mode") == "live"
+
+    def _check_migration_target(self, target_path):
+        """Raise PathError if data can not be migrated to target_path."""
         if not target_path.is_dir():
             raise PathError("Destination directory does not exist")
         if any(target_path.iterdir()):
             raise PathError("Destination directory is not empty")
-        for item in data_path.iterdir():
-            shutil.move(str(item.resolve()), str(target_path))
+
+    @property
+    def migration_journal(self):
+        """File recording the progress of an interrupted data migration."""
+        return self.default_data_path.with_name("migration.json")
+
+    def _start_journal(self, data_path, target_path, check_target=True):
+        """Return the journal for this migration, starting one if needed.
+
+        A journal left by an interrupted migration between the same paths is
+        resumed, in which case the target is expected to hold partial data.
+        """
+        try:
+            with open(str(self.migration_journal), "r") as journal_file:
+                journal = json.load(journal_file)
+        except (OSError, ValueError):
+            journal = None
+
+        if journal and (journal["source"], journal["target"]) == (
+            str(data_path),
+            str(target_path),
+        ):
+            logging.info(
+                "Resuming migration to {}, {} of {} bytes done".format(
+                    target_path, journal["bytes_done"], journal["bytes_total"]
+                )
+            )
+
+            return journal
+
+        if check_target:
+            self._check_migration_target(target_path)
+        items = {item.name: tree_size(item) for item in data_path.iterdir()}
+        journal = {
+            "source": str(data_path),
+            "target": str(target_path),
+            "phase": "copying",
+            "items": items,
+            "completed": {},
+            "bytes_total": sum(items.values()),
+            "bytes_done": 0,
+        }
+        write_json_atomic(self.migration_journal, journal)
+
+        return journal
+
+    def _update_journal(self, journal, **changes):
+        """Apply changes to the journal and persist it."""
+        journal.update(changes)
+        write_json_atomic(self.migration_journal, journal)
+
+    def finish_migration(self):
+        """Remove the journal of a migration which has been fully applied."""
+        if self.migration_journal.exists() and not self.needs_data_migration:
+            self.migration_journal.unlink()
+
+    def presync_data(self, status=None):
+        """Copy the data path to the migration target while the service runs.
+
+        The copy is brought up to date by migrate_data(presynced=True) once the
+        service has been stopped, so only files changed in between are copied
+        during the outage. Progress is passed to the status callable.
+        """
+        data_path = Path(self.state.current_data_path)
+        target_path = self.migration_target
+        journal = self._start_journal(data_path, target_path)
+
+        if journal["phase"] != "copying" or journal["completed"]:
+            # An interrupted offline move can't be pre-synced, it is resumed instead
+            logging.info("Skipping pre-copy, migration already in phase {}".format(journal["phase"]))
+
+            return
+        progress = MigrationProgress(journal["bytes_total"], status=status)
+        engine = self.copy_engine
+        engine.progress = progress.add
+        presync_started = time.time_ns()
+        copied, copied_bytes, _ = sync_tree(data_path, target_path, engine)
+        self._update_journal(
+            journal,
+            phase="presynced",
+            bytes_done=journal["bytes_total"],
+            presync_started=presync_started,
+        )
+        logging.info(
+            "Pre-copied {} files ({} bytes) to {} in {:.1f}s".format(
+                copied, copied_bytes, target_path, progress.elapsed
+            )
+        )
+
+    def migrate_data(self, presynced=False, status=None):
+        """Migrate data to a new path.
+
+        With presynced the target already holds a copy from presync_data and
+        only the changes since then are copied before the old data is removed.
+        Progress is recorded in a journal so an interrupted migration resumes
+        where it stopped, and is passed to the status callable.
+        """
+
+        if not self.needs_data_migration:
+            logging.error("Cowardly refusing to migrate data unnecessarily")
+
+            return
+        # Imported here, most hooks don't record operations
+        from lib_metrics import record_operation
+
+        data_path = Path(self.state.current_data_path)
+        target_path = self.migration_target
+        journal = self._start_journal(data_path, target_path, check_target=not presynced)
+        engine = self.copy_engine
+
+        if journal["phase"] == "presynced":
+            progress = MigrationProgress(0, status=status)
+            # Files changed while they were pre-copied may not look changed
+            copied, copied_bytes, removed = sync_tree(
+                data_path, target_path, engine, changed_since=journal.get("presync_started")
+            )
+            logging.info(
+                "Synced {} changed files ({} bytes), removed {} in {:.1f}s".format(
+                    copied, copied_bytes, removed, progress.elapsed
+                )
+            )
+            record_operation("migrate", progress.elapsed, copied_bytes)
+            self._update_journal(journal, phase="complete")
+        elif journal["phase"] == "copying":
+            progress = MigrationProgress(
+                journal["bytes_total"], journal["bytes_done"], status=status
+            )
+            engine.progress = progress.add
+
+            for name, size in journal["items"].items():
+                if journal["completed"].get(name) not in (None, "copied"):
+                    continue
+                self._migrate_item(journal, data_path / name, target_path / name, engine)
+
+                if journal["completed"][name] == "moved":
+                    # Renamed without copying, so nothing was counted yet
+                    progress.add(size)
+                journal["completed"][name] = "done"
+                self._update_journal(journal, bytes_done=progress.done)
+            self._update_journal(journal, phase="complete")
+            logging.info(
+                "Moved data to {}, {} bytes in {:.1f}s using {}".format(
+                    target_path, progress.done, progress.elapsed, engine.stats
+                )
+            )
+            record_operation("migrate", progress.elapsed, progress.done)
+        # Only remove the old data once the journal records a complete copy
         self.state.current_data_path = str(target_path)
 
+        for item in data_path.iterdir():
+            remove_path(item)
+
+    def _migrate_item(self, journal, source, target, engine):
+        """Move one top level item, resuming a partial copy if there is one.
+
+        Once target holds a complete copy the item is journaled as copied
+        before the source is removed, as an interrupted removal leaves a
+        partial source which must not be synced from.
+        """
+        completed = journal["completed"]
+
+        if completed.get(source.name) == "copied" or not os.path.lexists(str(source)):
+            # Copied by an interrupted migration, only the source is left to remove
+            if os.path.lexists(str(source)):
+                remove_path(source)
+            completed[source.name] = "synced"
+
+            return
+
+        if os.path.lexists(str(target)) and source.is_dir() and not source.is_symlink():
+            # Interrupted while copying, so the source is whole and nothing is pruned
+            sync_tree(source, target, engine, prune=False)
+            completed[source.name] = "synced"
+            self._update_journal(journal)
+            remove_path(source)
+
+            return
+
+        if os.path.lexists(str(target)):
+            remove_path(target)
+
+        def journal_copied():
+            completed[source.name] = "copied"
+            self._update_journal(journal)
+
+        copied = engine.move(source, target, copied=journal_copied)
+        completed[source.name] = "copied" if copied else "moved"
+
+    @property
+    def backup_store(self):
+        """The store backups of the data path are kept in."""
+        # Imported here, only the backup actions use the store
+        from lib_backup import BackupStore
+
+        return BackupStore(self.charm_config.get("backup_path") or "/opt/foundry/backups")
+
+    def backup_data(self, rate=0):
+        """Snapshot the data path into the backup store, returning its id and stats."""
+        from lib_backup import load_zstandard
+
+        if not load_zstandard():
+            fetch.apt_install(["python3-zstandard"], fatal=False)
+
+            if not load_zstandard():
+                logging.warning("zstandard is not available, compressing backups with zlib")
+        store = self.backup_store
+        snapshot, stats = store.backup(self.state.current_data_path, rate=rate, follow=TIER_SUBTREES)
+        store.prune(self.charm_config.get("backup_retention") or 0)
+
+        return snapshot, stats
+
+    def restore_data(self, snapshot=None):
+        """Restore the data path from a snapshot, the latest if none is given."""
+        store = self.backup_store
+        snapshots = store.snapshots()
+
+        if not snapshots:
+            raise PathError("There are no backups in {}".format(store.path))
+        from lib_backup import load_zstandard
+
+        load_zstandard()
+
+        return store.restore(
+            snapshot or snapshots[-1], self.state.current_data_path, follow=TIER_SUBTREES
+        )
+
+    def compact_databases(self, status=None):
+        """Compact the NeDB databases in the data path, returning a report.
+
+        The service must be stopped, as Foundry appends to the files while running.
+        """
+        if not self.state.current_data_path:
+            raise PathError("No data path to compact databases in")
+
+        # Imported here, only the compact action and job parse databases
+        from lib_nedb import compact_tree
+
+        return compact_tree(self.state.current_data_path, status=status, follow=TIER_SUBTREES)
+
+    def render_compaction_schedule(self, charm_dir):
+        """Install or remove the timer compacting databases, returning True if changed.
+
+        The timer runs the compact background job in the maintenance window
+        set by compaction_schedule, a systemd OnCalendar expression.
+        """
+        schedule = (self.charm_config.get("compaction_schedule") or "").strip()
+        timer_file = self.systemd_path / self.compaction_timer
+        service_file = timer_file.with_suffix(".service")
+
+        if not schedule:
+            if not timer_file.exists():
+                return False
+            subprocess.call(["systemctl", "disable", "--now", self.compaction_timer])
+
+            for unit_file in (timer_file, service_file):
+                unit_file.unlink()
+            logging.info("Removed database compaction schedule")
+
+            return True
+        context = {
+            "schedule": schedule,
+            "charm_dir": charm_dir,
+            "python": sys.executable,
+        }
+        changed = render_artifact("foundryvtt-compact-job.service", service_file, context)
+
+        return render_artifact("foundryvtt-compact-job.timer", timer_file, context) or changed
+
+    def render_exporter(self, charm_dir, address="127.0.0.1"):
+        """Install or remove the metrics exporter service, returning True if changed.
+
+        The exporter only listens on address, localhost unless Prometheus is related.
+        """
+        port = self.charm_config.get("metrics_port")
+
+        if not port:
+            return self._remove_units(self.exporter_service)
+        context = {
+            "charm_dir": charm_dir,
+            "python": sys.executable,
+            "port": port,
+            "address": address,
+            "service": self.service_name,
+            "foundry_port": self.port,
+            "data_path": self.state.current_data_path,
+        }
+
+        return render_artifact(
+            "foundryvtt-exporter.service", self.systemd_path / self.exporter_service, context
+        )
+
+    @property
+    def image_index(self):
+        """File indexing the images optimised in the data path."""
+        return self.default_data_path.with_name("image-index.json")
+
+    def optimise_images(self, min_size, max_dimension, quality, dry_run=False):
+        """Write WebP variants of oversized images in the data path, returning a report."""
+        # Imported here, only the optimise action handles images
+        from lib_images import ImageOptimiser, pillow_available
+
+        if not pillow_available():
+            fetch.apt_install(["python3-pil"], fatal=True)
+            importlib.invalidate_caches()
+
+        if not pillow_available():
+            raise PathError("Pillow is not available to optimise images")
+
+        if not self.state.current_data_path:
+            raise PathError("No data path to optimise images in")
+        optimiser = ImageOptimiser(
+            self.state.current_data_path,
+            self.image_index,
+            self.charm_config.get("image_workers") or 0,
+            follow=TIER_SUBTREES,
+        )
+
+        return optimiser.run(min_size, max_dimension, quality, dry_run=dry_run)
+
+    @property
+    def tier_journal(self):
+        """File recording subtrees being relocated between storage tiers."""
+        return self.default_data_path.with_name("tiers.json")
+
+    def _read_tier_journal(self):
+        """Return the subtree relocations in progress."""
+        try:
+            with open(str(self.tier_journal), "r") as journal_file:
+                return json.load(journal_file)
+        except (OSError, ValueError):
+            return {}
+
+    def tier_moves(self):
+        """Return the subtrees to relocate as (subtree, source, target) tuples.
+
+        A subtree placed on a tier is a symlink in the data path to a directory
+        of the same name under the tier path. Without a tier path the subtree
+        is a plain directory in the data path. Relocations interrupted earlier
+        are returned as they were started.
+        """
+        data_path = Path(self.state.current_data_path)
+        journal = self._read_tier_journal()
+        moves = []
+
+        for option, subtrees in STORAGE_TIERS.items():
+            tier_path = self.charm_config.get(option)
+
+            for subtree in subtrees:
+                if subtree in journal:
+                    moves.append(
+                        (subtree, Path(journal[subtree]["source"]), Path(journal[subtree]["target"]))
+                    )
+
+                    continue
+                link = data_path / subtree
+                target = Path(tier_path) / link.name if tier_path else link
+
+                if link.is_symlink():
+                    source = Path(os.readlink(str(link)))
+
+                    if source == target:
+                        continue
+                elif target == link:
+                    continue
+                else:
+                    source = link
+                moves.append((subtree, source, target))
+
+        return moves
+
+    def relocate_tiers(self, status=None):
+        """Move each subtree whose tier changed, leaving the other subtrees alone.
+
+        The service must be stopped. Each move is journaled through copying,
+        copied and linked phases, so an interrupted relocation resumes without
+        losing data. Subtrees on the same device are renamed, others copied.
+        """
+        data_path = Path(self.state.current_data_path)
+        journal = self._read_tier_journal()
+
+        for subtree, source, target in self.tier_moves():
+            link = data_path / subtree
+
+            if target != link and subtree not in journal and os.path.lexists(str(target)):
+                raise PathError("{} already exists".format(target))
+
+            if subtree not in journal:
+                self._set_tier_phase(journal, subtree, "copying", source=str(source), target=str(target))
+
+            if journal[subtree]["phase"] == "copying":
+                if status:
+                    status("Relocating {} to {}".format(subtree, target.parent))
+                self._copy_tier(source, target, link)
+                self._set_tier_phase(journal, subtree, "copied")
+
+            if journal[subtree]["phase"] == "copied":
+                self._link_tier(source, target, link)
+                self._set_tier_phase(journal, subtree, "linked")
+
+            if source != link and source.exists():
+                remove_path(source)
+            del journal[subtree]
+            write_json_atomic(self.tier_journal, journal)
+            logging.info("Relocated {} to {}".format(subtree, target))
+
+        if self.tier_journal.exists() and not journal:
+            self.tier_journal.unlink()
+
+    def _set_tier_phase(self, journal, subtree, phase, **move):
+        """Record the phase a subtree relocation reached in the tier journal."""
+        journal.setdefault(subtree, {}).update(move, phase=phase)
+        write_json_atomic(self.tier_journal, journal)
+
+    def _copy_tier(self, source, target, link):
+        """Put the subtree next to its target under a staging name, the copying phase."""
+        staging = target.with_name(".{}.partial".format(target.name))
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        if source.is_dir():
+            if os.path.lexists(str(staging)):
+                remove_path(staging)
+
+            if os.stat(str(source)).st_dev == os.stat(str(target.parent)).st_dev:
+                os.rename(str(source), str(staging))
+            else:
+                self.copy_engine.copy_tree(source, staging)
+        elif staging.exists():
+            # Renamed before the relocation was interrupted
+            pass
+        elif source == link:
+            # Nothing to move yet
+            staging.mkdir()
+        else:
+            raise PathError("{} does not exist".format(source))
+
+    def _link_tier(self, source, target, link):
+        """Move the staged subtree in place and link it into the data path, the copied phase."""
+        staging = target.with_name(".{}.partial".format(target.name))
+
+        if os.path.lexists(str(link)) and (link.is_symlink() or link == source):
+            remove_path(link)
+
+        if staging.exists():
+            os.rename(str(staging), str(target))
+
+        if target != link:
+            link.parent.mkdir(parents=True, exist_ok=True)
+            os.symlink(str(target), str(link))
+
+    @property
+    def replication_stamp(self):
+        """File whose mtime is when the last completed sync from the active unit started."""
+        return self.default_data_path.with_name("replicated")
+
+    def _write_secret(self, path, content):
+        """Write a file only root can read, returning True if it changed."""
+        try:
+            if path.read_text() == content:
+                return False
+        except OSError:
+            pass
+        host.write_file(str(path), content.encode(), perms=0o600)
+
+        return True
+
+    def _remove_units(self, *units):
+        """Disable and remove systemd units, returning True if any were installed."""
+        removed = False
+
+        for unit in units:
+            unit_file = self.systemd_path / unit
+
+            if not unit_file.exists():
+                continue
+            subprocess.call(["systemctl", "disable", "--now", unit])
+            unit_file.unlink()
+            removed = True
+
+        return removed
+
+    def _prepare_replication(self):
+        """Install rsync and create the replication config directory."""
+        if not shutil.which("rsync"):
+            fetch.apt_install(["rsync"], fatal=True)
+        self.replication_path.mkdir(parents=True, exist_ok=True)
+
+    def render_replication_source(self, secret, standbys):
+        """Serve the data path to the standby addresses, returning True if changed."""
+        # Imported here, most deployments run a single unit
+        from lib_replica import REPLICATION_PORT, RSYNC_MODULE, RSYNC_USER
+
+        self._prepare_replication()
+        config_file = self.replication_path / "rsyncd.conf"
+        secrets_file = self.replication_path / "rsyncd.secrets"
+        context = {
+            "port": REPLICATION_PORT,
+            "module": RSYNC_MODULE,
+            "user": RSYNC_USER,
+            "data_path": self.state.current_data_path,
+            "secrets_file": secrets_file,
+            "hosts_allow": " ".join(sorted(standbys)),
+        }
+        changed = self._write_secret(secrets_file, "{}:{}\n".format(RSYNC_USER, secret))
+        changed |= render_artifact("foundryvtt-rsyncd.conf", config_file, context)
+
+        return (
+            render_artifact(
+                "foundryvtt-replica-source.service",
+                self.systemd_path / self.replica_source_service,
+                {"config_file": config_file},
+            )
+            or changed
+        )
+
+    def stop_replication_source(self):
+        """Stop serving the data path to standby units, returning True if it was."""
+        return self._remove_units(self.replica_source_service)
+
+    def _rsync_command(self, address):
+        """Return the rsync command pulling the data path from address."""
+        # Imported here, most deployments run a single unit
+        from lib_replica import rsync_command
+
+        return rsync_command(
+            address,
+            self.replication_path / "rsync.password",
+            self.state.current_data_path,
+            self.charm_config.get("replication_bwlimit") or 0,
+        )
+
+    def render_replication_target(self, address, secret):
+        """Pull the data path from the active unit on a timer, returning True if changed.
+
+        Each sync runs at idle I/O priority and limited to replication_bwlimit,
+        replication_interval seconds after the previous one finished.
+        """
+        self._prepare_replication()
+        timer_file = self.systemd_path / self.replicate_timer
+        context = {
+            "command": " ".join(self._rsync_command(address)),
+            "stamp": self.replication_stamp,
+            "interval": self.charm_config.get("replication_interval") or 60,
+        }
+        changed = self._write_secret(self.replication_path / "rsync.password", secret + "\n")
+        changed |= render_artifact(
+            "foundryvtt-replicate.service", timer_file.with_suffix(".service"), context
+        )
+
+        return render_artifact("foundryvtt-replicate.timer", timer_file, context) or changed
+
+    def stop_replication_target(self):
+        """Stop pulling the data path from the active unit, returning True if it was."""
+        replicate_service = self.replicate_timer.replace(".timer", ".service")
+
+        return self._remove_units(self.replicate_timer, replicate_service)
+
+    def replicate(self, address, timeout):
+        """Sync once from the active unit, returning True if it completed within timeout."""
+        started = time.time()
+        try:
+            subprocess.check_call(self._rsync_command(address), timeout=timeout)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+            logging.warning("Sync from {} failed: {}".format(address, e))
+
+            return False
+        self.replication_stamp.touch()
+        os.utime(str(self.replication_stamp), (started, started))
+
+        return True
+
+    def replication_lag(self):
+        """Seconds the replicated data is behind the active unit, None if never synced."""
+        # Imported here, most deployments run a single unit
+        from lib_replica import replication_lag
+
+        return replication_lag(self.replication_stamp)
+
     @property
     def needs_data_migration(self):
         """Returns true if the datapath config has changed and needs to be migrated."""
@@ -0,0 +1,234 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Batch optimisation of the raster images in the Foundry data directory."""
+
+import hashlib
+import io
+import json
+import logging
+import os
+from pathlib import Path
+import time
+
+from lib_tree import walk_tree
+
+RASTER_SUFFIXES = {".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff"}
+MAX_IMAGE_WORKERS = 8
+# Bump when the optimisation changes, so indexed results are redone
+INDEX_VERSION = 1
+
+
+def pillow_available():
+    """Return true if Pillow can be imported."""
+    try:
+        import PIL.Image  # noqa:F401
+    except ImportError:
+        return False
+
+    return True
+
+
+def _digest(path):
+    """Return the sha256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(str(path), "rb") as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def optimise_image(source, target, max_dimension, quality, dry_run=False):
+    """Transcode source to a WebP at target, resized to fit max_dimension.
+
+    The WebP is only written if it is smaller than the source. Runs in a
+    worker process, so Pillow is imported here. Returns the source size and
+    dimensions and the size of the WebP.
+    """
+    from PIL import Image
+
+    size = os.stat(str(source)).st_size
+    with Image.open(str(source)) as image:
+        dimensions = image.size
+        image.load()
+
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        if max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, "WEBP", quality=quality, method=6)
+    data = output.getvalue()
+    written = len(data) < size and not dry_run
+
+    if written:
+        tmp_path = Path(target).with_name(".{}.tmp".format(Path(target).name))
+        tmp_path.write_bytes(data)
+        os.replace(str(tmp_path), str(target))
+
+    return {
+        "size": size,
+        "width": dimensions[0],
+        "height": dimensions[1],
+        "output_size": len(data),
+        "written": written,
+    }
+
+
+class ImageOptimiser:
+    """Write WebP variants of oversized raster images next to the originals.
+
+    The variant of map.png is written as map.png.webp, so it can't replace
+    an image of the same name uploaded by a user. Originals are never
+    modified. An index of each image's size, mtime and digest is kept, so
+    reruns only transcode images which are new or whose content changed.
+    """
+
+    def __init__(self, data_path, index_path, workers=0, follow=()):
+        """Initialize with the data path, the index file, a worker count and the links to follow."""
+        if workers < 1:
+            workers = min(MAX_IMAGE_WORKERS, os.cpu_count() or 1)
+        self.data_path = Path(data_path)
+        self.index_path = Path(index_path)
+        self.workers = workers
+        self.follow = follow
+
+    def load_index(self):
+        """Return the index of optimised images, or an empty one."""
+        try:
+            with open(str(self.index_path), "r") as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            index = {}
+
+        if index.get("version") != INDEX_VERSION or index.get("data_path") != str(self.data_path):
+            index = {"version": INDEX_VERSION, "data_path": str(self.data_path), "images": {}}
+
+        return index
+
+    def save_index(self, index):
+        """Write the index atomically."""
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(".{}.tmp".format(self.index_path.name))
+        with open(str(tmp_path), "w") as tmp_file:
+            json.dump(index, tmp_file)
+        os.replace(str(tmp_path), str(self.index_path))
+
+    def candidates(self, min_size):
+        """Yield raster images of at least min_size bytes with their stat."""
+        for root, dirs, files in walk_tree(self.data_path, self.follow):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+
+            for name in files:
+                path = Path(root) / name
+
+                if path.suffix.lower() not in RASTER_SUFFIXES or path.is_symlink():
+                    continue
+                path_stat = path.stat()
+
+                if path_stat.st_size >= min_size:
+                    yield path, path_stat
+
+    def _pending(self, index, min_size, settings, report):
+        """Return the images which need transcoding, updating unchanged index entries."""
+        pending = []
+
+        for path, path_stat in self.candidates(min_size):
+            name = str(path.relative_to(self.data_path))
+            entry = index["images"].get(name)
+            report["scanned"] += 1
+            report["bytes_scanned"] += path_stat.st_size
+
+            if entry and entry["settings"] == settings:
+                if (entry["size"], entry["mtime"]) == (path_stat.st_size, path_stat.st_mtime):
+                    report["unchanged"] += 1
+
+                    continue
+                digest = _digest(path)
+
+                if entry["digest"] == digest:
+                    # Touched but not changed
+                    entry["mtime"] = path_stat.st_mtime
+                    report["unchanged"] += 1
+
+                    continue
+            else:
+                digest = None
+            pending.append((name, path, path_stat, digest))
+
+        return pending
+
+    def run(self, min_size, max_dimension, quality, dry_run=False):
+        """Optimise images of at least min_size bytes, returning a report.
+
+        With dry_run images are transcoded in memory to report the savings,
+        but nothing is written and the index isn't updated.
+        """
+        started = time.perf_counter()
+        index = self.load_index()
+        settings = {"max_dimension": max_dimension, "quality": quality}
+        report = {
+            "scanned": 0,
+            "bytes_scanned": 0,
+            "unchanged": 0,
+            "optimised": 0,
+            "skipped": 0,
+            "failed": 0,
+            "bytes_before": 0,
+            "bytes_after": 0,
+        }
+        pending = self._pending(index, min_size, settings, report)
+        jobs = [
+            (path, path.with_name(path.name + ".webp"), max_dimension, quality, dry_run)
+            for _, path, _, _ in pending
+        ]
+
+        if self.workers == 1 or len(jobs) < 2:
+            results = [self._try(optimise_image, *job) for job in jobs]
+        else:
+            # Imported here, multiprocessing is slow to import
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(optimise_image, *job) for job in jobs]
+                results = [self._try(future.result) for future in futures]
+
+        for (name, path, path_stat, digest), result in zip(pending, results):
+            if result is None:
+                report["failed"] += 1
+
+                continue
+
+            if result["output_size"] < result["size"]:
+                report["optimised"] += 1
+                report["bytes_before"] += result["size"]
+                report["bytes_after"] += result["output_size"]
+            else:
+                report["skipped"] += 1
+            index["images"][name] = {
+                "size": path_stat.st_size,
+                "mtime": path_stat.st_mtime,
+                "digest": digest or _digest(path),
+                "settings": settings,
+                "webp": result["written"],
+            }
+        report["bytes_saved"] = report["bytes_before"] - report["bytes_after"]
+        report["seconds"] = time.perf_counter() - started
+
+        if not dry_run:
+            self.save_index(index)
+        logging.info("Image optimisation{}: {}".format(" (dry run)" if dry_run else "", report))
+
+        return report
+
+    def _try(self, function, *args):
+        """Call function, logging and returning None if the image couldn't be processed."""
+        try:
+            return function(*args)
+        except Exception as e:
+            logging.warning("Could not optimise image: {}".format(e))
+
+            return None
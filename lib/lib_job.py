@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Run long charm operations outside of the hook as transient systemd units."""
+
+import json
+import logging
+import os
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+JOB_DIR = Path("/var/lib/foundryvtt-charm/jobs")
+
+
+class BackgroundJob:
+    """A named operation run by a transient systemd unit.
+
+    The charm starts the job with its parameters and returns from the hook.
+    The job reports progress and its result to a status file which later
+    hooks poll until the job is done or failed.
+    """
+
+    def __init__(self, name, job_dir=JOB_DIR):
+        """Initialize the job with a name and the directory for its files."""
+        self.name = name
+        self.job_dir = Path(job_dir)
+        self.unit_name = "foundryvtt-{}-job".format(name)
+
+    @property
+    def status_file(self):
+        """File the job writes its status to."""
+        return self.job_dir / "{}.json".format(self.name)
+
+    @property
+    def params_file(self):
+        """File the charm writes the job parameters to."""
+        return self.job_dir / "{}.params.json".format(self.name)
+
+    def _write(self, path, data):
+        """Atomically write data as JSON."""
+        tmp_path = path.with_name(".{}.tmp".format(path.name))
+        with open(str(tmp_path), "w") as tmp_file:
+            json.dump(data, tmp_file)
+        os.replace(str(tmp_path), str(path))
+
+    def status(self):
+        """Return the job status, or None if the job hasn't been started.
+
+        A job still marked running whose unit has exited is reported failed.
+        """
+        try:
+            with open(str(self.status_file), "r") as status_file:
+                status = json.load(status_file)
+        except (OSError, ValueError):
+            return None
+
+        if status["state"] == "running" and not self.unit_active():
+            status["state"] = "failed"
+            status["message"] = "Background {} job exited unexpectedly".format(self.name)
+
+        return status
+
+    def unit_active(self):
+        """Return true if the transient unit running the job is active."""
+        return (
+            subprocess.call(
+                ["systemctl", "is-active", "--quiet", self.unit_name],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            == 0
+        )
+
+    def start(self, script, params, env=None, working_directory=None):
+        """Start the job by running script in a transient unit."""
+        self.save_params(params)
+        self._write(
+            self.status_file,
+            {"state": "running", "message": "Starting {}".format(self.name), "started": time.time()},
+        )
+        command = ["systemd-run", "--unit", self.unit_name, "--collect"]
+
+        if working_directory:
+            command.append("--property=WorkingDirectory={}".format(working_directory))
+
+        for key, value in (env or {}).items():
+            command.append("--setenv={}={}".format(key, value))
+        command += [sys.executable, str(script), self.name]
+        logging.info("Starting background job: {}".format(command))
+        subprocess.check_call(command)
+
+    def save_params(self, params):
+        """Write the parameters for the next run of the job."""
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        self._write(self.params_file, params)
+
+    def params(self):
+        """Return the parameters the job was started with."""
+        with open(str(self.params_file), "r") as params_file:
+            return json.load(params_file)
+
+    def update(self, **fields):
+        """Update fields of the job status."""
+        try:
+            with open(str(self.status_file), "r") as status_file:
+                status = json.load(status_file)
+        except (OSError, ValueError):
+            status = {}
+        status.update(fields)
+        self._write(self.status_file, status)
+
+    def report(self, message):
+        """Report progress of the running job."""
+        self.update(message=message)
+
+    def clear(self):
+        """Remove the job files once its result has been handled."""
+        for path in (self.status_file, self.params_file):
+            if path.exists():
+                path.unlink()
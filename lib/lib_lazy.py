@@ -0,0 +1,31 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Deferred imports of modules which are slow to import and only needed by some hooks."""
+
+import importlib
+
+
+class LazyModule:
+    """Stand in for a module, importing it on first attribute access.
+
+    charmhelpers imports distutils and setuptools, which takes longer than
+    most hooks need to run, so it is only imported by hooks that use it.
+    """
+
+    def __init__(self, name):
+        """Initialize with the name of the module to import."""
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        """Import the module if needed and return its attribute."""
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        """Show the module stood in for."""
+        return "<lazy module {}{}>".format(self._name, "" if self._module is None else " (imported)")
@@ -0,0 +1,348 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Prometheus metrics of the Foundry process and of the charm's own operations."""
+
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import threading
+import time
+
+from lib_probe import cold_starts, probe
+
+OPERATIONS_FILE = Path("/var/lib/foundryvtt-charm/operations.json")
+# Scrapes within this many seconds of the last collection are served from cache
+CACHE_SECONDS = 5
+# Walking the data path is expensive, so its size is refreshed less often
+TREE_SIZE_SECONDS = 900
+# State of an established connection in /proc/net/tcp
+TCP_ESTABLISHED = "01"
+
+
+def record_operation(name, seconds=0, size=0, path=OPERATIONS_FILE):
+    """Add one run of a charm operation to its counters."""
+    path = Path(path)
+    try:
+        with open(str(path), "r") as operations_file:
+            operations = json.load(operations_file)
+    except (OSError, ValueError):
+        operations = {}
+    counters = operations.setdefault(name, {"count": 0, "seconds": 0, "bytes": 0})
+    counters["count"] += 1
+    counters["seconds"] += seconds
+    counters["bytes"] += size
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(".{}.tmp".format(path.name))
+        with open(str(tmp_path), "w") as tmp_file:
+            json.dump(operations, tmp_file)
+        os.replace(str(tmp_path), str(path))
+    except OSError as e:
+        logging.warning("Could not record operation {}: {}".format(name, e))
+
+
+def service_pid(service):
+    """Return the main PID of a systemd service, or None if it isn't running."""
+    try:
+        output = subprocess.check_output(
+            ["systemctl", "show", "--property=MainPID", "--value", service],
+            stderr=subprocess.DEVNULL,
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    pid = int(output.strip() or 0)
+
+    return pid or None
+
+
+def process_stats(pid, proc="/proc"):
+    """Return memory, CPU, thread and file descriptor use of a process from /proc."""
+    process = Path(proc) / str(pid)
+    stats = {}
+
+    for line in (process / "status").read_text().splitlines():
+        key, _, value = line.partition(":")
+
+        if key == "VmRSS":
+            stats["resident_bytes"] = int(value.split()[0]) * 1024
+        elif key == "Threads":
+            stats["threads"] = int(value)
+    # The command name is in parentheses and may contain spaces
+    fields = (process / "stat").read_text().rpartition(")")[2].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    stats["cpu_seconds"] = (int(fields[11]) + int(fields[12])) / ticks
+    uptime = float((Path(proc) / "uptime").read_text().split()[0])
+    stats["uptime_seconds"] = uptime - int(fields[19]) / ticks
+    stats["open_fds"] = len(os.listdir(str(process / "fd")))
+
+    return stats
+
+
+def established_connections(port, proc="/proc"):
+    """Count established TCP connections to a local port, each client keeps a websocket open."""
+    count = 0
+
+    for table in ("tcp", "tcp6"):
+        try:
+            lines = (Path(proc) / "net" / table).read_text().splitlines()[1:]
+        except OSError:
+            continue
+
+        for line in lines:
+            fields = line.split()
+
+            if fields[3] == TCP_ESTABLISHED and int(fields[1].rsplit(":", 1)[1], 16) == port:
+                count += 1
+
+    return count
+
+
+def format_metrics(metrics):
+    """Return metrics in the Prometheus text format.
+
+    Each metric is a (name, type, help, samples) tuple, with samples a list
+    of (labels, value) pairs.
+    """
+    lines = []
+
+    for name, metric_type, description, samples in metrics:
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+
+        for labels, value in samples:
+            label_text = ",".join(
+                '{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"'))
+                for key, label in sorted(labels.items())
+            )
+            lines.append(
+                "{}{} {}".format(name, "{" + label_text + "}" if label_text else "", float(value))
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+class Collector:
+    """Collect the metrics of a Foundry server, caching them between scrapes.
+
+    The process is found by its systemd service. The pid, probe and tree
+    size functions can be replaced to collect from a stand-in process.
+    """
+
+    def __init__(
+        self,
+        service,
+        port,
+        data_path,
+        operations_file=OPERATIONS_FILE,
+        proc="/proc",
+        pid_function=service_pid,
+        probe_function=probe,
+        tree_size_function=None,
+    ):
+        """Initialize with the service, the port it listens on and its data path."""
+        self.service = service
+        self.port = port
+        self.data_path = data_path
+        self.operations_file = operations_file
+        self.proc = proc
+        self.pid_function = pid_function
+        self.probe_function = probe_function
+        self.tree_size_function = tree_size_function
+        self._lock = threading.Lock()
+        self._cached = None
+        self._cached_at = 0
+        self._tree_size = None
+        self._tree_size_at = 0
+
+    def metrics(self):
+        """Return the metrics text, collecting it if the cache has expired."""
+        with self._lock:
+            now = time.monotonic()
+
+            if self._cached is None or now - self._cached_at >= CACHE_SECONDS:
+                self._cached = format_metrics(self.collect())
+                self._cached_at = now
+
+            return self._cached
+
+    def collect(self):
+        """Collect every metric."""
+        started = time.perf_counter()
+        metrics = self._process_metrics()
+        metrics += self._data_metrics()
+        metrics += self._operation_metrics()
+        metrics.append(
+            (
+                "foundryvtt_exporter_collect_seconds",
+                "gauge",
+                "Time taken to collect these metrics.",
+                [({}, time.perf_counter() - started)],
+            )
+        )
+
+        return metrics
+
+    def _process_metrics(self):
+        """Metrics of the Foundry process and how quickly it answers."""
+        pid = self.pid_function(self.service)
+        stats = {}
+
+        if pid:
+            try:
+                stats = process_stats(pid, self.proc)
+            except (OSError, ValueError, IndexError) as e:
+                logging.debug("Could not read stats of {}: {}".format(pid, e))
+        started = time.perf_counter()
+        up = bool(stats) and self.probe_function("127.0.0.1", self.port)
+        # Foundry answers on its event loop, so slow answers mean a blocked loop
+        probe_seconds = time.perf_counter() - started
+        metrics = [
+            ("foundryvtt_up", "gauge", "Whether Foundry answers HTTP.", [({}, up)]),
+        ]
+
+        if up:
+            metrics.append(
+                (
+                    "foundryvtt_probe_seconds",
+                    "gauge",
+                    "Time Foundry took to answer a request on its port.",
+                    [({}, probe_seconds)],
+                )
+            )
+
+        for key, name, metric_type, description in (
+            ("resident_bytes", "foundryvtt_resident_memory_bytes", "gauge", "Resident memory."),
+            ("cpu_seconds", "foundryvtt_cpu_seconds_total", "counter", "User and system CPU time."),
+            ("threads", "foundryvtt_threads", "gauge", "Threads of the process."),
+            ("open_fds", "foundryvtt_open_fds", "gauge", "Open file descriptors."),
+            ("uptime_seconds", "foundryvtt_uptime_seconds", "gauge", "Seconds since the process started."),
+        ):
+            if key in stats:
+                metrics.append((name, metric_type, description, [({}, stats[key])]))
+
+        if stats:
+            metrics.append(
+                (
+                    "foundryvtt_connections",
+                    "gauge",
+                    "Established connections to the Foundry port, about one websocket per client.",
+                    [({}, established_connections(self.port, self.proc))],
+                )
+            )
+
+        return metrics
+
+    def _data_metrics(self):
+        """Metrics of the data path and the filesystem it is on."""
+        if not self.data_path:
+            return []
+        metrics = []
+        try:
+            usage = shutil.disk_usage(str(self.data_path))
+        except OSError:
+            return metrics
+        metrics.append(
+            (
+                "foundryvtt_data_filesystem_bytes",
+                "gauge",
+                "Size and free space of the filesystem holding the data path.",
+                [({"type": "size"}, usage.total), ({"type": "free"}, usage.free)],
+            )
+        )
+        now = time.monotonic()
+
+        if self.tree_size_function and (
+            self._tree_size is None or now - self._tree_size_at >= TREE_SIZE_SECONDS
+        ):
+            try:
+                self._tree_size = self.tree_size_function(self.data_path)
+                self._tree_size_at = now
+            except OSError as e:
+                logging.debug("Could not size {}: {}".format(self.data_path, e))
+
+        if self._tree_size is not None:
+            metrics.append(
+                (
+                    "foundryvtt_data_bytes",
+                    "gauge",
+                    "Size of the files in the data path, refreshed every {}s.".format(TREE_SIZE_SECONDS),
+                    [({}, self._tree_size)],
+                )
+            )
+
+        return metrics
+
+    def _operation_metrics(self):
+        """Counters of the operations the charm ran, and the last cold start."""
+        try:
+            with open(str(self.operations_file), "r") as operations_file:
+                operations = json.load(operations_file)
+        except (OSError, ValueError):
+            operations = {}
+        metrics = []
+
+        for key, name, description in (
+            ("count", "foundryvtt_charm_operations_total", "Operations run by the charm."),
+            ("seconds", "foundryvtt_charm_operation_seconds_total", "Time spent in charm operations."),
+            ("bytes", "foundryvtt_charm_operation_bytes_total", "Bytes processed by charm operations."),
+        ):
+            samples = [
+                ({"operation": operation}, counters[key])
+                for operation, counters in sorted(operations.items())
+            ]
+
+            if samples:
+                metrics.append((name, "counter", description, samples))
+        starts = cold_starts()
+
+        if starts:
+            metrics.append(
+                (
+                    "foundryvtt_last_cold_start_seconds",
+                    "gauge",
+                    "Time Foundry took to serve after it was last started.",
+                    [({"reason": starts[-1]["reason"]}, starts[-1]["seconds"])],
+                )
+            )
+
+        return metrics
+
+
+def metrics_server(collector, port, address="127.0.0.1"):
+    """Return an HTTP server bound to address which serves the collector's metrics on /metrics."""
+    # Imported here, the charm only uses this module to record operations
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import socket
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # noqa: N802
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+
+                return
+            body = collector.metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class MetricsServer(HTTPServer):
+        address_family = socket.AF_INET6 if ":" in address else socket.AF_INET
+
+    return MetricsServer((address, port), MetricsHandler)
+
+
+def serve(collector, port, address="127.0.0.1"):
+    """Serve the collector's metrics on address and port until interrupted."""
+    server = metrics_server(collector, port, address)
+    logging.info("Serving metrics on {} port {}".format(address, port))
+    server.serve_forever()
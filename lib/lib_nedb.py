@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Offline compaction of the NeDB database files Foundry keeps its worlds in."""
+
+import json
+import logging
+import os
+from pathlib import Path
+import time
+
+from lib_tree import walk_tree
+
+# NeDB refuses to load a file with more corrupt lines than this
+CORRUPT_THRESHOLD = 0.1
+
+
+class NeDBError(Exception):
+    """Raise if a database can't be safely compacted."""
+
+    pass
+
+
+def load(path):
+    """Load a NeDB file the way NeDB does, returning its documents and indexes.
+
+    Each line is a document, a later line with the same _id replaces it and
+    a line with $$deleted removes it. Index definitions are kept separately.
+    """
+    documents = {}
+    indexes = {}
+    lines = 0
+    corrupt = 0
+    with open(str(path), "rb") as db_file:
+        data = db_file.read()
+
+    for line in data.split(b"\n"):
+        if not line.strip():
+            continue
+        lines += 1
+        try:
+            document = json.loads(line.decode("utf-8"))
+        except ValueError:
+            corrupt += 1
+
+            continue
+
+        if "$$indexCreated" in document:
+            index = document["$$indexCreated"]
+            indexes[index["fieldName"]] = index
+        elif "$$indexRemoved" in document:
+            indexes.pop(document["$$indexRemoved"], None)
+        elif document.get("$$deleted"):
+            documents.pop(document["_id"], None)
+        elif "_id" in document:
+            documents[document["_id"]] = document
+        else:
+            corrupt += 1
+
+    if lines and corrupt / lines > CORRUPT_THRESHOLD:
+        raise NeDBError("{} has {} of {} lines corrupt".format(path, corrupt, lines))
+
+    return documents, indexes
+
+
+def _dumps(document):
+    """Serialize a document as a single line, as NeDB does."""
+    return json.dumps(document, ensure_ascii=False, separators=(",", ":"))
+
+
+def serialize(documents, indexes):
+    """Return the compacted file content for documents and indexes."""
+    lines = [_dumps(document) for document in documents.values()]
+    lines += [_dumps({"$$indexCreated": index}) for name, index in indexes.items() if name != "_id"]
+
+    return "".join(line + "\n" for line in lines).encode("utf-8")
+
+
+def compact_file(path):
+    """Compact a NeDB file in place, returning its sizes and load times.
+
+    The compacted file is written beside the original, loaded again and
+    compared with the original before it replaces it.
+    """
+    path = Path(path)
+    size = path.stat().st_size
+    started = time.perf_counter()
+    documents, indexes = load(path)
+    load_seconds = time.perf_counter() - started
+    content = serialize(documents, indexes)
+    tmp_path = path.with_name(".{}.compact".format(path.name))
+    try:
+        with open(str(tmp_path), "wb") as tmp_file:
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(str(tmp_path), path.stat().st_mode & 0o7777)
+        started = time.perf_counter()
+        compacted = load(tmp_path)
+        compacted_seconds = time.perf_counter() - started
+
+        indexes.pop("_id", None)
+
+        if compacted != (documents, indexes):
+            raise NeDBError("Compacted {} does not match the original".format(path))
+        os.replace(str(tmp_path), str(path))
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+    return {
+        "documents": len(documents),
+        "bytes_before": size,
+        "bytes_after": len(content),
+        "load_seconds_before": load_seconds,
+        "load_seconds_after": compacted_seconds,
+    }
+
+
+def compact_tree(path, status=None, follow=()):
+    """Compact every NeDB file under path, returning a report.
+
+    The symlinked directories in follow, relative to path, are compacted
+    too. Files that can't be compacted safely are left as they are and
+    listed in the report. Progress is passed to the status callable.
+    """
+    report = {
+        "files": 0,
+        "documents": 0,
+        "bytes_before": 0,
+        "bytes_after": 0,
+        "load_seconds_before": 0,
+        "load_seconds_after": 0,
+        "failed": [],
+    }
+    databases = sorted(
+        Path(root) / name
+        for root, _, files in walk_tree(path, follow)
+        for name in files
+        if name.endswith(".db")
+    )
+
+    for count, database in enumerate(databases, 1):
+        if database.is_symlink() or not database.is_file():
+            continue
+
+        if status:
+            status("Compacting databases: {} / {}".format(count, len(databases)))
+        try:
+            result = compact_file(database)
+        except (NeDBError, OSError) as e:
+            logging.error("Not compacting {}: {}".format(database, e))
+            report["failed"].append(str(database))
+
+            continue
+        report["files"] += 1
+
+        for key, value in result.items():
+            report[key] += value
+    logging.info("Compacted databases in {}: {}".format(path, report))
+
+    return report
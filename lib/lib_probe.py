@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Readiness probing of the Foundry server and a record of its cold starts."""
+
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import time
+
+COLD_START_LOG = Path("/var/log/foundryvtt-charm/cold-starts.jsonl")
+KEEP_COLD_STARTS = 200
+INITIAL_DELAY = 0.25
+MAX_DELAY = 5
+
+
+def probe(host, port, timeout=2):
+    """Return true if Foundry accepts a connection and answers HTTP without a server error."""
+    # Imported here, most hooks never probe
+    import http.client
+
+    try:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        try:
+            connection.request("GET", "/")
+            status = connection.getresponse().status
+        finally:
+            connection.close()
+    except (OSError, socket.timeout, http.client.HTTPException) as e:
+        logging.debug("Probe of {}:{} failed: {}".format(host, port, e))
+
+        return False
+
+    # Foundry redirects to /join or /setup once it is serving
+    return status < 500
+
+
+def wait_until_ready(host, port, timeout, probe_function=probe):
+    """Probe with exponential backoff until ready or timeout seconds have passed.
+
+    Returns the seconds and attempts it took, or None for the seconds if
+    Foundry didn't become ready in time.
+    """
+    started = time.monotonic()
+    delay = INITIAL_DELAY
+    attempts = 0
+
+    while True:
+        attempts += 1
+
+        if probe_function(host, port):
+            return time.monotonic() - started, attempts
+        remaining = timeout - (time.monotonic() - started)
+
+        if remaining <= 0:
+            logging.warning(
+                "Foundry not ready on port {} after {} attempts in {}s".format(
+                    port, attempts, timeout
+                )
+            )
+
+            return None, attempts
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, MAX_DELAY)
+
+
+def record_cold_start(record, log_path=COLD_START_LOG):
+    """Append a cold start to the log, keeping the most recent."""
+    log_path = Path(log_path)
+    try:
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        lines = log_path.read_text().splitlines(True) if log_path.exists() else []
+        # A last line without a newline was torn by an interrupted write
+        lines = [line for line in lines if line.endswith("\n")]
+        lines = lines[-(KEEP_COLD_STARTS - 1):] + [json.dumps(record) + "\n"]
+        # Written aside and renamed, so readers never see a torn log
+        tmp_path = log_path.with_name(".{}.tmp".format(log_path.name))
+        tmp_path.write_text("".join(lines))
+        os.replace(str(tmp_path), str(log_path))
+    except OSError as e:
+        logging.warning("Could not record cold start: {}".format(e))
+
+
+def cold_starts(log_path=COLD_START_LOG):
+    """Return the recorded cold starts, oldest first, skipping lines that don't parse."""
+    try:
+        lines = Path(log_path).read_text().splitlines()
+    except OSError:
+        return []
+    starts = []
+
+    for line in lines:
+        try:
+            starts.append(json.loads(line))
+        except ValueError:
+            if line.strip():
+                logging.debug("Skipping unreadable cold start: {}".format(line))
+
+    return starts
@@ -0,0 +1,158 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Opt-in timing and profiling of charm hook handlers."""
+
+from contextlib import contextmanager
+import functools
+import json
+import logging
+import os
+from pathlib import Path
+import time
+
+PROFILE_LOG = Path("/var/log/foundryvtt-charm/hook-profiles.jsonl")
+# Number of profiles kept once the log grows past MAX_LOG_BYTES
+KEEP_PROFILES = 500
+MAX_LOG_BYTES = 4 * 1024 * 1024
+TOP_FUNCTIONS = 25
+
+
+def profiled(handler):
+    """Decorate a charm handler so it is timed by the charm's profiler."""
+
+    @functools.wraps(handler)
+    def wrapper(self, event):
+        with self.profiler.hook(handler.__name__):
+            return handler(self, event)
+
+    return wrapper
+
+
+class HookProfiler:
+    """Time hook handlers and the phases within them.
+
+    With mode "timing" each handler run appends one JSON line to the log,
+    holding the total duration and the duration of each phase. Mode
+    "cprofile" also records the functions with the highest cumulative time.
+    Any other mode disables profiling and phases cost nothing.
+    """
+
+    def __init__(self, mode=None, log_path=PROFILE_LOG):
+        """Initialize the profiler for the configured mode."""
+        self.enabled = mode in ("timing", "cprofile")
+        self.cprofile = mode == "cprofile"
+        self.log_path = Path(log_path)
+        self._phases = None
+
+    @contextmanager
+    def hook(self, handler):
+        """Profile a handler, recording it when it finishes or raises."""
+        if not self.enabled or self._phases is not None:
+            yield
+
+            return
+        self._phases = {}
+        profiler = None
+
+        if self.cprofile:
+            import cProfile
+
+            profiler = cProfile.Profile()
+        start = time.time()
+        started = time.perf_counter()
+        error = None
+
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+            record = {
+                "handler": handler,
+                "hook": os.environ.get("JUJU_HOOK_NAME") or os.environ.get("JUJU_DISPATCH_PATH"),
+                "unit": os.environ.get("JUJU_UNIT_NAME"),
+                "charm_version": self._charm_version(),
+                "start": start,
+                "duration": time.perf_counter() - started,
+                "phases": self._phases,
+                "error": error,
+            }
+
+            if profiler:
+                record["profile"] = self._top_functions(profiler)
+            self._phases = None
+            self._append(record)
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of the handler being profiled."""
+        if self._phases is None:
+            yield
+
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._phases[name] = self._phases.get(name, 0) + time.perf_counter() - started
+
+    def _charm_version(self):
+        """Return the charm version, if the charm was built with one."""
+        charm_dir = os.environ.get("JUJU_CHARM_DIR")
+
+        if not charm_dir:
+            return None
+        try:
+            return (Path(charm_dir) / "version").read_text().strip()
+        except OSError:
+            return None
+
+    def _top_functions(self, profiler):
+        """Return the functions with the highest cumulative time."""
+        import pstats
+
+        stats = pstats.Stats(profiler)
+        rows = []
+
+        for (filename, line, function), (_, calls, _, cumulative, _) in stats.stats.items():
+            rows.append(
+                {
+                    "function": "{}:{}({})".format(filename, line, function),
+                    "calls": calls,
+                    "cumulative": cumulative,
+                }
+            )
+        rows.sort(key=lambda row: row["cumulative"], reverse=True)
+
+        return rows[:TOP_FUNCTIONS]
+
+    def _append(self, record):
+        """Append a record to the log, trimming the log when it grows too large."""
+        try:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(self.log_path), "a") as log_file:
+                log_file.write(json.dumps(record) + "\n")
+
+            if self.log_path.stat().st_size > MAX_LOG_BYTES:
+                lines = self.log_path.read_text().splitlines(True)[-KEEP_PROFILES:]
+                self.log_path.write_text("".join(lines))
+        except OSError as e:
+            logging.warning("Could not record hook profile: {}".format(e))
+
+    def last(self, count):
+        """Return the last count profiles recorded, newest last."""
+        if count < 1:
+            return []
+        try:
+            lines = self.log_path.read_text().splitlines()
+        except OSError:
+            return []
+
+        return [json.loads(line) for line in lines[-count:] if line.strip()]
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Replication of the data directory from the active unit to warm standby units."""
+
+import os
+import time
+
+REPLICATION_PORT = 8730
+RSYNC_USER = "foundry"
+RSYNC_MODULE = "foundry-data"
+# Not worth replicating, or written by a migration or tier move in progress
+EXCLUDES = ["/Logs/", ".*.tmp", ".*.partial/"]
+
+
+def rsync_command(address, password_file, target, bwlimit=0):
+    """Return the rsync command pulling the data directory from the active unit.
+
+    Only changed files are transferred, and they are moved into place
+    together at the end, so a failover finds the data of one sync rather
+    than a mix of two. Directory symlinks of storage tiers are followed on
+    the active unit and kept on the standby, so tiers are replicated into
+    the standby's own tiers.
+    """
+    command = [
+        "/usr/bin/rsync",
+        "--archive",
+        "--hard-links",
+        "--delete",
+        "--delete-delay",
+        "--delay-updates",
+        "--copy-dirlinks",
+        "--keep-dirlinks",
+        "--password-file={}".format(password_file),
+    ]
+
+    if bwlimit:
+        command.append("--bwlimit={}".format(bwlimit))
+
+    for pattern in EXCLUDES:
+        command.append("--exclude={}".format(pattern))
+    command += [
+        "rsync://{}@{}:{}/{}/".format(RSYNC_USER, address, REPLICATION_PORT, RSYNC_MODULE),
+        "{}/".format(str(target).rstrip("/")),
+    ]
+
+    return command
+
+
+def elect_active(claims):
+    """Return the unit serving Foundry, given the epoch each active unit claimed.
+
+    A promoted unit claims a higher epoch than any it has seen, so a unit
+    which was active before a failover gives way once it sees the claim.
+    Equal epochs are settled by unit name, so every unit agrees.
+    """
+    if not claims:
+        return None
+
+    return sorted(claims.items(), key=lambda claim: (-claim[1], claim[0]))[0][0]
+
+
+def replication_lag(stamp_path, now=None):
+    """Return the age in seconds of the data of the last completed sync, or None."""
+    try:
+        synced = os.stat(str(stamp_path)).st_mtime
+    except OSError:
+        return None
+
+    return max(0, (now or time.time()) - synced)
@@ -0,0 +1,26 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Walking the data directory through the symlinks storage tiers are placed with."""
+
+import os
+from pathlib import Path
+
+
+def followed_links(path, follow):
+    """Return the relative paths in follow which are symlinks to directories under path."""
+    path = Path(path)
+
+    return [relative for relative in follow if (path / relative).is_symlink() and (path / relative).is_dir()]
+
+
+def walk_tree(path, follow=(), topdown=True):
+    """Walk path like os.walk, also walking the symlinked directories in follow.
+
+    follow holds paths relative to path, such as the storage tier subtrees.
+    Their contents are yielded under the symlink, so paths stay relative to
+    path wherever the data is stored. Other symlinks are not followed.
+    """
+    for top in [path] + [Path(path) / relative for relative in followed_links(path, follow)]:
+        yield from os.walk(str(top), topdown=topdown)
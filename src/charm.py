@@ -5,21 +5,33 @@
 # Distributed under terms of the GPL license.
 """Operator Charm main library."""
 # Load modules from lib directory
+import json
 import logging
+import os
+import secrets
 import socket
 import subprocess
+import time
 from zipfile import BadZipFile
 
 import setuppath  # noqa:F401
-from charmhelpers.core import host
 from interface_reverseproxy.operator_requires import ProxyConfig, ReverseProxyRequires
+from lib_defer import deferrable, DeferralTracker
 from lib_foundry import FoundryHelper, PathError
+from lib_job import BackgroundJob
+from lib_lazy import LazyModule
+from lib_probe import cold_starts
+from lib_profile import HookProfiler, profiled
+from lib_replica import elect_active
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, ModelError
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, ModelError, WaitingStatus
 
 DATA_MOVE_ERROR = "Data move error"
+# State background jobs may change, copied back from their result
+JOB_STATE_FIELDS = ("current_data_path", "apt_source_digest", "pinned_release")
+host = LazyModule("charmhelpers.core.host")
 
 
 class FoundryvttCharm(CharmBase):
@@ -35,21 +47,67 @@ class FoundryvttCharm(CharmBase):
         self.framework.observe(self.on.start, self.on_start)
         self.framework.observe(self.on.config_changed, self.on_config_changed)
         self.framework.observe(self.on.upgrade_charm, self.on_upgrade_charm)
+        self.framework.observe(self.on.update_status, self.on_update_status)
+        self.framework.observe(self.on.leader_elected, self.on_replicas_changed)
+        # -- peer relation --
+        self.framework.observe(self.on.replicas_relation_joined, self.on_replicas_changed)
+        self.framework.observe(self.on.replicas_relation_changed, self.on_replicas_changed)
+        self.framework.observe(self.on.replicas_relation_departed, self.on_replicas_changed)
+        # -- relations --
+        self.framework.observe(
+            self.on.metrics_endpoint_relation_joined, self.on_metrics_endpoint_joined
+        )
+        # -- actions --
+        self.framework.observe(self.on.rollback_action, self.on_rollback_action)
+        self.framework.observe(self.on.hook_profiles_action, self.on_hook_profiles_action)
+        self.framework.observe(self.on.runtime_info_action, self.on_runtime_info_action)
+        self.framework.observe(self.on.release_info_action, self.on_release_info_action)
+        self.framework.observe(self.on.optimise_images_action, self.on_optimise_images_action)
+        self.framework.observe(self.on.backup_action, self.on_backup_action)
+        self.framework.observe(self.on.restore_action, self.on_restore_action)
+        self.framework.observe(
+            self.on.compact_databases_action, self.on_compact_databases_action
+        )
+        self.framework.observe(self.on.failover_action, self.on_failover_action)
         # -- initialize states --
         self.state.set_default(installed=False)
         self.state.set_default(configured=False)
         self.state.set_default(started=False)
         self.state.set_default(enabled=False)
+        self.state.set_default(ready=False)
         self.state.set_default(current_data_path=False)
         self.state.set_default(status_reason=None)
+        self.state.set_default(apt_source_digest=None)
+        self.state.set_default(pinned_release=None)
+        self.state.set_default(role=None)
+        self.state.set_default(epoch=0)
+        self.state.set_default(replication_secret=None)
+        self.state.set_default(deferrals={})
         # -- relations --
         self.proxy = ReverseProxyRequires(self, "reverseproxy")
         self.framework.observe(self.proxy.on.proxy_connected, self.on_proxy_connected)
-        # Setup helper
-        self.helper = FoundryHelper(self.model.config, self.state)
+        # Helper is built by the first handler using it
+        self._helper = None
+        self.profiler = HookProfiler(self.model.config.get("hook_profiling"))
+        self.deferrals = DeferralTracker(
+            self.state.deferrals,
+            backoff=self.model.config.get("defer_backoff") or 0,
+            retry_limit=self.model.config.get("defer_retry_limit") or 0,
+        )
+
+    @property
+    def helper(self):
+        """Helper for the install, built on first use."""
+        if self._helper is None:
+            self._helper = FoundryHelper(self.model.config, self.state)
 
+        return self._helper
+
+    @profiled
     def on_upgrade_charm(self, event):
         """Handle upgrade event."""
+        # A new charm or resource may be what deferred events were waiting for
+        self.deferrals.retry_now()
 
         if self.state.started and not self.state.enabled:
             host.service("enable", self.helper.service_name)
@@ -59,16 +117,50 @@ class FoundryvttCharm(CharmBase):
             self.state.current_data_path = str(self.helper.default_data_path)
 
         if self.state.installed:
-            self.helper.render_systemd_service()
-            subprocess.check_call(["systemctl", "daemon-reload"])
+            release_changed = self.helper.adopt_legacy_install()
+            try:
+                with self.profiler.phase("fetch_resource"):
+                    zip_path = self.model.resources.fetch("foundryvtt")
+                with self.profiler.phase("install_zip"):
+                    release_changed |= self.helper.install_zip(zip_path)
+            except ModelError:
+                logging.warning("No install resource available, keeping current release")
+            except BadZipFile:
+                self.unit.status = BlockedStatus("Bad zip file, upload a new resource")
+                logging.error(
+                    "Could not install resource, keeping release {}".format(
+                        self.helper.current_release
+                    )
+                )
+            with self.profiler.phase("render_systemd_service"):
+                service_changed = self.helper.render_systemd_service()
+
+            if service_changed:
+                with self.profiler.phase("daemon_reload"):
+                    subprocess.check_call(["systemctl", "daemon-reload"])
 
+            if (release_changed or service_changed) and self.state.started:
+                logging.info("Restarting on release {}".format(self.helper.current_release))
+                with self.profiler.phase("service_restart"):
+                    host.service_restart(self.helper.service_name)
+                self._wait_until_ready("upgrade")
+            self._sync_instances(restart=release_changed)
+
+    @profiled
+    @deferrable
     def on_install(self, event):
         """Handle install state."""
+
+        if self.helper.background_jobs:
+            self._background_install(event)
+
+            return
         self.unit.status = MaintenanceStatus("Installing charm software")
         # Perform install tasks
         zip_path = None
         try:
-            zip_path = self.model.resources.fetch("foundryvtt")
+            with self.profiler.phase("fetch_resource"):
+                zip_path = self.model.resources.fetch("foundryvtt")
         except ModelError:
             self.unit.status = BlockedStatus("Upload foundryvtt resource to proceed")
             logging.warning(
@@ -76,29 +168,81 @@ class FoundryvttCharm(CharmBase):
                     event.handle
                 )
             )
-            self._defer_once(event)
+            self.deferrals.defer(event)
 
             return
         # Install the resource
         try:
-            self.helper.install_zip(zip_path)
+            with self.profiler.phase("install_zip"):
+                self.helper.install_zip(zip_path)
         except BadZipFile:
             self.unit.status = BlockedStatus("Bad zip file, upload a new resource")
             logging.error(
                 "Could not install resource, deferring event: {}".format(event.handle)
             )
-            self._defer_once(event)
+            self.deferrals.defer(event)
 
             return
         self.unit.status = MaintenanceStatus("Installing dependencies")
         logging.info("Installing dependencies")
-        self.helper.add_sources()
-        self.helper.install_dependencies()
-        self.helper.render_systemd_service()
+        with self.profiler.phase("add_sources"):
+            self.helper.add_sources()
+        with self.profiler.phase("install_dependencies"):
+            self.helper.install_dependencies()
+        self._finish_install()
+
+    def _background_install(self, event):
+        """Handle install by extracting and installing dependencies in a background job."""
+        job = BackgroundJob("install")
+        status = job.status()
+
+        if status is None:
+            self.unit.status = MaintenanceStatus("Installing charm software")
+            try:
+                zip_path = self.model.resources.fetch("foundryvtt")
+            except ModelError:
+                self.unit.status = BlockedStatus("Upload foundryvtt resource to proceed")
+                logging.warning(
+                    "No install resource available, install blocked, deferring event: {}".format(
+                        event.handle
+                    )
+                )
+                self.deferrals.defer(event)
+
+                return
+            self._start_job(job, zip_path=str(zip_path))
+            status = job.status()
+
+        if status["state"] == "running":
+            self.unit.status = MaintenanceStatus(status["message"])
+            logging.info("Install running in background, deferring event: {}".format(event.handle))
+            self.deferrals.poll(event)
+
+            return
+        job.clear()
+
+        if status["state"] == "failed":
+            self.unit.status = BlockedStatus(status["message"])
+            logging.error(
+                "Background install failed, deferring event: {}".format(event.handle)
+            )
+            # Counted as a retry, so failures back off and stop at the retry limit
+            self.deferrals.defer(event)
+
+            return
+        self._apply_job_result(status["result"])
+        self._finish_install()
+
+    def _finish_install(self):
+        """Complete the install once the software and dependencies are in place."""
+        with self.profiler.phase("render_systemd_service"):
+            self.helper.render_systemd_service()
         self.unit.status = MaintenanceStatus("Install complete")
         logging.info("Install of software complete")
         self.state.installed = True
 
+    @profiled
+    @deferrable
     def on_config_changed(self, event):
         """Handle config changed."""
 
@@ -108,45 +252,184 @@ class FoundryvttCharm(CharmBase):
                     event.handle
                 )
             )
-            self._defer_once(event)
+            self.deferrals.defer(event)
 
             return
 
+        if not self._migrate_data_if_needed(event):
+            return
+        restart = self._apply_runtime_tuning()
+
+        if self.helper.tier_moves():
+            if not self._relocate_tiers():
+                return
+            # Relocating restarted the service, with the new unit file
+            restart = False
+        changed_options = self._sync_options()
+        restart |= bool(changed_options)
+        restart_controls, restart_instances = self._apply_resource_controls()
+        restart |= restart_controls
+
+        if restart and self.state.started:
+            logging.info("Restarting for changed configuration")
+            with self.profiler.phase("service_restart"):
+                host.service_restart(self.helper.service_name)
+            self._wait_until_ready("restart")
+        self._update_compaction_schedule()
+        self._update_exporter()
+        self._configure_metrics_endpoint()
+
+        if self._sync_instances(restart=restart_instances) or "port" in changed_options:
+            self._reconfigure_proxy()
+        self._update_replication()
+
+        # Configure the software
+        logging.info("Configuring complete")
+        self.state.configured = True
+
+    def _migrate_data_if_needed(self, event):
+        """Migrate the data path if it changed, returning False if the hook has to stop."""
+        migration_job = BackgroundJob("migrate")
+
+        if self.helper.background_jobs and (
+            self.helper.needs_data_migration or migration_job.status() is not None
+        ):
+            return self._background_migration(event, migration_job)
+
         if self.helper.needs_data_migration:
-            self.unit.status = MaintenanceStatus("Reloacting data direcotry")
+            return self._migrate_data()
+        self.helper.finish_migration()
+        # No migration necessary, but status might still be blocked from a config-change
+        # of the custom data path.
+        if self.state.status_reason == DATA_MOVE_ERROR:
+            self.unit.status = ActiveStatus("Unit is ready")
+            self.state.status_reason = None
+
+        return True
+
+    def _migrate_data(self):
+        """Migrate the data path within the hook, returning True on success."""
+        self.unit.status = MaintenanceStatus("Reloacting data direcotry")
+        presync = self.state.started and self.helper.live_migration
+        try:
+            if presync:
+                logging.info("Pre-copying data path while running")
+                with self.profiler.phase("presync_data"):
+                    self.helper.presync_data(status=self._maintenance_status)
 
             if self.state.started:
                 # Stop if necessary for reconfig
                 logging.info("Stopping to move data path")
-                host.service_stop(self.helper.service_name)
-            try:
-                self.helper.migrate_data()
-            except (PathError, OSError) as e:
-                if self.state.started:
-                    host.service_start(self.helper.service_name)
-                logging.error("Data move error: {}".format(e))
-                self.unit.status = BlockedStatus("{}".format(e))
-                self.state.status_reason = DATA_MOVE_ERROR
+                with self.profiler.phase("service_stop"):
+                    host.service_stop(self.helper.service_name)
+            with self.profiler.phase("migrate_data"):
+                self.helper.migrate_data(presynced=presync, status=self._maintenance_status)
+        except (PathError, OSError) as e:
+            if self.state.started:
+                host.service_start(self.helper.service_name)
+            logging.error("Data move error: {}".format(e))
+            self.unit.status = BlockedStatus("{}".format(e))
+            self.state.status_reason = DATA_MOVE_ERROR
 
-                return
-            self.helper.render_systemd_service()
-            subprocess.check_call(["systemctl", "daemon-reload"])
+            return False
+        self._apply_runtime_tuning()
 
-            if self.state.started:
-                logging.info("Restarting from data path migration")
+        if self.state.started:
+            logging.info("Restarting from data path migration")
+            with self.profiler.phase("service_start"):
                 host.service_start(self.helper.service_name)
-                self.unit.status = ActiveStatus("Unit is ready")
-        else:
-            # No migration necessary, but status might still be blocked from a config-change
-            # of the custom data path.
-            if self.state.status_reason == DATA_MOVE_ERROR:
-                self.unit.status = ActiveStatus("Unit is ready")
-                self.state.status_reason = None
+            self._wait_until_ready("migration")
 
-        # Configure the software
-        logging.info("Configuring complete")
-        self.state.configured = True
+        return True
+
+    def _apply_runtime_tuning(self):
+        """Render the service unit with the runtime tuning, returning True if a restart is needed."""
+        with self.profiler.phase("render_systemd_service"):
+            service_changed = self.helper.render_systemd_service()
+
+        if service_changed:
+            with self.profiler.phase("daemon_reload"):
+                subprocess.check_call(["systemctl", "daemon-reload"])
+
+        return service_changed
+
+    def _sync_options(self):
+        """Render Foundry's server options, returning the changed keys, which need a restart."""
+        with self.profiler.phase("render_server_options"):
+            return self.helper.render_server_options(self._proxied)
+
+    def _apply_resource_controls(self):
+        """Apply changed resource controls to the main service and the instances.
 
+        Returns whether the main service and whether the instances need a
+        restart for the changes to apply.
+        """
+        with self.profiler.phase("render_resource_controls"):
+            changed_controls = self.helper.render_resource_controls()
+            changed_instances = self.helper.render_instance_resource_controls()
+
+        if not changed_controls and not changed_instances:
+            return False, False
+        logging.info("Resource controls changed: {}".format(changed_controls or changed_instances))
+        with self.profiler.phase("daemon_reload"):
+            subprocess.check_call(["systemctl", "daemon-reload"])
+
+        if not self.state.started:
+            return False, False
+        restart_instances = False
+
+        for name in self.helper.instances():
+            restart_instances |= not self.helper.apply_resource_controls(
+                changed_instances, self.helper.instance_service(name)
+            )
+
+        return not self.helper.apply_resource_controls(changed_controls), restart_instances
+
+    def _update_compaction_schedule(self):
+        """Render the compaction timer and save the config the timer's job runs with."""
+        with self.profiler.phase("render_compaction_schedule"):
+            schedule_changed = self.helper.render_compaction_schedule(self.framework.charm_dir)
+
+        if self.model.config.get("compaction_schedule"):
+            # The timer runs the job with the config and state of the last hook
+            BackgroundJob("compact").save_params(self._job_params())
+
+        if schedule_changed:
+            subprocess.check_call(["systemctl", "daemon-reload"])
+
+            if self.model.config.get("compaction_schedule"):
+                subprocess.check_call(
+                    ["systemctl", "enable", "--now", self.helper.compaction_timer]
+                )
+
+    def _update_exporter(self):
+        """Render the metrics exporter service and restart it if it changed."""
+        with self.profiler.phase("render_exporter"):
+            exporter_changed = self.helper.render_exporter(
+                self.framework.charm_dir, self._exporter_address()
+            )
+
+        if exporter_changed:
+            subprocess.check_call(["systemctl", "daemon-reload"])
+
+            if self.model.config.get("metrics_port"):
+                host.service("enable", self.helper.exporter_service)
+                host.service_restart(self.helper.exporter_service)
+
+    def _exporter_address(self):
+        """Return the address the exporter listens on, only reachable by a related Prometheus."""
+        if self.model.get_relation("metrics-endpoint") is None:
+            return "127.0.0.1"
+
+        return str(self.model.get_binding("metrics-endpoint").network.ingress_address)
+
+    def _reconfigure_proxy(self):
+        """Update the proxy registration of a serving unit after its ports changed."""
+        if self.state.started and self._proxied:
+            self._configure_proxy()
+
+    @profiled
+    @deferrable
     def on_start(self, event):
         """Handle start state."""
 
@@ -156,29 +439,133 @@ class FoundryvttCharm(CharmBase):
                     event.handle
                 )
             )
-            self._defer_once(event)
+            self.deferrals.defer(event)
 
             return
+        role = self._update_replication()
+
+        if role != "active":
+            # A standby only replicates until it is promoted
+            self.unit.status = self._standby_status()
+
+            return
+        self._start_foundry()
+
+    def _start_foundry(self):
+        """Start the service and instances, registering with the proxy once serving."""
         self.unit.status = MaintenanceStatus("Starting charm software")
         # Start software
-        host.service("enable", self.helper.service_name)
-        host.service_start(self.helper.service_name)
-        self.unit.status = ActiveStatus("Unit is ready")
+        with self.profiler.phase("service_enable"):
+            host.service("enable", self.helper.service_name)
+        with self.profiler.phase("service_start"):
+            host.service_start(self.helper.service_name)
+
+        for name in self.helper.instances():
+            with self.profiler.phase("instance_start"):
+                host.service("enable", self.helper.instance_service(name))
+                host.service_start(self.helper.instance_service(name))
         self.state.started = True
         self.state.enabled = True
         logging.info("Started")
 
+        if self._wait_until_ready("start") and self.model.get_relation("reverseproxy"):
+            self._configure_proxy()
+
+    @profiled
+    def on_update_status(self, event):
+        """Handle update status by checking if a slow starting Foundry is now serving."""
+        if self.state.role == "standby":
+            self.unit.status = self._standby_status()
+
+            return
+
+        if not self.state.started or self.state.ready:
+            return
+
+        if self._wait_until_ready("start", timeout=0) and self.model.get_relation("reverseproxy"):
+            self._configure_proxy()
+
+    @profiled
+    @deferrable
     def on_proxy_connected(self, event):
         """Handle proxy connected event."""
 
-        if not self.state.started:
+        if self.state.role == "standby":
+            logging.info("Not registering a standby unit with the proxy")
+
+            return
+
+        if not self.state.ready:
             logging.info(
-                "Proxy connected before start, deferring event: {}".format(event.handle)
+                "Proxy connected before Foundry is serving, deferring event: {}".format(
+                    event.handle
+                )
             )
-            self._defer_once(event)
+            self.deferrals.defer(event)
+
+            return
+        # Foundry builds its links with the proxy's port and scheme
+        if self.helper.render_server_options(proxied=True):
+            logging.info("Restarting for server options behind the proxy")
+            with self.profiler.phase("service_restart"):
+                host.service_restart(self.helper.service_name)
+            self._wait_until_ready("restart")
+        self._configure_proxy()
 
+    @profiled
+    def on_replicas_changed(self, event):
+        """Handle peer units coming, going or changing role."""
+        if not self.state.installed:
             return
+        self._update_replication()
 
+        if self.state.role == "active" and self.state.configured and not self.state.started:
+            # Became leader before anyone served
+            self._start_foundry()
+
+    def on_metrics_endpoint_joined(self, event):
+        """Handle a Prometheus joining by publishing the exporter."""
+        if self.state.installed:
+            # Listen on the address published to Prometheus instead of localhost
+            self._update_exporter()
+        self._configure_metrics_endpoint()
+
+    def _configure_metrics_endpoint(self):
+        """Publish the exporter's address and scrape job to related Prometheus units."""
+        relation = self.model.get_relation("metrics-endpoint")
+        port = self.model.config.get("metrics_port")
+
+        if relation is None or not port:
+            return
+        address = str(self.model.get_binding("metrics-endpoint").network.ingress_address)
+        relation.data[self.unit]["prometheus_scrape_unit_address"] = address
+        relation.data[self.unit]["prometheus_scrape_unit_name"] = self.unit.name
+
+        if self.unit.is_leader():
+            relation.data[self.app]["scrape_jobs"] = json.dumps(
+                [
+                    {
+                        "metrics_path": "/metrics",
+                        "static_configs": [{"targets": ["*:{}".format(port)]}],
+                    }
+                ]
+            )
+            relation.data[self.app]["scrape_metadata"] = json.dumps(
+                {
+                    "model": self.model.name,
+                    "model_uuid": os.environ.get("JUJU_MODEL_UUID"),
+                    "application": self.app.name,
+                    "unit": self.unit.name,
+                }
+            )
+
+    @property
+    def _proxied(self):
+        """Returns true if the reverse proxy relation exists."""
+        return self.model.get_relation("reverseproxy") is not None
+
+    def _configure_proxy(self):
+        """Register the service and each instance with the reverse proxy."""
         host = None
 
         if self.model.config["proxy_via_fqdn"]:
@@ -191,31 +578,551 @@ class FoundryvttCharm(CharmBase):
             "subdomain": self.model.config["proxy_subdomain"],
             "external_port": self.model.config["proxy_port"],
             "internal_host": host,
-            "internal_port": 30000,
+            "internal_port": self.helper.port,
         }
         logging.info("Proxy is connected, configuring: {}".format(config))
         proxy_config = ProxyConfig(config)
-        self.proxy.set_proxy_config(proxy_config)
+        instances = self.helper.instances()
+
+        if instances:
+            # Each instance is served under its own subdomain of the main server
+            proxy_config = [proxy_config]
+
+            for name, port in instances.items():
+                instance_config = dict(
+                    config,
+                    subdomain="{}.{}".format(name, config["subdomain"]),
+                    internal_port=port,
+                )
+                logging.info("Configuring proxy for instance {}: {}".format(name, instance_config))
+                proxy_config.append(ProxyConfig(instance_config))
+        with self.profiler.phase("set_proxy_config"):
+            self.proxy.set_proxy_config(proxy_config)
+
+    def on_rollback_action(self, event):
+        """Handle the rollback action."""
+        try:
+            release = self.helper.rollback_release()
+        except PathError as e:
+            event.fail("{}".format(e))
+
+            return
 
-    def _defer_once(self, event):
-        """Defer the given event, but only once."""
-        notice_count = 0
-        handle = str(event.handle)
+        if self.state.started:
+            logging.info("Restarting on rolled back release {}".format(release))
+            host.service_restart(self.helper.service_name)
+            self._wait_until_ready("rollback")
+        event.set_results({"release": release})
 
-        for event_path, _, _ in self.framework._storage.notices(None):
-            if event_path.startswith(handle.split("[")[0]):
-                notice_count += 1
-                logging.debug("Found event: {} x {}".format(event_path, notice_count))
+    def on_hook_profiles_action(self, event):
+        """Handle the hook-profiles action."""
+        profiles = self.profiler.last(event.params.get("count", 10))
+        event.set_results({"count": len(profiles), "profiles": json.dumps(profiles)})
 
-        if notice_count > 1:
-            logging.debug(
-                "Not deferring {} notice count of {}".format(handle, notice_count)
+    def on_runtime_info_action(self, event):
+        """Handle the runtime-info action."""
+        tuning = self.helper.runtime_tuning()
+        results = {
+            "host-cores": os.cpu_count(),
+            "host-memory-mb": self.helper.host_memory_mb(),
+            "heap-size-mb": tuning["heap_size_mb"] or "default",
+            "uv-threadpool-size": tuning["uv_threadpool_size"] or "default",
+            "node-options": tuning["node_options"],
+            "resource-controls": " ".join(
+                "{}={}".format(directive, value)
+                for directive, value in self.helper.applied_resource_controls().items()
+            ),
+        }
+        try:
+            service_lines = self.helper.service_file.read_text().splitlines()
+        except OSError:
+            service_lines = []
+        applied = [
+            line for line in service_lines if line.startswith(("Environment=", "ExecStart="))
+        ]
+        results["applied"] = "\n".join(applied)
+        event.set_results(results)
+
+    def on_release_info_action(self, event):
+        """Handle the release-info action."""
+        release = self.helper.current_release
+
+        if not release:
+            event.fail("No release installed")
+
+            return
+        manifest = self.helper.read_manifest(release)
+        results = {
+            "release": release,
+            "releases": " ".join(self.helper.releases()),
+            "members": len(manifest["members"]),
+        }
+        precompressed = manifest.get("precompressed")
+
+        if precompressed:
+            results["precompressed-files"] = precompressed["files"]
+            results["precompressed-bytes"] = precompressed["bytes"]
+            results["precompress-seconds"] = round(precompressed["seconds"], 1)
+
+            for encoding, size in precompressed["compressed"].items():
+                ratio = size / precompressed["bytes"] if precompressed["bytes"] else 1
+                results["ratio-{}".format(encoding)] = round(ratio, 3)
+        starts = [start for start in cold_starts() if start["release"] == release]
+
+        if starts:
+            results["cold-starts"] = len(starts)
+            results["cold-start-seconds"] = round(starts[-1]["seconds"], 2)
+            results["cold-start-data-bytes"] = starts[-1]["data_bytes"]
+        event.set_results(results)
+
+    def on_optimise_images_action(self, event):
+        """Handle the optimise-images action."""
+        try:
+            report = self.helper.optimise_images(
+                event.params["min-size-kb"] * 1024,
+                event.params["max-dimension"],
+                event.params["quality"],
+                dry_run=event.params["dry-run"],
+            )
+        except PathError as e:
+            event.fail("{}".format(e))
+
+            return
+        event.set_results(
+            {
+                "dry-run": event.params["dry-run"],
+                "scanned": report["scanned"],
+                "unchanged": report["unchanged"],
+                "optimised": report["optimised"],
+                "skipped": report["skipped"],
+                "failed": report["failed"],
+                "bytes-before": report["bytes_before"],
+                "bytes-after": report["bytes_after"],
+                "bytes-saved": report["bytes_saved"],
+                "seconds": round(report["seconds"], 1),
+            }
+        )
+
+    def on_backup_action(self, event):
+        """Handle the backup action."""
+        # Imported here, only the backup actions need lib_backup and its compressor
+        from lib_backup import BackupError, lower_priority
+
+        stop = event.params["stop-service"] and self.state.started
+        # Keep the backup from competing with connected players for I/O
+        lower_priority()
+        try:
+            if stop:
+                host.service_stop(self.helper.service_name)
+            snapshot, stats = self.helper.backup_data(rate=event.params["bwlimit"] * 1024 * 1024)
+        except (BackupError, OSError) as e:
+            event.fail("Backup failed: {}".format(e))
+
+            return
+        finally:
+            if stop:
+                host.service_start(self.helper.service_name)
+        event.set_results(
+            {
+                "snapshot": snapshot,
+                "snapshots": " ".join(self.helper.backup_store.snapshots()),
+                "files": stats["files"],
+                "files-unchanged": stats["files_unchanged"],
+                "bytes": stats["bytes"],
+                "bytes-read": stats["bytes_read"],
+                "bytes-stored": stats["bytes_stored"],
+                "chunks-reused": stats["chunks_reused"],
+                "seconds": round(stats["seconds"], 1),
+            }
+        )
+
+    def on_restore_action(self, event):
+        """Handle the restore action."""
+        # Imported here, only the backup actions need lib_backup and its compressor
+        from lib_backup import BackupError
+
+        if self.state.started:
+            host.service_stop(self.helper.service_name)
+        try:
+            stats = self.helper.restore_data(event.params.get("snapshot") or None)
+        except (BackupError, PathError, OSError) as e:
+            event.fail("Restore failed: {}".format(e))
+
+            return
+        finally:
+            if self.state.started:
+                host.service_start(self.helper.service_name)
+                self._wait_until_ready("restore")
+        event.set_results(
+            {
+                "files": stats["files"],
+                "files-written": stats["files_written"],
+                "bytes-written": stats["bytes_written"],
+                "removed": stats["removed"],
+            }
+        )
+
+    def on_compact_databases_action(self, event):
+        """Handle the compact-databases action."""
+        if self.state.started:
+            self.unit.status = MaintenanceStatus("Compacting databases")
+            host.service_stop(self.helper.service_name)
+        try:
+            report = self.helper.compact_databases(status=self._maintenance_status)
+        except PathError as e:
+            event.fail("{}".format(e))
+
+            return
+        finally:
+            if self.state.started:
+                host.service_start(self.helper.service_name)
+                self._wait_until_ready("compact")
+        event.set_results(
+            {
+                "files": report["files"],
+                "documents": report["documents"],
+                "bytes-before": report["bytes_before"],
+                "bytes-after": report["bytes_after"],
+                "load-seconds-before": round(report["load_seconds_before"], 2),
+                "load-seconds-after": round(report["load_seconds_after"], 2),
+                "failed": " ".join(report["failed"]),
+            }
+        )
+
+    def on_failover_action(self, event):
+        """Handle the failover action, promoting this standby to serve Foundry."""
+        relation = self.model.get_relation("replicas")
+
+        if self.state.role == "active":
+            event.fail("This unit is already active")
+
+            return
+
+        if relation is None or not self.state.configured:
+            event.fail("This unit is not a configured standby")
+
+            return
+        started = time.monotonic()
+        lag = self.helper.replication_lag()
+
+        if self.helper.stop_replication_target():
+            subprocess.check_call(["systemctl", "daemon-reload"])
+        claims, peers = self._peer_roles(relation)
+        active = elect_active(claims)
+        synced = False
+
+        if event.params.get("final-sync") and peers.get(active, {}).get("address"):
+            # Catch up if the active unit is still reachable, otherwise serve what was replicated
+            self.unit.status = MaintenanceStatus("Final sync from {}".format(active))
+            synced = self.helper.replicate(
+                peers[active]["address"], event.params.get("sync-timeout")
             )
+
+            if synced:
+                lag = 0
+        logging.info("Promoting to active, replication lag {}".format(lag))
+        self.state.role = "active"
+        self.state.epoch = max([self.state.epoch] + list(claims.values())) + 1
+        self._update_replication()
+        self._start_foundry()
+        event.set_results(
+            {
+                "replication-lag": "unknown" if lag is None else round(lag, 1),
+                "final-sync": synced,
+                "ready": self.state.ready,
+                "seconds": round(time.monotonic() - started, 1),
+            }
+        )
+
+    def _background_migration(self, event, job):
+        """Migrate the data path in a background job.
+
+        Returns True once the migration has completed.
+        """
+        status = job.status()
+
+        if status is None:
+            self.unit.status = MaintenanceStatus("Reloacting data direcotry")
+            self._start_job(job)
+            status = job.status()
+
+        if status["state"] == "running":
+            self.unit.status = MaintenanceStatus(status["message"])
+            logging.info(
+                "Data migration running in background, deferring event: {}".format(event.handle)
+            )
+            self.deferrals.poll(event)
+
+            return False
+        job.clear()
+
+        if status["state"] == "failed":
+            logging.error("Data move error: {}".format(status["message"]))
+            self.unit.status = BlockedStatus(status["message"])
+            self.state.status_reason = DATA_MOVE_ERROR
+
+            return False
+        self._apply_job_result(status["result"])
+        self.state.status_reason = None
+
+        if self.state.started:
+            self._wait_until_ready("migration")
+
+        return True
+
+    def _job_params(self, **params):
+        """Return job parameters with the charm config and state jobs need."""
+        params["config"] = dict(self.model.config)
+        params["state"] = {field: getattr(self.state, field) for field in JOB_STATE_FIELDS}
+        params["state"]["started"] = self.state.started
+
+        return params
+
+    def _apply_job_result(self, result):
+        """Copy the state a background job changed back into the charm state."""
+        for field in JOB_STATE_FIELDS:
+            # Results of jobs started by an older charm revision lack newer fields
+            if field in result:
+                setattr(self.state, field, result[field])
+
+    def _start_job(self, job, **params):
+        """Start a background job with the charm config and state it needs."""
+        charm_dir = self.framework.charm_dir
+        job.start(
+            charm_dir / "src" / "foundry_job.py",
+            self._job_params(**params),
+            env={"JUJU_CHARM_DIR": str(charm_dir)},
+            working_directory=charm_dir,
+        )
+
+    def _sync_instances(self, restart=False):
+        """Add and remove instances to match config without restarting the others.
+
+        Instances are also restarted when their service template changed, or
+        with restart. Returns True if instances were added or removed.
+        """
+        with self.profiler.phase("render_instance_service"):
+            template_changed = self.helper.render_instance_service()
+        added, removed = self.helper.sync_instances()
+
+        for name in removed:
+            with self.profiler.phase("instance_stop"):
+                host.service("disable", self.helper.instance_service(name))
+                host.service_stop(self.helper.instance_service(name))
+
+        if template_changed:
+            with self.profiler.phase("daemon_reload"):
+                subprocess.check_call(["systemctl", "daemon-reload"])
+
+        if self.state.started:
+            for name in self.helper.instances():
+                if name in added:
+                    logging.info("Starting instance {}".format(name))
+                    with self.profiler.phase("instance_start"):
+                        host.service("enable", self.helper.instance_service(name))
+                        host.service_start(self.helper.instance_service(name))
+                elif template_changed or restart:
+                    logging.info("Restarting instance {}".format(name))
+                    with self.profiler.phase("instance_restart"):
+                        host.service_restart(self.helper.instance_service(name))
+
+        return bool(added or removed)
+
+    def _relocate_tiers(self):
+        """Move subtrees whose storage tier changed, returning True on success."""
+        self.unit.status = MaintenanceStatus("Relocating storage tiers")
+
+        if self.state.started:
+            logging.info("Stopping to relocate storage tiers")
+            with self.profiler.phase("service_stop"):
+                host.service_stop(self.helper.service_name)
+        try:
+            with self.profiler.phase("relocate_tiers"):
+                self.helper.relocate_tiers(status=self._maintenance_status)
+        except (PathError, OSError) as e:
+            logging.error("Data move error: {}".format(e))
+            self.unit.status = BlockedStatus("{}".format(e))
+            self.state.status_reason = DATA_MOVE_ERROR
+
+            return False
+        finally:
+            if self.state.started:
+                with self.profiler.phase("service_start"):
+                    host.service_start(self.helper.service_name)
+
+        if self.state.status_reason == DATA_MOVE_ERROR:
+            self.state.status_reason = None
+
+        if self.state.started:
+            self._wait_until_ready("relocation")
         else:
-            logging.debug(
-                "Deferring {} notice count of {}".format(handle, notice_count)
+            self.unit.status = MaintenanceStatus("Storage tiers relocated")
+
+        return True
+
+    def _wait_until_ready(self, reason, timeout=None):
+        """Wait for Foundry to serve after it was (re)started for reason.
+
+        The unit is only reported active once Foundry answers HTTP, and the
+        time it took is recorded as a cold start. Returns True if it is ready.
+        """
+        if timeout is None:
+            timeout = self.model.config.get("ready_timeout") or 0
+            self.unit.status = MaintenanceStatus("Waiting for Foundry to serve")
+        with self.profiler.phase("wait_until_ready"):
+            seconds, attempts = self.helper.wait_until_ready(timeout)
+        self.state.ready = seconds is not None
+
+        if not self.state.ready:
+            self.unit.status = WaitingStatus(
+                "Foundry is not serving on port {}".format(self.helper.port)
             )
-            event.defer()
+
+            return False
+
+        if timeout:
+            self.helper.record_cold_start(reason, seconds, attempts)
+        self.unit.status = ActiveStatus("Unit is ready")
+
+        return True
+
+    def _peer_roles(self, relation):
+        """Return the epoch claimed by each active peer and the relation data of each peer."""
+        claims = {}
+        peers = {}
+
+        for unit in relation.units:
+            peers[unit.name] = relation.data[unit]
+
+            if peers[unit.name].get("role") == "active":
+                claims[unit.name] = int(peers[unit.name].get("epoch") or 0)
+
+        return claims, peers
+
+    def _update_replication(self):
+        """Settle this unit's role and replicate the data path from the active unit.
+
+        The leader serves unless another unit already does, and the other
+        units are its standbys. A unit which sees another claim a higher epoch
+        was failed over from and becomes a standby. Returns the role.
+        """
+        relation = self.model.get_relation("replicas")
+        claims, peers = self._peer_roles(relation) if relation is not None else ({}, {})
+
+        if self.state.role is None:
+            self._elect_initial_role(relation, claims)
+
+        if relation is None or self.state.role is None:
+            return self.state.role
+
+        if self.state.role == "active":
+            claims[self.unit.name] = self.state.epoch
+        active = elect_active(claims)
+
+        if self.state.role == "active" and active != self.unit.name:
+            self._demote(active)
+        data = relation.data[self.unit]
+        data["role"] = self.state.role
+        data["epoch"] = str(self.state.epoch)
+        data["address"] = str(self.model.get_binding("replicas").network.ingress_address)
+
+        if self.state.role == "active":
+            if not self.state.replication_secret:
+                self.state.replication_secret = secrets.token_hex(16)
+            data["secret"] = self.state.replication_secret
+            self._serve_replicas(
+                [peer["address"] for peer in peers.values() if peer.get("address")]
+            )
+        else:
+            data["secret"] = ""
+            self._replicate_from(peers.get(active, {}))
+
+        return self.state.role
+
+    def _elect_initial_role(self, relation, claims):
+        """Settle the role of a unit which has none yet, unless it waits for the leader."""
+        if self.state.started or relation is None:
+            # Serving from before the peer relation
+            role = "active"
+        elif claims:
+            role = "standby"
+        elif self.unit.is_leader():
+            role = "active"
+        else:
+            return
+        self.state.role = role
+
+        if role == "active":
+            self.state.epoch = 1
+
+    def _serve_replicas(self, standbys):
+        """Serve the data path to the standby addresses, or stop if there are none."""
+        if standbys:
+            changed = self.helper.render_replication_source(self.state.replication_secret, standbys)
+        else:
+            changed = self.helper.stop_replication_source()
+
+        if not changed:
+            return
+        subprocess.check_call(["systemctl", "daemon-reload"])
+
+        if standbys:
+            host.service("enable", self.helper.replica_source_service)
+            host.service_restart(self.helper.replica_source_service)
+
+    def _replicate_from(self, source):
+        """Replicate from the active unit's relation data, once it has published it."""
+        replicating = bool(source.get("address") and source.get("secret"))
+
+        if replicating:
+            changed = self.helper.render_replication_target(source["address"], source["secret"])
+        else:
+            changed = self.helper.stop_replication_target()
+
+        if not changed:
+            return
+        subprocess.check_call(["systemctl", "daemon-reload"])
+
+        if replicating:
+            host.service("enable", self.helper.replicate_timer)
+            host.service_restart(self.helper.replicate_timer)
+
+    def _demote(self, active):
+        """Stop serving Foundry and become a standby of the unit failed over to."""
+        logging.info("Failed over to {}, becoming a standby".format(active))
+
+        if self.state.started:
+            for name in self.helper.instances():
+                host.service_stop(self.helper.instance_service(name))
+                host.service("disable", self.helper.instance_service(name))
+            host.service_stop(self.helper.service_name)
+            host.service("disable", self.helper.service_name)
+
+        if self._proxied:
+            # Only the active unit is a backend of the proxy
+            self.proxy.set_proxy_config([])
+        self.state.started = False
+        self.state.enabled = False
+        self.state.ready = False
+        self.state.role = "standby"
+
+        if self.helper.stop_replication_source():
+            subprocess.check_call(["systemctl", "daemon-reload"])
+
+    def _standby_status(self):
+        """Return the status of a standby, with how far its data is behind."""
+        if self.state.role is None:
+            return WaitingStatus("Waiting for the leader to serve")
+        lag = self.helper.replication_lag()
+
+        if lag is None:
+            return WaitingStatus("Standby, waiting for the first sync")
+
+        return ActiveStatus("Standby, replicated {}s ago".format(int(lag)))
+
+    def _maintenance_status(self, message):
+        """Set a maintenance status, used to report progress of long operations."""
+        self.unit.status = MaintenanceStatus(message)
 
 
 if __name__ == "__main__":
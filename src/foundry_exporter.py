@@ -0,0 +1,39 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Serve Prometheus metrics of the Foundry server and the charm's operations."""
+# Load modules from lib directory
+import argparse
+import functools
+import logging
+import sys
+
+import setuppath  # noqa:F401
+from lib_foundry import TIER_SUBTREES, tree_size
+from lib_metrics import Collector, serve
+
+
+def main(args=None):
+    """Parse arguments and serve metrics until stopped."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, required=True, help="Port to serve metrics on")
+    parser.add_argument("--address", default="127.0.0.1", help="Address to serve metrics on")
+    parser.add_argument("--service", required=True, help="Systemd service running Foundry")
+    parser.add_argument("--foundry-port", type=int, required=True, help="Port Foundry listens on")
+    parser.add_argument("--data-path", help="Foundry data path")
+    args = parser.parse_args(args)
+    collector = Collector(
+        args.service,
+        args.foundry_port,
+        args.data_path,
+        tree_size_function=functools.partial(tree_size, follow=TIER_SUBTREES),
+    )
+    serve(collector, args.port, args.address)
+
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Run a charm operation started as a background job by the charm."""
+# Load modules from lib directory
+import logging
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+from zipfile import BadZipFile
+
+import setuppath  # noqa:F401
+from charmhelpers.core import host
+from lib_foundry import FoundryHelper, PathError
+from lib_job import BackgroundJob
+
+
+def run_install(helper, params, job):
+    """Extract the resource and install dependencies."""
+    job.update(message="Installing charm software")
+    helper.install_zip(params["zip_path"])
+    job.update(message="Installing dependencies")
+    helper.add_sources()
+    helper.install_dependencies()
+
+
+def run_migrate(helper, params, job):
+    """Migrate the data path, stopping the service only while required."""
+    started = params["state"]["started"]
+    presync = started and helper.live_migration
+    try:
+        if presync:
+            helper.presync_data(status=job.report)
+
+        if started:
+            host.service_stop(helper.service_name)
+        helper.migrate_data(presynced=presync, status=job.report)
+        helper.render_systemd_service()
+        subprocess.check_call(["systemctl", "daemon-reload"])
+    finally:
+        if started:
+            host.service_start(helper.service_name)
+
+
+def run_compact(helper, params, job):
+    """Compact the databases, stopping the service while they are compacted."""
+    running = host.service_running(helper.service_name)
+    job.update(state="running", message="Compacting databases", started=time.time())
+    try:
+        if running:
+            host.service_stop(helper.service_name)
+        report = helper.compact_databases(status=job.report)
+    finally:
+        if running:
+            host.service_start(helper.service_name)
+    job.update(report=report)
+
+
+OPERATIONS = {
+    "install": run_install,
+    "migrate": run_migrate,
+    "compact": run_compact,
+}
+
+
+def main(name):
+    """Run the named job and record its result."""
+    job = BackgroundJob(name)
+    params = job.params()
+    state = SimpleNamespace(**params["state"])
+    helper = FoundryHelper(params["config"], state)
+    try:
+        OPERATIONS[name](helper, params, job)
+    except BadZipFile:
+        logging.exception("Background {} job failed".format(name))
+        job.update(state="failed", error="BadZipFile", message="Bad zip file, upload a new resource")
+
+        return 1
+    except (PathError, OSError, subprocess.CalledProcessError) as e:
+        logging.exception("Background {} job failed".format(name))
+        job.update(state="failed", error=type(e).__name__, message="{}".format(e))
+
+        return 1
+    job.update(state="done", message="Completed {}".format(name), result=vars(state))
+
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1]))
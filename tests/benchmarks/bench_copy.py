@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Benchmark each CopyEngine strategy, optionally on loopback filesystems.
+
+Run as root with --fstype (e.g. btrfs or xfs) to create and mount two
+loopback filesystems, so both same-filesystem and cross-filesystem copies
+are measured. Without it the copies run inside a temporary directory.
+"""
+
+import argparse
+from contextlib import ExitStack
+import os
+from pathlib import Path
+import subprocess
+import tempfile
+import time
+
+import setuppath  # noqa:F401
+from lib_copy import CopyEngine, STRATEGIES
+
+
+def loopback(stack, root, name, fstype, size_mb):
+    """Create and mount a loopback filesystem, unmounted when stack closes."""
+    image = root / "{}.img".format(name)
+    mount = root / name
+    mount.mkdir()
+    with open(str(image), "wb") as image_file:
+        image_file.truncate(size_mb * 1024 * 1024)
+    subprocess.check_call(["mkfs.{}".format(fstype), "-q", str(image)])
+    subprocess.check_call(["mount", "-o", "loop", str(image), str(mount)])
+    stack.callback(subprocess.call, ["umount", str(mount)])
+
+    return mount
+
+
+def build_tree(root, files, size):
+    """Create a tree of files to copy."""
+    root.mkdir()
+    for index in range(files):
+        (root / "{:05}.webp".format(index)).write_bytes(os.urandom(size))
+
+
+def time_strategy(source, target, strategy, workers):
+    """Copy source to target with one strategy, returning seconds and the strategies used."""
+    engine = CopyEngine(workers=workers, strategies=[strategy, "buffered"])
+    start = time.perf_counter()
+    engine.copy_tree(source, target)
+    os.sync()
+    elapsed = time.perf_counter() - start
+    used = {name: count for name, count in engine.stats.items() if count}
+
+    return elapsed, used
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=1024 * 1024)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--fstype", help="Filesystem for loopback mounts, requires root")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir, ExitStack() as stack:
+        root = Path(tmpdir)
+
+        if args.fstype:
+            size_mb = args.files * args.size * 4 // (1024 * 1024) + 512
+            source_fs = loopback(stack, root, "a", args.fstype, size_mb)
+            targets = {
+                "same-fs": source_fs,
+                "cross-fs": loopback(stack, root, "b", args.fstype, size_mb),
+            }
+        else:
+            source_fs = root
+            targets = {"tmpdir": root}
+        source = source_fs / "source"
+        build_tree(source, args.files, args.size)
+        total_mb = args.files * args.size / (1024 * 1024)
+        print("{} files, {:.0f} MB".format(args.files, total_mb))
+
+        for label, target_fs in targets.items():
+            for strategy in STRATEGIES:
+                target = target_fs / "{}-{}".format(label, strategy)
+                elapsed, used = time_strategy(source, target, strategy, args.workers)
+                print(
+                    "{:<9} {:<16} {:8.3f}s {:9.1f} MB/s  {}".format(
+                        label, strategy, elapsed, total_mb / elapsed, used
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Benchmark the import and dispatch time of each hook.
+
+Every hook execs src/charm.py in a new process, so each measurement runs
+in a fresh interpreter using the unit test operator fixtures. It reports
+the time to import the charm, build it and dispatch the hook, and which of
+the slow imports each hook pulled in. Exits non-zero if a hook which
+shouldn't need them imported charmhelpers or the backup modules.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+# Hooks measured, run on an uninstalled unit so nothing touches the host
+HOOKS = [
+    "update_status",
+    "leader_elected",
+    "replicas_relation_changed",
+    "config_changed",
+    "start",
+    "upgrade_charm",
+]
+# Hooks which must dispatch without importing charmhelpers or the backup modules
+LIGHT_HOOKS = {"update_status", "leader_elected", "replicas_relation_changed"}
+SLOW_IMPORTS = [
+    "charmhelpers.core.host",
+    "charmhelpers.core.templating",
+    "charmhelpers.fetch",
+    "jinja2",
+    "lib_backup",
+    "lib_foundry",
+    "zstandard",
+]
+# Slow imports a light hook must not pull in
+HEAVY_IMPORTS = ("charmhelpers", "lib_backup", "zstandard")
+
+
+def measure(hook):
+    """Import the charm, build it and dispatch one hook, printing the times as JSON."""
+    started = time.perf_counter()
+    sys.path[:0] = [ROOT, os.path.join(ROOT, "lib"), os.path.join(ROOT, "tests", "unit")]
+    import operator_fixtures
+
+    imported = time.perf_counter()
+    operator_fixtures.OperatorTestCase.setUpClass()
+    case = operator_fixtures.OperatorTestCase()
+    case.setUp()
+    built = time.perf_counter()
+    case.emit(hook)
+    dispatched = time.perf_counter()
+    print(
+        json.dumps(
+            {
+                "import": imported - started,
+                "build": built - imported,
+                "dispatch": dispatched - built,
+                "slow_imports": [name for name in SLOW_IMPORTS if name in sys.modules],
+            }
+        )
+    )
+    case.tearDown()
+    operator_fixtures.OperatorTestCase.tearDownClass()
+
+
+def run(hook):
+    """Measure a hook in a fresh interpreter, as Juju runs it."""
+    output = subprocess.check_output(
+        [sys.executable, __file__, "--measure", hook],
+        cwd=ROOT,
+        stderr=subprocess.DEVNULL,
+    )
+
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--hooks", default=",".join(HOOKS))
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure)
+
+        return
+    results = {}
+    failed = []
+
+    for hook in args.hooks.split(","):
+        samples = [run(hook) for _ in range(args.runs)]
+        results[hook] = {
+            phase: statistics.median(sample[phase] for sample in samples)
+            for phase in ("import", "build", "dispatch")
+        }
+        results[hook]["slow_imports"] = samples[-1]["slow_imports"]
+        print(
+            "{:<28} import {:7.1f}ms  build {:6.1f}ms  dispatch {:7.1f}ms  {}".format(
+                hook,
+                results[hook]["import"] * 1000,
+                results[hook]["build"] * 1000,
+                results[hook]["dispatch"] * 1000,
+                " ".join(results[hook]["slow_imports"]),
+            )
+        )
+
+        heavy = [
+            name for name in results[hook]["slow_imports"] if name.startswith(HEAVY_IMPORTS)
+        ]
+
+        if hook in LIGHT_HOOKS and heavy:
+            failed.append((hook, heavy))
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=1, sort_keys=True)
+
+    for hook, heavy in failed:
+        print("Regression: {} imported {}".format(hook, " ".join(heavy)))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Benchmark serial and parallel extraction of a many-small-files resource."""
+
+import argparse
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+import zipfile
+
+import setuppath  # noqa:F401
+from lib_foundry import FoundryHelper
+
+
+def build_archive(zip_path, files, size):
+    """Build a synthetic archive of many small, compressible files."""
+    with zipfile.ZipFile(str(zip_path), "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for index in range(files):
+            content = os.urandom(size // 2).hex().encode()[:size]
+            zip_ref.writestr("resources/app/public/{:06}.js".format(index), content)
+
+
+def time_extractall(zip_path, target):
+    """Return the seconds ZipFile.extractall takes, the serial extraction replaced."""
+    start = time.perf_counter()
+    with zipfile.ZipFile(str(zip_path), "r") as zip_ref:
+        zip_ref.extractall(str(target))
+
+    return time.perf_counter() - start
+
+
+def time_extract(zip_path, target, workers):
+    """Return the seconds extract_members takes with the given workers."""
+    helper = FoundryHelper(
+        {"extract_workers": workers}, SimpleNamespace(current_data_path=False, pinned_release=None)
+    )
+    with zipfile.ZipFile(str(zip_path), "r") as zip_ref:
+        infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+    start = time.perf_counter()
+    helper.extract_members(zip_path, infos, target)
+
+    return time.perf_counter() - start
+
+
+def best_of(repeat, root, run):
+    """Return the fastest of repeat runs, each into a fresh directory."""
+    times = []
+
+    for _ in range(repeat):
+        target = Path(tempfile.mkdtemp(dir=str(root)))
+        times.append(run(target))
+        shutil.rmtree(str(target))
+
+    return min(times)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=16 * 1024)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        zip_path = root / "foundryvtt.zip"
+        build_archive(zip_path, args.files, args.size)
+        print(
+            "{} files of {} bytes, archive {} bytes, {} cores".format(
+                args.files, args.size, zip_path.stat().st_size, os.cpu_count()
+            )
+        )
+        baseline = best_of(args.repeat, root, lambda target: time_extractall(zip_path, target))
+        print("extractall  {:8.3f}s".format(baseline))
+        results = {}
+
+        for workers in args.workers:
+            results[workers] = best_of(
+                args.repeat, root, lambda target: time_extract(zip_path, target, workers)
+            )
+            print(
+                "workers={:<3} {:8.3f}s  speedup {:5.2f}x".format(
+                    workers, results[workers], baseline / results[workers]
+                )
+            )
+        print("fastest with {} workers".format(min(results, key=results.get)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Benchmark how many concurrent players a Foundry server sustains.
+
+Simulated players fetch the client assets, then move tokens, chat and
+change scenes over socket.io, and the latency percentiles and throughput
+of each action are reported for each player count. Without --url they
+play against a local stand-in server. Against a deployed unit pass its
+url and the ids of users to join as, e.g.
+
+    bench_players.py --url http://10.0.0.5:30000 --user-ids id1,id2 --players 5,10
+
+Save a run with --json and compare later runs with --baseline, which exits
+non-zero if a p95 latency regressed by more than --tolerance.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+
+from loadgen import run_players, StandInServer
+
+
+def print_report(players, report):
+    """Print the report of one run."""
+    print(
+        "{} players, {:.1f}s, {:.1f} messages received/s".format(
+            players, report["seconds"], report["received_per_second"]
+        )
+    )
+
+    for operation, result in report["operations"].items():
+        print(
+            "  {:<13} {:7} ok {:5} errors {:8.1f}/s  p50 {:8.1f}ms  p95 {:8.1f}ms  p99 {:8.1f}ms".format(
+                operation,
+                result["count"],
+                result["errors"],
+                result["per_second"],
+                result["p50_ms"],
+                result["p95_ms"],
+                result["p99_ms"],
+            )
+        )
+
+
+def regressions(results, baseline, tolerance):
+    """Return the p95 latencies which are worse than the baseline by more than tolerance."""
+    found = []
+
+    for players, report in results.items():
+        for operation, result in report["operations"].items():
+            previous = baseline.get(players, {}).get("operations", {}).get(operation)
+
+            if previous and result["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+                found.append(
+                    "{} players {}: p95 {:.1f}ms, was {:.1f}ms".format(
+                        players, operation, result["p95_ms"], previous["p95_ms"]
+                    )
+                )
+
+    return found
+
+
+async def benchmark(args):
+    """Run each player count in turn, returning the reports by player count."""
+    server = None
+    url = args.url
+
+    if not url:
+        server = StandInServer(args.asset_size, args.delay / 1000)
+        await server.start()
+        url = "http://127.0.0.1:{}".format(server.port)
+    ids = {key: value for key, value in (("scene", args.scene_id), ("token", args.token_id)) if value}
+    results = {}
+    try:
+        for players in args.players:
+            stats = await run_players(
+                url,
+                players,
+                args.seconds,
+                rate=args.rate,
+                ramp=args.ramp,
+                assets=args.assets,
+                user_ids=args.user_ids,
+                password=args.password,
+                ids=ids,
+            )
+            results[str(players)] = stats.report()
+            print_report(players, results[str(players)])
+    finally:
+        if server:
+            server.close()
+
+    return results
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    def int_list(value):
+        return [int(item) for item in value.split(",")]
+
+    def str_list(value):
+        return [item for item in value.split(",") if item]
+
+    parser.add_argument("--url", help="Foundry server to benchmark, a local stand-in if not given")
+    parser.add_argument("--players", type=int_list, default=[10, 50, 100])
+    parser.add_argument("--seconds", type=float, default=30, help="Duration of each run")
+    parser.add_argument("--rate", type=float, default=0.5, help="Actions per second of each player")
+    parser.add_argument("--ramp", type=float, default=5, help="Seconds to start the players over")
+    parser.add_argument("--assets", type=str_list, default=["/scripts/foundry.js", "/css/style.css"])
+    parser.add_argument("--user-ids", type=str_list, default=[], help="Users players join as, in turn")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--scene-id", help="Scene updated by scene changes and holding the token")
+    parser.add_argument("--token-id", help="Token moved by token moves")
+    parser.add_argument("--asset-size", type=int, default=256 * 1024, help="Stand-in asset size")
+    parser.add_argument("--delay", type=float, default=0, help="Stand-in milliseconds per event")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(benchmark(args))
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            found = regressions(results, json.load(baseline_file), args.tolerance)
+
+        for regression in found:
+            print("Regression: {}".format(regression))
+
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
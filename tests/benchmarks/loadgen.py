@@ -0,0 +1,514 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+# Distributed under terms of the GPL license.
+"""Simulated Foundry players and a stand-in Foundry server to run them against.
+
+Only the standard library is used. Players speak socket.io over Engine.IO 4
+on a websocket, as Foundry's client does, and fetch static assets over
+HTTP. The stand-in answers the same way Foundry does, acknowledging each
+event and broadcasting it to the other connected players.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import time
+from urllib.parse import urlsplit
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+# Relative frequency of each player action
+ACTIONS = {"token_move": 70, "chat": 20, "scene_change": 10}
+
+
+class LoadError(Exception):
+    """Raise if the server doesn't answer as expected."""
+
+    pass
+
+
+async def read_head(reader):
+    """Read an HTTP head, returning the status line and the headers."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    headers = {}
+
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+
+    return lines[0], headers
+
+
+async def http_request(host, port, method, path, headers=None, body=b""):
+    """Send a request on a new connection, returning the status, headers and body."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        lines = ["{} {} HTTP/1.1".format(method, path), "Host: {}:{}".format(host, port)]
+        lines += ["{}: {}".format(key, value) for key, value in (headers or {}).items()]
+        lines += ["Content-Length: {}".format(len(body)), "Connection: close", "", ""]
+        writer.write("\r\n".join(lines).encode("latin-1") + body)
+        status_line, response_headers = await read_head(reader)
+
+        if "content-length" in response_headers:
+            content = await reader.readexactly(int(response_headers["content-length"]))
+        else:
+            content = await reader.read()
+    finally:
+        writer.close()
+
+    return int(status_line.split()[1]), response_headers, content
+
+
+async def read_frame(reader):
+    """Read a websocket frame, returning its opcode and payload."""
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+
+    if mask:
+        payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+    return first & 0x0F, payload
+
+
+def encode_frame(opcode, payload, masked):
+    """Encode a single websocket frame, masked as clients must send them."""
+    head = bytes([0x80 | opcode])
+    length = len(payload)
+    mask_bit = 0x80 if masked else 0
+
+    if length < 126:
+        head += bytes([mask_bit | length])
+    elif length < 65536:
+        head += bytes([mask_bit | 126]) + struct.pack("!H", length)
+    else:
+        head += bytes([mask_bit | 127]) + struct.pack("!Q", length)
+
+    if not masked:
+        return head + payload
+    mask = os.urandom(4)
+
+    return head + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+
+class Stats:
+    """Latencies and counts of each operation, and of the messages received."""
+
+    def __init__(self):
+        """Initialize empty stats."""
+        self.latencies = {}
+        self.errors = {}
+        self.received = 0
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, operation, seconds):
+        """Record one completed operation."""
+        self.latencies.setdefault(operation, []).append(seconds)
+
+    def error(self, operation):
+        """Record one failed operation."""
+        self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def report(self):
+        """Return the percentiles and throughput of each operation."""
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        operations = {}
+
+        for operation in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies.get(operation, []))
+            operations[operation] = {
+                "count": len(latencies),
+                "errors": self.errors.get(operation, 0),
+                "per_second": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+            }
+
+        return {
+            "seconds": elapsed,
+            "operations": operations,
+            "received": self.received,
+            "received_per_second": self.received / elapsed,
+        }
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values, 0 if there are none."""
+    if not values:
+        return 0
+
+    return values[max(0, min(len(values) - 1, -(-len(values) * percent // 100) - 1))]
+
+
+class Player:
+    """One simulated browser client.
+
+    It fetches the client assets, opens the game socket and then acts at
+    the given rate until stopped, timing the acknowledgement of each event.
+    With a user id it first joins the world, as a deployed Foundry requires.
+    """
+
+    def __init__(self, url, stats, rate=1.0, assets=(), user_id=None, password="", ids=None):
+        """Initialize with the server url, shared stats and actions per second."""
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.stats = stats
+        self.rate = rate
+        self.assets = list(assets)
+        self.user_id = user_id
+        self.password = password
+        self.ids = ids or {}
+        self.session = None
+        self.reader = None
+        self.writer = None
+        self.pending = {}
+        self.next_ack = 0
+        self.rng = random.Random()
+
+    async def timed(self, operation, coroutine):
+        """Await coroutine, recording its latency, or an error if it fails.
+
+        Returns True if it succeeded.
+        """
+        started = time.perf_counter()
+        try:
+            await coroutine
+        except (LoadError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            self.stats.error(operation)
+
+            return False
+        self.stats.record(operation, time.perf_counter() - started)
+
+        return True
+
+    async def fetch(self, path):
+        """Fetch an asset, raising LoadError unless it is served."""
+        headers = {"Cookie": "session={}".format(self.session)} if self.session else {}
+        status, _, _ = await http_request(self.host, self.port, "GET", path, headers)
+
+        if status >= 400:
+            raise LoadError("GET {} returned {}".format(path, status))
+
+    async def join(self):
+        """Get a session and join the world as the user."""
+        _, headers, _ = await http_request(self.host, self.port, "GET", "/join")
+
+        for cookie in headers.get("set-cookie", "").split(";"):
+            if cookie.strip().startswith("session="):
+                self.session = cookie.strip()[len("session="):]
+
+        if self.user_id:
+            body = json.dumps(
+                {"userid": self.user_id, "password": self.password, "action": "join"}
+            ).encode()
+            status, _, _ = await http_request(
+                self.host,
+                self.port,
+                "POST",
+                "/join",
+                {"Content-Type": "application/json", "Cookie": "session={}".format(self.session)},
+                body,
+            )
+
+            if status >= 400:
+                raise LoadError("Join as {} returned {}".format(self.user_id, status))
+
+    async def connect(self):
+        """Open the socket.io websocket and wait for the namespace to connect."""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        path = "/socket.io/?EIO=4&transport=websocket"
+
+        if self.session:
+            path += "&session={}".format(self.session)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write(
+            "\r\n".join(
+                [
+                    "GET {} HTTP/1.1".format(path),
+                    "Host: {}:{}".format(self.host, self.port),
+                    "Upgrade: websocket",
+                    "Connection: Upgrade",
+                    "Sec-WebSocket-Key: {}".format(key),
+                    "Sec-WebSocket-Version: 13",
+                    "",
+                    "",
+                ]
+            ).encode("latin-1")
+        )
+        status_line, _ = await read_head(self.reader)
+
+        if " 101 " not in status_line + " ":
+            raise LoadError("Websocket upgrade refused: {}".format(status_line))
+        opcode, payload = await read_frame(self.reader)
+
+        if not payload.startswith(b"0"):
+            raise LoadError("Expected an Engine.IO open packet")
+        self.send("40")
+
+        while True:
+            opcode, payload = await read_frame(self.reader)
+
+            if payload.startswith(b"40"):
+                return
+
+            if payload.startswith(b"44"):
+                raise LoadError("Socket refused: {}".format(payload[2:].decode()))
+
+    def send(self, packet):
+        """Send an Engine.IO packet."""
+        self.writer.write(encode_frame(OP_TEXT, packet.encode(), masked=True))
+
+    async def emit(self, event, *args):
+        """Emit a socket.io event and wait for its acknowledgement."""
+        ack = self.next_ack
+        self.next_ack += 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[ack] = future
+        self.send("42{}{}".format(ack, json.dumps([event] + list(args))))
+        result = await asyncio.wait_for(future, 30)
+
+        if isinstance(result, dict) and result.get("error"):
+            raise LoadError(result["error"])
+
+        return result
+
+    async def listen(self):
+        """Answer pings, resolve acknowledgements and count broadcasts until closed."""
+        while True:
+            opcode, payload = await read_frame(self.reader)
+
+            if opcode == OP_PING:
+                self.writer.write(encode_frame(OP_PONG, payload, masked=True))
+            elif opcode == OP_CLOSE:
+                return
+            elif payload == b"2":
+                self.send("3")
+            elif payload.startswith(b"43"):
+                text = payload[2:].decode()
+                index = text.index("[")
+                future = self.pending.pop(int(text[:index]), None)
+
+                if future and not future.done():
+                    arguments = json.loads(text[index:])
+                    future.set_result(arguments[0] if arguments else None)
+            elif payload.startswith(b"42"):
+                self.stats.received += 1
+
+    def action(self, name):
+        """Return the event for one player action, shaped like Foundry's modifyDocument."""
+        scene = self.ids.get("scene", "benchmarkScene00")
+
+        if name == "token_move":
+            return (
+                "modifyDocument",
+                {
+                    "type": "Token",
+                    "action": "update",
+                    "updates": [
+                        {
+                            "_id": self.ids.get("token", "benchmarkToken00"),
+                            "x": self.rng.randrange(0, 4000, 100),
+                            "y": self.rng.randrange(0, 4000, 100),
+                        }
+                    ],
+                    "options": {"diff": True, "animate": True},
+                    "pack": None,
+                    "parentUuid": "Scene.{}".format(scene),
+                },
+            )
+
+        if name == "chat":
+            return (
+                "modifyDocument",
+                {
+                    "type": "ChatMessage",
+                    "action": "create",
+                    "data": [{"content": "Benchmark roll {}".format(self.rng.randint(1, 20))}],
+                    "options": {},
+                    "pack": None,
+                },
+            )
+
+        return (
+            "modifyDocument",
+            {
+                "type": "Scene",
+                "action": "update",
+                "updates": [{"_id": scene, "active": True}],
+                "options": {"diff": True},
+                "pack": None,
+            },
+        )
+
+    async def run(self, deadline):
+        """Play until the deadline."""
+        if not await self.timed("join", self.join()) and self.user_id:
+            return
+
+        for asset in self.assets:
+            await self.timed("asset", self.fetch(asset))
+
+        if not await self.timed("connect", self.connect()):
+            return
+        listener = asyncio.ensure_future(self.listen())
+        names = list(ACTIONS)
+        weights = [ACTIONS[name] for name in names]
+        try:
+            while time.perf_counter() < deadline:
+                # Exponential gaps between actions, so players don't act in lockstep
+                await asyncio.sleep(self.rng.expovariate(self.rate))
+                name = self.rng.choices(names, weights)[0]
+                await self.timed(name, self.emit(*self.action(name)))
+
+                if name == "scene_change" and self.assets:
+                    await self.timed("asset", self.fetch(self.rng.choice(self.assets)))
+        finally:
+            listener.cancel()
+            self.writer.close()
+
+
+async def run_players(url, players, seconds, rate=1.0, ramp=0, assets=(), user_ids=(), **kwargs):
+    """Run players against url for seconds, starting them over ramp seconds.
+
+    Players join as the given user ids in turn. Returns the stats.
+    """
+    stats = Stats()
+    deadline = time.perf_counter() + ramp + seconds
+    tasks = []
+
+    for index in range(players):
+        user_id = user_ids[index % len(user_ids)] if user_ids else None
+        player = Player(url, stats, rate, assets, user_id, **kwargs)
+        tasks.append(asyncio.ensure_future(player.run(deadline)))
+
+        if ramp:
+            await asyncio.sleep(ramp / players)
+    await asyncio.gather(*tasks)
+    stats.finished = time.perf_counter()
+
+    return stats
+
+
+class StandInServer:
+    """A stand-in for Foundry's HTTP and websocket handling.
+
+    Assets under /scripts, /css and /icons are served with asset_size
+    bytes. Each event is acknowledged after delay seconds and broadcast to
+    every other connected client, the way Foundry relays document changes.
+    """
+
+    def __init__(self, asset_size=256 * 1024, delay=0.0):
+        """Initialize with the size of served assets and the event delay."""
+        self.asset = os.urandom(asset_size // 2).hex().encode()[:asset_size]
+        self.delay = delay
+        self.clients = set()
+        self.server = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start listening, on a free port by default."""
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        """Stop listening."""
+        self.server.close()
+
+    async def handle(self, reader, writer):
+        """Serve one connection."""
+        try:
+            request_line, headers = await read_head(reader)
+            method, path, _ = request_line.split(" ", 2)
+
+            if headers.get("upgrade", "").lower() == "websocket":
+                await self.websocket(reader, writer, headers)
+
+                return
+            await reader.readexactly(int(headers.get("content-length") or 0))
+
+            if path == "/join":
+                self.respond(writer, 200, b"{}", {"Set-Cookie": "session=standin; path=/"})
+            elif path.startswith(("/scripts/", "/css/", "/icons/")):
+                self.respond(writer, 200, self.asset)
+            else:
+                self.respond(writer, 404, b"")
+            await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, body, headers=None):
+        """Write an HTTP response."""
+        lines = ["HTTP/1.1 {} {}".format(status, "OK" if status < 400 else "Error")]
+        lines += ["{}: {}".format(key, value) for key, value in (headers or {}).items()]
+        lines += ["Content-Length: {}".format(len(body)), "Connection: close", "", ""]
+        writer.write("\r\n".join(lines).encode("latin-1") + body)
+
+    async def websocket(self, reader, writer, headers):
+        """Speak Engine.IO and socket.io to one client until it disconnects."""
+        accept = base64.b64encode(
+            hashlib.sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                "Connection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n".format(accept)
+            ).encode("latin-1")
+        )
+        sid = base64.urlsafe_b64encode(os.urandom(15)).decode()
+        self.send(writer, "0" + json.dumps({"sid": sid, "pingInterval": 25000, "pingTimeout": 20000}))
+        self.clients.add(writer)
+        try:
+            while True:
+                opcode, payload = await read_frame(reader)
+
+                if opcode == OP_CLOSE:
+                    return
+                text = payload.decode()
+
+                if text == "40":
+                    self.send(writer, "40" + json.dumps({"sid": sid}))
+                elif text.startswith("42"):
+                    await self.event(writer, text[2:])
+        finally:
+            self.clients.discard(writer)
+
+    async def event(self, writer, text):
+        """Acknowledge an event and broadcast it to the other clients."""
+        index = text.index("[")
+        ack = text[:index]
+        event = json.loads(text[index:])
+
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        if ack:
+            self.send(writer, "43{}{}".format(ack, json.dumps([{"result": event[1:]}])))
+
+        for client in list(self.clients):
+            if client is not writer:
+                self.send(client, "42" + json.dumps(event))
+
+    def send(self, writer, packet):
+        """Send an Engine.IO packet, unmasked as servers send them."""
+        writer.write(encode_frame(OP_TEXT, packet.encode(), masked=False))
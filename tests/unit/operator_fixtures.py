@@ -60,6 +60,8 @@ class OperatorTestCase(unittest.TestCase):
 
         for key, _ in config["options"].items():
             charm_config[key] = config["options"][key]["default"]
+        # Tests change options through this, the model reads it lazily
+        self.charm_config = charm_config
         config_patcher = mock.patch(
             "ops.model.ModelBackend.config_get", lambda x: charm_config
         )
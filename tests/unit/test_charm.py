@@ -4,7 +4,10 @@ from pathlib import Path
 
 import setuppath  # noqa:F401
 import mock
+from lib_backup import BackupError
+from lib_foundry import PathError
 from operator_fixtures import OperatorTestCase
+from src.charm import DATA_MOVE_ERROR
 
 
 class TestCharm(OperatorTestCase):
@@ -14,12 +17,26 @@ class TestCharm(OperatorTestCase):
         # Mock zip install
         zip_patcher = mock.patch("lib_foundry.zipfile.ZipFile")
         cls.patchers["lib_foundry.zipfile"] = zip_patcher.start()
+        digest_patcher = mock.patch("lib_foundry.file_digest")
+        cls.patchers["lib_foundry.file_digest"] = digest_patcher.start()
+        cls.patchers["lib_foundry.file_digest"].return_value = "mock_digest"
 
         # Mock charmhelpers subprocess calls
         subprocess_patcher = mock.patch("charmhelpers.fetch.ubuntu.subprocess")
         cls.patchers["charmhelpers_fetch_subprocess"] = subprocess_patcher.start()
         subprocess_patcher = mock.patch("charmhelpers.core.host.subprocess")
         cls.patchers["charmhelpers_host_subprocess"] = subprocess_patcher.start()
+        # Mock the charm's own systemctl calls
+        subprocess_patcher = mock.patch("src.charm.subprocess")
+        cls.patchers["charm_subprocess"] = subprocess_patcher.start()
+
+        # Mock readiness, nothing listens in tests
+        ready_patcher = mock.patch("lib_probe.wait_until_ready", return_value=(1.0, 1))
+        cls.patchers["lib_probe.wait_until_ready"] = ready_patcher.start()
+        record_patcher = mock.patch("lib_probe.record_cold_start")
+        cls.patchers["lib_probe.record_cold_start"] = record_patcher.start()
+        operation_patcher = mock.patch("lib_metrics.record_operation")
+        cls.patchers["lib_metrics.record_operation"] = operation_patcher.start()
 
         # Mock import_key
         import_key_patcher = mock.patch("charmhelpers.fetch.ubuntu.import_key")
@@ -46,6 +63,17 @@ class TestCharm(OperatorTestCase):
             prefix="service_", dir=self.tmpdir.name
         ).name
         self.charm.helper.service_file = Path(tmp_service)
+        self.charm.helper.instance_service_file = Path(tmp_service).with_name("instance@.service")
+        self.charm.helper.instance_config_path = Path(self.tmpdir.name) / "instances"
+        self.charm.helper.instances_data_path = Path(self.tmpdir.name) / "instance_data"
+        self.charm.helper.systemd_path = Path(self.tmpdir.name)
+
+    def set_installed(self, started=False):
+        """Set the state of an installed unit on the default data path."""
+        self.charm.state.installed = True
+        self.charm.state.started = started
+        self.charm.helper.default_data_path.mkdir()
+        self.charm.state.current_data_path = str(self.charm.helper.default_data_path)
 
     def test_create_charm(self):
         """Verify fixtures and create a charm."""
@@ -59,16 +87,79 @@ class TestCharm(OperatorTestCase):
             content = service_file.read()
         self.assertIn("ExecStart=/usr/bin/node", content)
 
+    @mock.patch("src.charm.BackgroundJob")
+    @mock.patch(
+        "lib_foundry.FoundryHelper.background_jobs",
+        new_callable=mock.PropertyMock,
+        return_value=True,
+    )
+    def test_install_background(self, background_jobs, job_class):
+        """Test a background install is polled until the job is done."""
+        job = job_class.return_value
+        job.status.side_effect = [None, {"state": "running", "message": "Starting install"}]
+        self.emit("install")
+        self.assertTrue(job.start.called)
+        self.assertEqual(self.charm.state.installed, False)
+        job.status.side_effect = None
+        job.status.return_value = {
+            "state": "done",
+            "message": "Completed install",
+            "result": {
+                "current_data_path": str(self.charm.helper.default_data_path),
+                "apt_source_digest": "mock_source_digest",
+                "pinned_release": {"release": "mock_release", "digest": "mock_digest"},
+            },
+        }
+        self.emit("update_status")
+        self.assertEqual(self.charm.state.installed, True)
+        self.assertTrue(job.clear.called)
+        self.assertEqual(self.charm.state.apt_source_digest, "mock_source_digest")
+        self.assertEqual(self.charm.state.pinned_release["release"], "mock_release")
+
+    @mock.patch("src.charm.BackgroundJob")
+    @mock.patch(
+        "lib_foundry.FoundryHelper.background_jobs",
+        new_callable=mock.PropertyMock,
+        return_value=True,
+    )
+    def test_install_background_failed(self, background_jobs, job_class):
+        """Test a failed background install is resubmitted until the retry limit."""
+        self.charm.deferrals.backoff = 0
+        self.charm.deferrals.retry_limit = 1
+        job = job_class.return_value
+        failed = {"state": "failed", "message": "Bad zip file, upload a new resource"}
+        job.status.side_effect = [None, {"state": "running", "message": "Starting install"}, failed]
+        self.emit("install")
+        self.emit("update_status")
+        self.assertEqual(self.charm.state.installed, False)
+        self.assertEqual(job.clear.call_count, 1)
+        self.assertEqual(self.charm.unit.status.message, failed["message"])
+        self.assertEqual(self.charm.state.deferrals["FoundryvttCharm/on/install"]["count"], 1)
+        # Resubmitted on the next hook, and dropped once it fails again
+        job.status.side_effect = [None, {"state": "running", "message": "Starting install"}]
+        self.emit("update_status")
+        self.assertEqual(job.start.call_count, 2)
+        job.status.side_effect = None
+        job.status.return_value = failed
+        with self.assertLogs(level="WARNING"):
+            self.emit("update_status")
+        self.assertEqual(dict(self.charm.state.deferrals), {})
+        job.status.return_value = None
+        self.emit("update_status")
+        self.assertEqual(job.start.call_count, 2)
+
     def test_start(self):
         """Test emitting a start hook."""
         self.charm.state.installed = True
         self.charm.state.configured = True
         self.emit("start")
         self.assertEqual(self.charm.state.started, True)
+        self.assertEqual(self.charm.state.ready, True)
 
     def test_proxy(self):
         """Test emitting reversepoxy join."""
         self.charm.state.started = True
+        self.charm.state.ready = True
         relation = mock.MagicMock()
         relation.id = "mock_relation_id"
         relation.name = "mock_relation_name"
@@ -98,6 +189,239 @@ class TestCharm(OperatorTestCase):
         self.emit("upgrade_charm")
         self.assertEqual(self.charm.state.enabled, True)
 
+    @mock.patch("lib_foundry.FoundryHelper.migrate_data")
+    @mock.patch(
+        "lib_foundry.FoundryHelper.needs_data_migration",
+        new_callable=mock.PropertyMock,
+        return_value=True,
+    )
+    @mock.patch("src.charm.host")
+    def test_config_changed_migration(self, host, needs_data_migration, migrate_data):
+        """Test a changed data path is migrated with the service stopped."""
+        self.set_installed(started=True)
+        self.emit("config_changed")
+        self.assertTrue(migrate_data.called)
+        host.service_stop.assert_called_with(self.charm.helper.service_name)
+        host.service_start.assert_called_with(self.charm.helper.service_name)
+        self.assertEqual(self.charm.state.configured, True)
+
+    @mock.patch("lib_foundry.FoundryHelper.migrate_data")
+    @mock.patch(
+        "lib_foundry.FoundryHelper.needs_data_migration",
+        new_callable=mock.PropertyMock,
+        return_value=True,
+    )
+    @mock.patch("src.charm.host")
+    def test_config_changed_migration_failed(self, host, needs_data_migration, migrate_data):
+        """Test a failed migration blocks the unit and restarts the service."""
+        self.set_installed(started=True)
+        migrate_data.side_effect = PathError("Target data path is not empty")
+        self.emit("config_changed")
+        self.assertEqual(self.charm.unit.status.name, "blocked")
+        self.assertEqual(self.charm.state.status_reason, DATA_MOVE_ERROR)
+        host.service_start.assert_called_with(self.charm.helper.service_name)
+        self.assertEqual(self.charm.state.configured, False)
+
+    @mock.patch("lib_foundry.FoundryHelper.relocate_tiers")
+    @mock.patch("lib_foundry.FoundryHelper.tier_moves", return_value=[("Data/assets", "/srv/hot")])
+    @mock.patch("src.charm.host")
+    def test_config_changed_tiers(self, host, tier_moves, relocate_tiers):
+        """Test changed storage tiers are relocated with the service stopped."""
+        self.set_installed(started=True)
+        self.emit("config_changed")
+        self.assertTrue(relocate_tiers.called)
+        host.service_stop.assert_called_with(self.charm.helper.service_name)
+        self.assertEqual(self.charm.state.configured, True)
+        # A failed relocation blocks the unit until the next config change
+        self.charm.state.configured = False
+        relocate_tiers.side_effect = OSError("No space left on device")
+        self.emit("config_changed")
+        self.assertEqual(self.charm.unit.status.name, "blocked")
+        self.assertEqual(self.charm.state.status_reason, DATA_MOVE_ERROR)
+        self.assertEqual(self.charm.state.configured, False)
+
+    @mock.patch("lib_foundry.FoundryHelper.render_exporter", return_value=True)
+    @mock.patch("src.charm.subprocess")
+    @mock.patch("src.charm.host")
+    def test_config_changed_exporter(self, host, subprocess, render_exporter):
+        """Test the exporter is only enabled and restarted when it has a port."""
+        self.set_installed()
+        self.charm_config["metrics_port"] = 0
+        self.emit("config_changed")
+        # Without Prometheus related the exporter only listens on localhost
+        render_exporter.assert_called_with(self.charm.framework.charm_dir, "127.0.0.1")
+        subprocess.check_call.assert_any_call(["systemctl", "daemon-reload"])
+        host.service_restart.assert_not_called()
+        self.charm_config["metrics_port"] = 9110
+        self.emit("config_changed")
+        host.service.assert_any_call("enable", self.charm.helper.exporter_service)
+        host.service_restart.assert_called_with(self.charm.helper.exporter_service)
+
+    @mock.patch("lib_foundry.FoundryHelper.instances", return_value=["one", "two"])
+    @mock.patch("lib_foundry.FoundryHelper.sync_instances", return_value=(["two"], ["three"]))
+    @mock.patch("lib_foundry.FoundryHelper.render_instance_service", return_value=False)
+    @mock.patch("src.charm.host")
+    def test_config_changed_instances(self, host, render_instance_service, sync_instances, instances):
+        """Test added instances are started and removed ones stopped, leaving the others."""
+        self.set_installed(started=True)
+        with mock.patch.object(self.charm, "_reconfigure_proxy") as reconfigure_proxy:
+            self.emit("config_changed")
+        helper = self.charm.helper
+        host.service_stop.assert_called_with(helper.instance_service("three"))
+        host.service_start.assert_called_with(helper.instance_service("two"))
+        self.assertNotIn(mock.call(helper.instance_service("one")), host.service_restart.mock_calls)
+        self.assertTrue(reconfigure_proxy.called)
+
+    def test_elect_initial_role(self):
+        """Test the role a unit without one settles on."""
+        relation = mock.MagicMock()
+        # Without the peer relation the unit serves
+        self.charm._elect_initial_role(None, {})
+        self.assertEqual(self.charm.state.role, "active")
+        self.assertEqual(self.charm.state.epoch, 1)
+        # Another unit already serves
+        self.charm.state.role = None
+        self.charm._elect_initial_role(relation, {"mock/1": 2})
+        self.assertEqual(self.charm.state.role, "standby")
+        # Nobody serves, the leader takes over
+        self.charm.state.role = None
+        with mock.patch.object(self.charm.unit, "is_leader", return_value=True):
+            self.charm._elect_initial_role(relation, {})
+        self.assertEqual(self.charm.state.role, "active")
+        # Others wait for the leader
+        self.charm.state.role = None
+        with mock.patch.object(self.charm.unit, "is_leader", return_value=False):
+            self.charm._elect_initial_role(relation, {})
+        self.assertIsNone(self.charm.state.role)
+        # A unit serving from before the relation keeps serving
+        self.charm.state.started = True
+        self.charm._elect_initial_role(relation, {"mock/1": 2})
+        self.assertEqual(self.charm.state.role, "active")
+
+    @mock.patch("lib_foundry.FoundryHelper.replicate", return_value=True)
+    @mock.patch("lib_foundry.FoundryHelper.replication_lag", return_value=12.5)
+    @mock.patch("lib_foundry.FoundryHelper.stop_replication_target", return_value=False)
+    def test_failover_action(self, stop_replication_target, replication_lag, replicate):
+        """Test a standby is promoted above the epoch of the unit it fails over from."""
+        event = mock.Mock(params={"final-sync": False})
+        # Only configured standbys can be promoted
+        with mock.patch.object(self.charm.model, "get_relation", return_value=None):
+            self.charm.on_failover_action(event)
+        self.assertTrue(event.fail.called)
+        active = mock.Mock()
+        active.name = "mock/1"
+        relation = mock.Mock(units=[active])
+        relation.data = {active: {"role": "active", "epoch": "3", "address": "10.0.0.1"}}
+        self.charm.state.configured = True
+        self.charm.state.role = "standby"
+        self.charm.state.epoch = 0
+        event = mock.Mock(params={"final-sync": True, "sync-timeout": 60})
+        with mock.patch.object(self.charm.model, "get_relation", return_value=relation), \
+                mock.patch.object(self.charm, "_update_replication"), \
+                mock.patch.object(self.charm, "_start_foundry"):
+            self.charm.on_failover_action(event)
+        self.assertFalse(event.fail.called)
+        replicate.assert_called_with("10.0.0.1", 60)
+        self.assertEqual(self.charm.state.role, "active")
+        self.assertEqual(self.charm.state.epoch, 4)
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["final-sync"], True)
+        self.assertEqual(results["replication-lag"], 0)
+        # An active unit is not failed over again
+        event = mock.Mock(params={"final-sync": False})
+        self.charm.on_failover_action(event)
+        self.assertTrue(event.fail.called)
+
+    @mock.patch("lib_foundry.FoundryHelper.backup_store", new_callable=mock.PropertyMock)
+    @mock.patch("lib_foundry.FoundryHelper.backup_data")
+    @mock.patch("lib_backup.lower_priority")
+    @mock.patch("src.charm.host")
+    def test_backup_action(self, host, lower_priority, backup_data, backup_store):
+        """Test the backup action reports its snapshot and restarts a stopped service."""
+        backup_store.return_value.snapshots.return_value = ["20260101T000000", "20260102T000000"]
+        backup_data.return_value = (
+            "20260102T000000",
+            {
+                "files": 3,
+                "files_unchanged": 1,
+                "bytes": 300,
+                "bytes_read": 200,
+                "bytes_stored": 100,
+                "chunks_reused": 1,
+                "seconds": 0.25,
+            },
+        )
+        self.charm.state.started = True
+        event = mock.Mock(params={"stop-service": True, "bwlimit": 2})
+        self.charm.on_backup_action(event)
+        self.assertTrue(lower_priority.called)
+        backup_data.assert_called_with(rate=2 * 1024 * 1024)
+        host.service_stop.assert_called_with(self.charm.helper.service_name)
+        host.service_start.assert_called_with(self.charm.helper.service_name)
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["snapshot"], "20260102T000000")
+        self.assertEqual(results["snapshots"], "20260101T000000 20260102T000000")
+        self.assertEqual(results["bytes-stored"], 100)
+        # A failed backup fails the action, still restarting the service
+        host.reset_mock()
+        backup_data.side_effect = BackupError("Chunk store is corrupt")
+        event = mock.Mock(params={"stop-service": True, "bwlimit": 0})
+        self.charm.on_backup_action(event)
+        event.fail.assert_called_with("Backup failed: Chunk store is corrupt")
+        self.assertFalse(event.set_results.called)
+        self.assertTrue(host.service_start.called)
+
+    @mock.patch("lib_foundry.FoundryHelper.restore_data")
+    @mock.patch("src.charm.host")
+    def test_restore_action(self, host, restore_data):
+        """Test the restore action restores the latest snapshot unless one is given."""
+        restore_data.return_value = {
+            "files": 3,
+            "files_written": 2,
+            "bytes_written": 200,
+            "removed": 1,
+        }
+        self.charm.state.started = True
+        event = mock.Mock(params={"snapshot": ""})
+        self.charm.on_restore_action(event)
+        restore_data.assert_called_with(None)
+        host.service_stop.assert_called_with(self.charm.helper.service_name)
+        host.service_start.assert_called_with(self.charm.helper.service_name)
+        self.assertEqual(event.set_results.call_args[0][0]["files-written"], 2)
+        restore_data.side_effect = BackupError("No snapshot 20260101T000000")
+        event = mock.Mock(params={"snapshot": "20260101T000000"})
+        self.charm.on_restore_action(event)
+        restore_data.assert_called_with("20260101T000000")
+        event.fail.assert_called_with("Restore failed: No snapshot 20260101T000000")
+        self.assertFalse(event.set_results.called)
+
+    @mock.patch("lib_foundry.FoundryHelper.compact_databases")
+    @mock.patch("src.charm.host")
+    def test_compact_databases_action(self, host, compact_databases):
+        """Test the compact-databases action reports the compaction."""
+        compact_databases.return_value = {
+            "files": 2,
+            "documents": 10,
+            "bytes_before": 2000,
+            "bytes_after": 1000,
+            "load_seconds_before": 0.125,
+            "load_seconds_after": 0.0625,
+            "failed": ["worlds/broken/data/actors.db"],
+        }
+        self.charm.state.started = True
+        event = mock.Mock(params={})
+        self.charm.on_compact_databases_action(event)
+        host.service_stop.assert_called_with(self.charm.helper.service_name)
+        host.service_start.assert_called_with(self.charm.helper.service_name)
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["bytes-after"], 1000)
+        self.assertEqual(results["failed"], "worlds/broken/data/actors.db")
+        compact_databases.side_effect = PathError("Data path does not exist")
+        event = mock.Mock(params={})
+        self.charm.on_compact_databases_action(event)
+        event.fail.assert_called_with("Data path does not exist")
+        self.assertFalse(event.set_results.called)
+
 
 if __name__ == "__main__":
     unittest.main()
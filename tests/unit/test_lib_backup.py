@@ -0,0 +1,83 @@
+import io
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+from lib_backup import BackupError, BackupStore, chunk_stream, MAX_CHUNK
+
+
+class TestBackupStore(unittest.TestCase):
+    def setUp(self):
+        """Setup a data path and a backup store in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name)
+        self.data_path = self.root / "userdata"
+        (self.data_path / "Data/worlds/test/data").mkdir(parents=True)
+        self.map = os.urandom(3 * 1024 * 1024)
+        (self.data_path / "Data/map.png").write_bytes(self.map)
+        self.db = self.data_path / "Data/worlds/test/data/actors.db"
+        self.db.write_bytes(b'{"_id":"a","name":"Goblin"}\n')
+        os.symlink("worlds", str(self.data_path / "Data/link"))
+        self.store = BackupStore(self.root / "backups")
+
+    def test_chunk_stream(self):
+        """Test chunks are content defined, so an insert only changes nearby chunks."""
+        lines = b"".join(b'{"_id":"%d","x":%d}\n' % (i, i * 7) for i in range(400000))
+        chunks = list(chunk_stream(io.BytesIO(lines)))
+        self.assertEqual(b"".join(chunks), lines)
+        self.assertGreater(len(chunks), 2)
+        self.assertTrue(all(len(chunk) <= MAX_CHUNK for chunk in chunks))
+        shifted = list(chunk_stream(io.BytesIO(b'{"_id":"new"}\n' + lines)))
+        self.assertEqual(shifted[1:], chunks[1:])
+
+    def test_backup_restore(self):
+        """Test a snapshot restores files, symlinks and metadata."""
+        os.chmod(str(self.data_path / "Data/map.png"), 0o600)
+        snapshot, stats = self.store.backup(self.data_path)
+        self.assertEqual(stats["files"], 2)
+        (self.data_path / "Data/map.png").write_bytes(b"broken")
+        (self.data_path / "Data/extra.txt").write_text("extra")
+        self.db.unlink()
+        stats = self.store.restore(snapshot, self.data_path)
+        self.assertEqual(stats["files_written"], 2)
+        self.assertEqual(stats["removed"], 1)
+        self.assertEqual((self.data_path / "Data/map.png").read_bytes(), self.map)
+        self.assertEqual((self.data_path / "Data/map.png").stat().st_mode & 0o777, 0o600)
+        self.assertEqual(os.readlink(str(self.data_path / "Data/link")), "worlds")
+        self.assertFalse((self.data_path / "Data/extra.txt").exists())
+        # Nothing differs from the snapshot any more
+        self.assertEqual(self.store.restore(snapshot, self.data_path)["files_written"], 0)
+
+    def test_backup_incremental(self):
+        """Test unchanged files aren't read and appended records store few chunks."""
+        self.store.backup(self.data_path)
+        _, stats = self.store.backup(self.data_path)
+        self.assertEqual(stats["files_unchanged"], 2)
+        self.assertEqual(stats["bytes_read"], 0)
+        with open(str(self.db), "ab") as db_file:
+            db_file.write(b'{"_id":"a","name":"Hobgoblin"}\n{"_id":"b"')
+        _, stats = self.store.backup(self.data_path)
+        self.assertEqual(stats["files_unchanged"], 1)
+        self.assertEqual(stats["chunks_stored"], 1)
+        snapshot = self.store.snapshots()[-1]
+        restored = self.root / "restored"
+        restored.mkdir()
+        self.store.restore(snapshot, restored)
+        # The record still being appended is left out
+        self.assertTrue(
+            (restored / "Data/worlds/test/data/actors.db").read_bytes().endswith(b"Hobgoblin\"}\n")
+        )
+
+    def test_prune(self):
+        """Test pruning keeps the newest snapshots and the chunks they use."""
+        self.store.backup(self.data_path)
+        (self.data_path / "Data/map.png").write_bytes(os.urandom(1024))
+        self.store.backup(self.data_path)
+        self.assertGreater(self.store.prune(1), 0)
+        self.assertEqual(len(self.store.snapshots()), 1)
+        self.store.restore(self.store.snapshots()[0], self.data_path)
+        with self.assertRaises(BackupError):
+            self.store.restore("missing", self.data_path)
@@ -0,0 +1,59 @@
+import gzip
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+import mock
+from lib_compress import Precompressor
+
+
+class TestPrecompressor(unittest.TestCase):
+    def setUp(self):
+        """Setup a release with static assets in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name)
+        self.release = self.root / "a"
+        self.release.mkdir()
+        self.script = b"function roll() { return Math.random(); }\n" * 200
+        (self.release / "foundry.js").write_bytes(self.script)
+        (self.release / "small.css").write_bytes(b"body {}")
+        (self.release / "map.webp").write_bytes(b"webp" * 1024)
+        (self.release / "random.json").write_bytes(os.urandom(4096))
+        self.names = ["foundry.js", "small.css", "map.webp", "random.json"]
+
+    def test_precompress(self):
+        """Test only compressible files that shrink get siblings."""
+        stats = Precompressor(workers=2).precompress(self.release, self.names)
+        self.assertEqual(gzip.decompress((self.release / "foundry.js.gz").read_bytes()), self.script)
+        self.assertFalse((self.release / "small.css.gz").exists())
+        self.assertFalse((self.release / "map.webp.gz").exists())
+        self.assertFalse((self.release / "random.json.gz").exists())
+        self.assertEqual(stats["files"], 2)
+        self.assertEqual(stats["bytes"], len(self.script) + 4096)
+        self.assertLess(stats["compressed"]["gz"], stats["bytes"])
+
+    def test_precompress_incremental(self):
+        """Test siblings of unchanged files are linked from the previous release."""
+        compressor = Precompressor(workers=2)
+        previous_stats = compressor.precompress(self.release, self.names)
+        release = self.root / "b"
+        release.mkdir()
+        (release / "foundry.js").write_bytes(self.script)
+        (release / "random.json").write_bytes(os.urandom(4096))
+        with mock.patch("lib_compress._gzip", side_effect=AssertionError):
+            stats = compressor.precompress(
+                release,
+                ["foundry.js", "random.json"],
+                previous_root=self.release,
+                previous_stats=previous_stats,
+                unchanged=["foundry.js", "random.json"],
+            )
+        self.assertEqual(stats["linked"], 1)
+        self.assertEqual(
+            (release / "foundry.js.gz").stat().st_ino,
+            (self.release / "foundry.js.gz").stat().st_ino,
+        )
+        self.assertFalse((release / "random.json.gz").exists())
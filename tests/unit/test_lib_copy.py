@@ -0,0 +1,70 @@
+import errno
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+import mock
+from lib_copy import CopyEngine, STRATEGIES
+
+
+class TestCopyEngine(unittest.TestCase):
+    def setUp(self):
+        """Setup a source tree in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name)
+        self.source = self.root / "source"
+        (self.source / "Data/worlds").mkdir(parents=True)
+        self.data = os.urandom(3 * 1024 * 1024 + 7)
+        (self.source / "Data/map.png").write_bytes(self.data)
+        (self.source / "Data/worlds/world.db").write_text("{}")
+        os.chmod(str(self.source / "Data/map.png"), 0o640)
+        os.utime(str(self.source / "Data/map.png"), (1000000000, 1000000000))
+        os.symlink("worlds", str(self.source / "Data/link"))
+
+    def test_copy_file_strategies(self):
+        """Test each strategy copies content and metadata, or falls back."""
+        for strategy in STRATEGIES:
+            engine = CopyEngine(strategies=[strategy, "buffered"])
+            target = self.root / "map-{}.png".format(strategy)
+            used = engine.copy_file(self.source / "Data/map.png", target)
+            self.assertIn(used, (strategy, "buffered"))
+            self.assertEqual(target.read_bytes(), self.data)
+            self.assertEqual(target.stat().st_mode & 0o777, 0o640)
+            self.assertEqual(target.stat().st_mtime, 1000000000)
+
+    def test_unsupported_strategy_not_retried(self):
+        """Test a strategy failing as unsupported is skipped for later files."""
+        engine = CopyEngine(strategies=["reflink", "buffered"])
+        with mock.patch.dict(
+            "lib_copy.COPY_FUNCTIONS",
+            {"reflink": mock.Mock(side_effect=OSError(errno.EOPNOTSUPP, "no"))},
+        ) as functions:
+            engine.copy_file(self.source / "Data/map.png", self.root / "a.png")
+            engine.copy_file(self.source / "Data/map.png", self.root / "b.png")
+            self.assertEqual(functions["reflink"].call_count, 1)
+        self.assertEqual(engine.stats["buffered"], 2)
+        self.assertEqual((self.root / "b.png").read_bytes(), self.data)
+
+    def test_move_across_devices(self):
+        """Test a move falls back to a parallel tree copy when rename fails."""
+        engine = CopyEngine(workers=4)
+        target = self.root / "target"
+        with mock.patch("lib_copy.os.rename", side_effect=OSError(errno.EXDEV, "xdev")):
+            engine.move(self.source / "Data", target)
+        self.assertFalse((self.source / "Data").exists())
+        self.assertEqual((target / "map.png").read_bytes(), self.data)
+        self.assertEqual((target / "worlds/world.db").read_text(), "{}")
+        self.assertEqual(os.readlink(str(target / "link")), "worlds")
+
+    def test_move_same_device(self):
+        """Test a move on the same device is a rename."""
+        engine = CopyEngine()
+        self.assertEqual(engine.move(self.source / "Data", self.root / "target"), 0)
+        self.assertEqual(engine.stats["rename"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
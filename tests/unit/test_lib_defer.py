@@ -0,0 +1,195 @@
+import unittest
+
+import setuppath  # noqa:F401
+from lib_defer import DEFAULT_BACKOFF, DEFAULT_RETRY_LIMIT, deferrable, DeferralTracker, MAX_BACKOFF
+
+
+class Handle:
+    """Stand in for an event handle."""
+
+    def __init__(self, path):
+        """Initialize with the handle path."""
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+
+class Event:
+    """Stand in for an event, counting how often it was deferred."""
+
+    def __init__(self, path):
+        """Initialize with the handle path."""
+        self.handle = Handle(path)
+        self.deferred = 0
+
+    def defer(self):
+        self.deferred += 1
+
+
+class Clock:
+    """Clock which only moves when told to."""
+
+    def __init__(self):
+        """Initialize at time 1000."""
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class Handler:
+    """Stand in for a charm with a deferrable handler."""
+
+    def __init__(self, deferrals):
+        """Initialize with a tracker, the handler defers until ready."""
+        self.deferrals = deferrals
+        self.ready = False
+        self.polling = False
+        self.runs = 0
+
+    @deferrable
+    def on_start(self, event):
+        """Defer until ready."""
+        self.runs += 1
+
+        if self.polling:
+            self.deferrals.poll(event)
+        elif not self.ready:
+            self.deferrals.defer(event)
+
+
+class TestDeferralTracker(unittest.TestCase):
+    def setUp(self):
+        """Setup a tracker on a plain dict with a controlled clock."""
+        self.stored = {}
+        self.clock = Clock()
+        self.tracker = DeferralTracker(self.stored, backoff=10, retry_limit=0, clock=self.clock)
+
+    def test_backoff(self):
+        """Test retries wait twice as long each time, up to the maximum."""
+        event = Event("Charm/on/start[1]")
+        dues = []
+
+        for _ in range(12):
+            self.assertTrue(self.tracker.defer(event))
+            dues.append(self.stored["Charm/on/start"]["due"] - self.clock.now)
+        self.assertEqual(dues[:4], [10, 20, 40, 80])
+        self.assertEqual(dues[-1], MAX_BACKOFF)
+        self.assertEqual(event.deferred, 12)
+
+    def test_one_per_kind(self):
+        """Test a later event of a pending kind replaces it, other kinds are kept."""
+        first = Event("Charm/on/start[1]")
+        self.assertTrue(self.tracker.defer(first))
+        self.assertTrue(self.tracker.defer(first))
+        due = self.stored["Charm/on/start"]["due"]
+        later = Event("Charm/on/start[2]")
+        self.clock.now += 5
+        self.assertTrue(self.tracker.defer(later))
+        self.assertEqual(later.deferred, 1)
+        # The later event takes over the retries and backoff
+        self.assertEqual(
+            self.stored["Charm/on/start"],
+            {"handle": "Charm/on/start[2]", "count": 2, "due": due, "superseded": ["Charm/on/start[1]"]},
+        )
+        self.assertTrue(self.tracker.defer(Event("Charm/on/config_changed[3]")))
+        self.assertEqual(self.stored["Charm/on/config_changed"]["handle"], "Charm/on/config_changed[3]")
+        # Past due, the pending event was already re-emitted and dropped
+        self.clock.now += 100
+        latest = Event("Charm/on/start[4]")
+        self.assertTrue(self.tracker.defer(latest))
+        self.assertEqual(self.stored["Charm/on/start"]["handle"], "Charm/on/start[4]")
+        self.assertEqual(self.stored["Charm/on/start"]["count"], 1)
+
+    def test_superseded(self):
+        """Test a replaced event is dropped when re-emitted and the latest one runs."""
+        handler = Handler(self.tracker)
+        first = Event("Charm/on/start[1]")
+        handler.on_start(first)
+        later = Event("Charm/on/start[2]")
+        handler.on_start(later)
+        self.assertEqual((handler.runs, first.deferred, later.deferred), (2, 1, 1))
+        # The next hook re-emits both, the replaced one is not deferred again
+        self.clock.now += 10
+        handler.ready = True
+        handler.on_start(first)
+        self.assertEqual((handler.runs, first.deferred), (2, 1))
+        handler.on_start(later)
+        self.assertEqual((handler.runs, later.deferred), (3, 1))
+        self.assertEqual(self.stored, {})
+
+    def test_retry_limit(self):
+        """Test an event is dropped once it ran out of retries."""
+        self.tracker.retry_limit = 2
+        event = Event("Charm/on/start[1]")
+        self.assertTrue(self.tracker.defer(event))
+        self.assertTrue(self.tracker.defer(event))
+        with self.assertLogs(level="WARNING"):
+            self.assertFalse(self.tracker.defer(event))
+        self.assertEqual(event.deferred, 2)
+        self.assertEqual(self.stored, {})
+
+    def test_deferrable(self):
+        """Test the handler only runs once the retry is due, and the event is then forgotten."""
+        handler = Handler(self.tracker)
+        event = Event("Charm/on/start[1]")
+        handler.on_start(event)
+        self.assertEqual((handler.runs, event.deferred), (1, 1))
+        # Re-emitted by a hook before it is due
+        self.clock.now += 5
+        handler.on_start(event)
+        self.assertEqual((handler.runs, event.deferred), (1, 2))
+        self.assertEqual(self.stored["Charm/on/start"]["count"], 1)
+        self.clock.now += 5
+        handler.ready = True
+        handler.on_start(event)
+        self.assertEqual((handler.runs, event.deferred), (2, 2))
+        self.assertEqual(self.stored, {})
+
+    def test_retry_now(self):
+        """Test pending events are retried on the next hook with their backoff reset."""
+        event = Event("Charm/on/start[1]")
+        self.tracker.defer(event)
+        self.tracker.defer(event)
+        self.tracker.retry_now()
+        self.assertFalse(self.tracker.backing_off("Charm/on/start", "Charm/on/start[1]"))
+        self.tracker.defer(event)
+        self.assertEqual(self.stored["Charm/on/start"]["due"], self.clock.now + 10)
+
+    def test_poll(self):
+        """Test a polled event runs on every hook without backing off or using up retries."""
+        self.tracker.retry_limit = 1
+        handler = Handler(self.tracker)
+        event = Event("Charm/on/start[1]")
+        handler.on_start(event)
+        self.assertIn("Charm/on/start", self.stored)
+        # Past due, the job started by the retry is then polled
+        self.clock.now += 10
+        handler.polling = True
+
+        for runs in range(2, 5):
+            handler.on_start(event)
+            self.assertEqual((handler.runs, event.deferred), (runs, runs))
+        self.assertEqual(self.stored["Charm/on/start"]["count"], 1)
+        # The job failing again uses up the retry left
+        handler.polling = False
+        with self.assertLogs(level="WARNING"):
+            handler.on_start(event)
+        self.assertEqual(self.stored, {})
+
+    def test_defaults(self):
+        """Test by default retries back off and are limited."""
+        tracker = DeferralTracker(self.stored, clock=self.clock)
+        self.assertEqual((tracker.backoff, tracker.retry_limit), (DEFAULT_BACKOFF, DEFAULT_RETRY_LIMIT))
+        self.assertGreater(tracker.backoff, 0)
+        self.assertGreater(tracker.retry_limit, 0)
+
+    def test_every_hook(self):
+        """Test without a backoff a deferred event is retried on the next hook."""
+        tracker = DeferralTracker(self.stored, backoff=0, clock=self.clock)
+        handler = Handler(tracker)
+        event = Event("Charm/on/start[1]")
+        handler.on_start(event)
+        handler.on_start(event)
+        self.assertEqual((handler.runs, event.deferred), (2, 2))
@@ -0,0 +1,676 @@
+import errno
+import json
+import os
+from pathlib import Path
+import tempfile
+from types import SimpleNamespace
+import unittest
+import zipfile
+
+import setuppath  # noqa:F401
+import mock
+from lib_copy import CopyEngine
+from lib_foundry import FoundryHelper, MigrationProgress, PathError, TIER_SUBTREES, tree_size
+
+
+class TestFoundryHelper(unittest.TestCase):
+    def setUp(self):
+        """Setup a helper installing into a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name)
+        self.state = SimpleNamespace(
+            current_data_path=False, apt_source_digest=None, pinned_release=None
+        )
+        self.helper = FoundryHelper({}, self.state)
+        self.helper.install_path = self.root / "vtt"
+        self.helper.default_data_path = self.root / "userdata"
+        operation_patcher = mock.patch("lib_metrics.record_operation")
+        self.record_operation = operation_patcher.start()
+        self.addCleanup(operation_patcher.stop)
+
+    def make_zip(self, name, members):
+        """Create a zip file with the given member names and contents."""
+        zip_path = self.root / name
+        with zipfile.ZipFile(str(zip_path), "w") as zip_ref:
+            for member, content in members.items():
+                zip_ref.writestr(member, content)
+
+        return zip_path
+
+    def test_install_zip(self):
+        """Test a fresh install extracts every member and writes a manifest."""
+        zip_path = self.make_zip("a.zip", {"resources/app/main.js": "main"})
+        self.assertTrue(self.helper.install_zip(zip_path))
+        main_js = self.helper.current_path / "resources/app/main.js"
+        self.assertEqual(main_js.read_text(), "main")
+        manifest = self.helper.read_manifest(self.helper.current_release)
+        self.assertIn("resources/app/main.js", manifest["members"])
+        self.assertEqual(self.state.current_data_path, str(self.helper.default_data_path))
+
+    def test_install_zip_unchanged(self):
+        """Test re-installing the same resource does not touch the install."""
+        zip_path = self.make_zip("a.zip", {"resources/app/main.js": "main"})
+        self.helper.install_zip(zip_path)
+        main_js = self.helper.current_path / "resources/app/main.js"
+        main_js.write_text("local")
+        self.assertFalse(self.helper.install_zip(zip_path))
+        self.assertEqual(main_js.read_text(), "local")
+
+    def test_install_zip_incremental(self):
+        """Test a new release only writes, replaces and removes changed members."""
+        self.helper.install_zip(
+            self.make_zip(
+                "a.zip",
+                {"same.js": "same", "changed.js": "old", "removed/old.js": "gone"},
+            )
+        )
+        current = self.helper.current_path
+        same_inode = (current / "same.js").stat().st_ino
+        self.helper.install_zip(
+            self.make_zip("b.zip", {"same.js": "same", "changed.js": "new", "new.js": "new"})
+        )
+        # Unchanged members are linked from the previous release, not rewritten
+        self.assertEqual((current / "same.js").stat().st_ino, same_inode)
+        self.assertEqual((current / "changed.js").read_text(), "new")
+        self.assertEqual((current / "new.js").read_text(), "new")
+        self.assertFalse((current / "removed").exists())
+
+    def test_install_zip_parallel(self):
+        """Test extraction with a pool of workers installs every member."""
+        self.helper.charm_config = {"extract_workers": 4}
+        members = {"public/{}.js".format(i): "file {}".format(i) for i in range(50)}
+        self.helper.install_zip(self.make_zip("a.zip", members))
+
+        for member, content in members.items():
+            self.assertEqual((self.helper.current_path / member).read_text(), content)
+
+    def test_install_zip_parallel_bad_crc(self):
+        """Test a corrupt member fails the parallel extraction with BadZipFile."""
+        self.helper.charm_config = {"extract_workers": 4}
+        members = {"public/{}.js".format(i): "file {:04}".format(i) for i in range(10)}
+        zip_path = self.make_zip("a.zip", members)
+        zip_path.write_bytes(zip_path.read_bytes().replace(b"file 0007", b"file 9999"))
+        with self.assertRaises(zipfile.BadZipFile):
+            self.helper.install_zip(zip_path)
+
+    def test_install_zip_parallel_traversal(self):
+        """Test members naming parent directories are extracted inside the slot."""
+        self.helper.charm_config = {"extract_workers": 4}
+        members = {"../../escape/{}.js".format(i): "file {}".format(i) for i in range(4)}
+        self.helper.install_zip(self.make_zip("a.zip", members))
+        self.assertFalse((self.helper.install_path / "escape").exists())
+        self.assertFalse((self.root / "escape").exists())
+        self.assertEqual((self.helper.current_path / "escape/0.js").read_text(), "file 0")
+
+    def test_install_zip_bad_crc_keeps_current(self):
+        """Test a failed extraction leaves the running release active."""
+        self.helper.install_zip(self.make_zip("a.zip", {"main.js": "file 0001"}))
+        release = self.helper.current_release
+        zip_path = self.make_zip("b.zip", {"main.js": "file 0002"})
+        zip_path.write_bytes(zip_path.read_bytes().replace(b"file 0002", b"file 9999"))
+        with self.assertRaises(zipfile.BadZipFile):
+            self.helper.install_zip(zip_path)
+        self.assertEqual(self.helper.current_release, release)
+        self.assertEqual((self.helper.current_path / "main.js").read_text(), "file 0001")
+
+    def test_release_rollback_and_retention(self):
+        """Test rolling back to the previous release and pruning old ones."""
+        self.helper.charm_config = {"release_retention": 2}
+        releases = []
+
+        for version in range(3):
+            self.helper.install_zip(
+                self.make_zip("{}.zip".format(version), {"main.js": str(version)})
+            )
+            releases.append(self.helper.current_release)
+        self.assertEqual(self.helper.releases(), [releases[2], releases[1]])
+        self.assertEqual(self.helper.rollback_release(), releases[1])
+        self.assertEqual((self.helper.current_path / "main.js").read_text(), "1")
+
+    def test_rollback_pinned_until_new_resource(self):
+        """Test upgrade-charm keeps a rolled back release until a new resource is attached."""
+        self.helper.charm_config = {"release_retention": 2}
+        first = self.make_zip("0.zip", {"main.js": "0"})
+        attached = self.make_zip("1.zip", {"main.js": "1"})
+        self.helper.install_zip(first)
+        rolled_back = self.helper.current_release
+        self.helper.install_zip(attached)
+        self.assertEqual(self.helper.rollback_release(), rolled_back)
+        # upgrade-charm installs the attached resource again
+        self.assertFalse(self.helper.install_zip(attached))
+        self.assertEqual(self.helper.current_release, rolled_back)
+        self.assertTrue(self.helper.install_zip(self.make_zip("2.zip", {"main.js": "2"})))
+        self.assertEqual((self.helper.current_path / "main.js").read_text(), "2")
+        self.assertIsNone(self.state.pinned_release)
+
+    def test_adopt_legacy_install(self):
+        """Test an install made before release slots is moved into one."""
+        legacy_main = self.helper.install_path / "resources/app/main.js"
+        legacy_main.parent.mkdir(parents=True)
+        legacy_main.write_text("legacy")
+        self.assertTrue(self.helper.adopt_legacy_install())
+        self.assertEqual(self.helper.current_release, "legacy")
+        self.assertEqual(
+            (self.helper.current_path / "resources/app/main.js").read_text(), "legacy"
+        )
+        self.assertFalse(self.helper.adopt_legacy_install())
+
+    def make_data(self, files):
+        """Populate the current data path with the given files."""
+        data_path = self.helper.default_data_path
+        self.state.current_data_path = str(data_path)
+
+        for name, content in files.items():
+            (data_path / name).parent.mkdir(parents=True, exist_ok=True)
+            (data_path / name).write_text(content)
+
+        return data_path
+
+    def test_migrate_data_live(self):
+        """Test a pre-copied migration only syncs what changed since the copy."""
+        data_path = self.make_data({"Data/worlds/a/data.db": "a", "Config/options.json": "{}"})
+        target = self.root / "custom"
+        target.mkdir()
+        self.helper.charm_config = {"custom_data_path": str(target), "data_migration_mode": "live"}
+        self.assertTrue(self.helper.live_migration)
+        self.helper.presync_data()
+        self.assertEqual((target / "Data/worlds/a/data.db").read_text(), "a")
+        # Changes made by the running service after the pre-copy
+        (data_path / "Data/worlds/a/data.db").write_text("changed")
+        (data_path / "Data/worlds/b").mkdir()
+        (data_path / "Data/worlds/b/data.db").write_text("b")
+        (data_path / "Config/options.json").unlink()
+        self.helper.migrate_data(presynced=True)
+        self.assertEqual((target / "Data/worlds/a/data.db").read_text(), "changed")
+        self.assertEqual((target / "Data/worlds/b/data.db").read_text(), "b")
+        self.assertFalse((target / "Config/options.json").exists())
+        self.assertEqual(list(data_path.iterdir()), [])
+        self.assertEqual(self.state.current_data_path, str(target))
+
+    def test_migrate_data_live_same_times(self):
+        """Test a file rewritten during the pre-copy is synced though its size and mtime match."""
+        data_path = self.make_data({"Data/worlds/a/data.db": "old"})
+        target = self.root / "custom"
+        target.mkdir()
+        self.helper.charm_config = {"custom_data_path": str(target), "data_migration_mode": "live"}
+        self.helper.presync_data()
+        # Rewritten after its content was copied, before its times were
+        source = data_path / "Data/worlds/a/data.db"
+        source_stat = source.stat()
+        source.write_text("new")
+        os.utime(str(source), ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        self.helper.migrate_data(presynced=True)
+        self.assertEqual((target / "Data/worlds/a/data.db").read_text(), "new")
+
+    def test_migrate_data(self):
+        """Test an offline migration moves every item to the new path."""
+        data_path = self.make_data({"Data/worlds/a/data.db": "a", "Config/options.json": "{}"})
+        target = self.root / "custom"
+        target.mkdir()
+        self.helper.charm_config = {"custom_data_path": str(target)}
+        self.helper.migrate_data()
+        self.assertEqual((target / "Data/worlds/a/data.db").read_text(), "a")
+        self.assertEqual(list(data_path.iterdir()), [])
+        self.assertEqual(self.state.current_data_path, str(target))
+
+    def test_migrate_data_resume(self):
+        """Test an interrupted migration resumes instead of failing on a non-empty target."""
+        data_path = self.make_data({"a/data.db": "a", "b/data.db": "b", "c/data.db": "c"})
+        target = self.root / "custom"
+        target.mkdir()
+        self.helper.charm_config = {"custom_data_path": str(target)}
+        move = CopyEngine.move
+        calls = []
+
+        def interrupted_move(engine, source, destination, **kwargs):
+            calls.append(source.name)
+
+            if len(calls) == 2:
+                raise OSError("Killed")
+
+            return move(engine, source, destination, **kwargs)
+
+        with mock.patch.object(CopyEngine, "move", interrupted_move):
+            with self.assertRaises(OSError):
+                self.helper.migrate_data()
+        self.assertTrue(self.helper.migration_journal.exists())
+        self.assertEqual(self.state.current_data_path, str(data_path))
+        messages = []
+        self.helper.migrate_data(status=messages.append)
+        self.assertEqual(sorted(item.name for item in target.iterdir()), ["a", "b", "c"])
+        self.assertEqual(list(data_path.iterdir()), [])
+        self.assertEqual(self.state.current_data_path, str(target))
+        self.helper.finish_migration()
+        self.assertFalse(self.helper.migration_journal.exists())
+
+    def test_migrate_data_resume_removal(self):
+        """Test a cross-device move interrupted while removing its source keeps every file."""
+        data_path = self.make_data({"Data/a": "a", "Data/b": "b", "Data/c": "c"})
+        target = self.root / "custom"
+        target.mkdir()
+        self.helper.charm_config = {"custom_data_path": str(target)}
+        rename = os.rename
+
+        def cross_device(source, destination):
+            if str(source).startswith(str(data_path)):
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(source, destination)
+
+        def interrupted_rmtree(path):
+            (Path(path) / "a").unlink()
+            (Path(path) / "b").unlink()
+            raise OSError("Killed")
+
+        with mock.patch("os.rename", cross_device):
+            with mock.patch("shutil.rmtree", interrupted_rmtree):
+                with self.assertRaises(OSError):
+                    self.helper.migrate_data()
+            self.assertEqual(sorted(item.name for item in (data_path / "Data").iterdir()), ["c"])
+            self.helper.migrate_data()
+        self.assertEqual(
+            sorted(item.name for item in (target / "Data").iterdir()), ["a", "b", "c"]
+        )
+        self.assertEqual((target / "Data/a").read_text(), "a")
+        self.assertEqual(list(data_path.iterdir()), [])
+
+    def test_migration_progress(self):
+        """Test the migration progress message."""
+        messages = []
+        progress = MigrationProgress(40 * 10 ** 9, 12 * 10 ** 9, status=messages.append, interval=0)
+        progress.start -= 10
+        progress.add(1800 * 10 ** 6)
+        self.assertEqual(messages, ["Relocating data: 13.8 GB / 40.0 GB, 180.0 MB/s, ETA 145s"])
+
+    def test_presync_data_not_empty(self):
+        """Test pre-copying refuses a destination which is not empty."""
+        self.make_data({"Data/file": "a"})
+        target = self.root / "custom"
+        (target / "other").mkdir(parents=True)
+        self.helper.charm_config = {"custom_data_path": str(target)}
+        with self.assertRaises(PathError):
+            self.helper.presync_data()
+
+    @mock.patch("lib_foundry.fetch.apt_update")
+    @mock.patch("lib_foundry.fetch.add_source")
+    @mock.patch("lib_foundry.host.get_distrib_codename", return_value="bionic")
+    def test_add_sources_unchanged(self, codename, add_source, apt_update):
+        """Test the apt source is only added and updated when it changes."""
+        self.helper.apt_sources_path = self.root / "apt"
+        (self.helper.apt_sources_path / "sources.list.d").mkdir(parents=True)
+        self.helper.charm_config = {"node_repo": "https://deb.nodesource.com", "node_repo_key": "key"}
+        self.assertTrue(self.helper.add_sources())
+        apt_line = add_source.call_args[0][0]
+        (self.helper.apt_sources_path / "sources.list.d/node.list").write_text(apt_line + "\n")
+        self.assertFalse(self.helper.add_sources())
+        self.assertEqual(apt_update.call_count, 1)
+        self.helper.charm_config["node_repo_key"] = "new key"
+        self.assertTrue(self.helper.add_sources())
+        self.assertEqual(apt_update.call_count, 2)
+
+    @mock.patch("lib_foundry.fetch.apt_install")
+    def test_install_dependencies_installed(self, apt_install):
+        """Test apt install is skipped when the expected versions are installed."""
+        installed = {"nodejs": "12.18.3-1nodesource1", "libssl-dev": "1.1.1-1ubuntu2.1~18.04.6"}
+        with mock.patch.object(FoundryHelper, "installed_versions", return_value=installed):
+            self.helper.install_dependencies()
+            self.assertFalse(apt_install.called)
+            installed["nodejs"] = "10.19.0~dfsg-3ubuntu1"
+            self.helper.install_dependencies()
+            self.assertTrue(apt_install.called)
+
+    @mock.patch("lib_foundry.fetch.apt_install")
+    def test_install_dependencies_deb_cache(self, apt_install):
+        """Test dependencies are installed from a local .deb cache."""
+        cache = self.root / "debs"
+        cache.mkdir()
+        (cache / "nodejs_12.18.3_amd64.deb").touch()
+        self.helper.charm_config = {"deb_cache_path": str(cache)}
+        self.assertFalse(self.helper.add_sources())
+        with mock.patch.object(FoundryHelper, "installed_versions", return_value={}):
+            self.helper.install_dependencies()
+        self.assertEqual(apt_install.call_args[0][0], [str(cache / "nodejs_12.18.3_amd64.deb")])
+        self.assertIn("--no-download", apt_install.call_args[1]["options"])
+
+    @mock.patch("os.fchown")
+    @mock.patch.dict("os.environ", {"JUJU_CHARM_DIR": "."})
+    def test_render_systemd_service(self, fchown):
+        """Test the service file is only written when its content changes."""
+        self.helper.service_file = self.root / "foundryvtt.service"
+        self.state.current_data_path = "/opt/foundry/userdata"
+        self.assertTrue(self.helper.render_systemd_service())
+        self.assertIn("--dataPath=/opt/foundry/userdata", self.helper.service_file.read_text())
+        mtime = self.helper.service_file.stat().st_mtime_ns
+        self.assertFalse(self.helper.render_systemd_service())
+        self.assertEqual(self.helper.service_file.stat().st_mtime_ns, mtime)
+        self.state.current_data_path = "/srv/foundry"
+        self.assertTrue(self.helper.render_systemd_service())
+
+    @mock.patch("os.fchown")
+    @mock.patch.dict("os.environ", {"JUJU_CHARM_DIR": "."})
+    def test_render_runtime_tuning(self, fchown):
+        """Test runtime tuning is rendered into the service file."""
+        self.helper.service_file = self.root / "foundryvtt.service"
+        self.state.current_data_path = "/opt/foundry/userdata"
+        self.helper.render_systemd_service()
+        content = self.helper.service_file.read_text()
+        self.assertIn("ExecStart=/usr/bin/node {}/resources".format(self.helper.current_path), content)
+        self.assertNotIn("Environment=", content)
+        self.helper.charm_config = {
+            "node_heap_size": "auto",
+            "uv_threadpool_size": "16",
+            "node_options": "--trace-gc",
+        }
+        with mock.patch.object(FoundryHelper, "host_memory_mb", return_value=8192):
+            self.assertTrue(self.helper.render_systemd_service())
+        content = self.helper.service_file.read_text()
+        self.assertIn("ExecStart=/usr/bin/node --max-old-space-size=4096 ", content)
+        self.assertIn("Environment=UV_THREADPOOL_SIZE=16\n", content)
+        self.assertIn('Environment="NODE_OPTIONS=--trace-gc"\n', content)
+
+    @mock.patch("os.fchown")
+    @mock.patch("subprocess.check_call")
+    @mock.patch.dict("os.environ", {"JUJU_CHARM_DIR": "."})
+    def test_resource_controls(self, check_call, fchown):
+        """Test resource controls are rendered to a drop-in and applied at runtime."""
+        self.helper.service_file = self.root / "foundryvtt.service"
+        self.assertEqual(self.helper.render_resource_controls(), {})
+        self.assertFalse(self.helper.resource_dropin.exists())
+
+        self.helper.charm_config = {"resource_profile": "latency", "memory_max": "2G"}
+        changed = self.helper.render_resource_controls()
+        self.assertEqual(changed["CPUWeight"], "1000")
+        self.assertEqual(changed["MemoryMax"], "2G")
+        self.assertIn("Nice=-5\n", self.helper.resource_dropin.read_text())
+        # Nice can only be changed by restarting the service
+        self.assertFalse(self.helper.apply_resource_controls(changed))
+        check_call.assert_not_called()
+
+        self.helper.charm_config["memory_max"] = "3G"
+        self.helper.charm_config["cpu_weight"] = "500"
+        changed = self.helper.render_resource_controls()
+        self.assertEqual(changed, {"MemoryMax": "3G", "CPUWeight": "500"})
+        self.assertTrue(self.helper.apply_resource_controls(changed))
+        check_call.assert_called_once_with(
+            [
+                "systemctl",
+                "set-property",
+                "--runtime",
+                "foundryvtt.service",
+                "CPUWeight=500",
+                "MemoryMax=3G",
+            ]
+        )
+
+        self.helper.charm_config = {}
+        changed = self.helper.render_resource_controls()
+        self.assertIsNone(changed["MemoryMax"])
+        self.assertFalse(self.helper.resource_dropin.exists())
+        self.assertFalse(self.helper.apply_resource_controls(changed))
+
+    @mock.patch("os.fchown")
+    @mock.patch("subprocess.check_call")
+    @mock.patch.dict("os.environ", {"JUJU_CHARM_DIR": "."})
+    def test_instance_resource_controls(self, check_call, fchown):
+        """Test instance resource controls change in a drop-in, leaving the template alone."""
+        self.helper.instance_service_file = self.root / "foundryvtt@.service"
+        self.helper.instance_config_path = self.root / "instances"
+        self.assertEqual(self.helper.render_instance_resource_controls(), {})
+        self.helper.charm_config = {"instances": "one", "cpu_weight": "200"}
+        self.helper.render_instance_service()
+        template = self.helper.instance_service_file.read_text()
+        self.assertNotIn("CPUWeight", template)
+        self.assertEqual(self.helper.render_instance_resource_controls(), {"CPUWeight": "200"})
+        self.helper.charm_config["cpu_weight"] = "300"
+        changed = self.helper.render_instance_resource_controls()
+        self.assertIn("CPUWeight=300\n", self.helper.instance_resource_dropin.read_text())
+        self.assertFalse(self.helper.render_instance_service())
+        self.assertTrue(self.helper.apply_resource_controls(changed, self.helper.instance_service("one")))
+        check_call.assert_called_once_with(
+            ["systemctl", "set-property", "--runtime", "foundryvtt@one.service", "CPUWeight=300"]
+        )
+
+    @mock.patch("os.fchown")
+    @mock.patch.dict("os.environ", {"JUJU_CHARM_DIR": "."})
+    def test_sync_instances(self, fchown):
+        """Test instances are added and removed without changing the others."""
+        self.helper.instance_service_file = self.root / "foundryvtt@.service"
+        self.helper.instance_config_path = self.root / "instances"
+        self.helper.instances_data_path = self.root / "instance_data"
+        self.assertFalse(self.helper.render_instance_service())
+        self.assertEqual(self.helper.sync_instances(), ([], []))
+
+        self.helper.charm_config = {"instances": "one two Bad_Name", "instance_base_port": 31000}
+        self.assertTrue(self.helper.render_instance_service())
+        content = self.helper.instance_service_file.read_text()
+        self.assertIn("EnvironmentFile={}/%i.env".format(self.helper.instance_config_path), content)
+        self.assertIn("--port=${FOUNDRY_PORT}", content)
+        self.assertEqual(self.helper.sync_instances(), (["one", "two"], []))
+        self.assertEqual(self.helper.instances(), {"one": 31000, "two": 31001})
+        self.assertTrue((self.helper.instances_data_path / "two").is_dir())
+
+        self.helper.charm_config["instances"] = "two,three"
+        self.assertEqual(self.helper.sync_instances(), (["three"], ["one"]))
+        # The freed port is reused and the remaining instance keeps its port
+        self.assertEqual(self.helper.instances(), {"three": 31000, "two": 31001})
+        self.assertTrue((self.helper.instances_data_path / "one").is_dir())
+
+    def test_render_server_options(self):
+        """Test managed options are merged into options.json, keeping the others."""
+        self.state.current_data_path = str(self.root / "data")
+        self.helper.charm_config = {"compress_static": True, "proxy_port": 443}
+        options_file = self.helper.options_file
+        options_file.parent.mkdir(parents=True)
+        options_file.write_text('{"port": 30000, "language": "de.core", "upnp": true}')
+        changed = self.helper.render_server_options()
+        self.assertEqual(
+            changed,
+            {
+                "compressStatic": True,
+                "compressSocket": False,
+                "upnp": False,
+                "proxyPort": None,
+                "proxySSL": False,
+            },
+        )
+        options = json.loads(options_file.read_text())
+        self.assertEqual(options["language"], "de.core")
+        self.assertEqual(options["port"], 30000)
+        self.assertEqual(self.helper.render_server_options(), {})
+
+        self.helper.charm_config["foundry_port"] = 30100
+        self.assertEqual(
+            self.helper.render_server_options(proxied=True),
+            {"port": 30100, "proxyPort": 443, "proxySSL": True},
+        )
+
+    @mock.patch("os.fchown")
+    @mock.patch("subprocess.call")
+    @mock.patch.dict("os.environ", {"JUJU_CHARM_DIR": "."})
+    def test_render_exporter(self, call, fchown):
+        """Test the exporter is off by default and listens on the address it is given."""
+        self.helper.systemd_path = self.root
+        self.assertFalse(self.helper.render_exporter("/charm"))
+        self.assertFalse((self.root / "foundryvtt-exporter.service").exists())
+        self.helper.charm_config = {"metrics_port": 9110}
+        self.assertTrue(self.helper.render_exporter("/charm"))
+        content = (self.root / "foundryvtt-exporter.service").read_text()
+        self.assertIn("--port=9110 --address=127.0.0.1 ", content)
+        self.assertTrue(self.helper.render_exporter("/charm", "10.0.0.5"))
+        content = (self.root / "foundryvtt-exporter.service").read_text()
+        self.assertIn("--port=9110 --address=10.0.0.5 ", content)
+
+    @mock.patch("os.fchown")
+    @mock.patch("subprocess.call")
+    @mock.patch.dict("os.environ", {"JUJU_CHARM_DIR": "."})
+    def test_render_compaction_schedule(self, call, fchown):
+        """Test the compaction timer is installed and removed with the schedule."""
+        self.helper.systemd_path = self.root
+        self.assertFalse(self.helper.render_compaction_schedule("/charm"))
+        self.helper.charm_config = {"compaction_schedule": "Mon *-*-* 04:00:00"}
+        self.assertTrue(self.helper.render_compaction_schedule("/charm"))
+        self.assertIn(
+            "OnCalendar=Mon *-*-* 04:00:00", (self.root / "foundryvtt-compact-job.timer").read_text()
+        )
+        self.assertIn(
+            "/charm/src/foundry_job.py compact",
+            (self.root / "foundryvtt-compact-job.service").read_text(),
+        )
+        self.assertFalse(self.helper.render_compaction_schedule("/charm"))
+        self.helper.charm_config = {}
+        self.assertTrue(self.helper.render_compaction_schedule("/charm"))
+        self.assertFalse((self.root / "foundryvtt-compact-job.timer").exists())
+        call.assert_any_call(["systemctl", "disable", "--now", "foundryvtt-compact-job.timer"])
+
+    @mock.patch("os.fchown")
+    @mock.patch("subprocess.call")
+    @mock.patch("shutil.which", return_value="/usr/bin/rsync")
+    @mock.patch.dict("os.environ", {"JUJU_CHARM_DIR": "."})
+    def test_render_replication_target(self, which, call, fchown):
+        """Test the standby timer is rendered from config and removed again."""
+        self.helper.systemd_path = self.root
+        self.helper.replication_path = self.root / "replication"
+        self.state.current_data_path = str(self.root / "data")
+        self.helper.charm_config = {"replication_interval": 30, "replication_bwlimit": 512}
+        self.assertTrue(self.helper.render_replication_target("10.0.0.1", "secret"))
+        service = (self.root / "foundryvtt-replicate.service").read_text()
+        self.assertIn("--bwlimit=512", service)
+        self.assertIn("rsync://foundry@10.0.0.1:8730/foundry-data/ {}/".format(self.root / "data"), service)
+        self.assertIn("OnUnitInactiveSec=30", (self.root / "foundryvtt-replicate.timer").read_text())
+        self.assertEqual((self.helper.replication_path / "rsync.password").read_text(), "secret\n")
+        self.assertFalse(self.helper.render_replication_target("10.0.0.1", "secret"))
+        self.assertTrue(self.helper.stop_replication_target())
+        self.assertFalse((self.root / "foundryvtt-replicate.timer").exists())
+        call.assert_any_call(["systemctl", "disable", "--now", "foundryvtt-replicate.timer"])
+
+    def test_relocate_tiers(self):
+        """Test each subtree is only moved when its own tier changes."""
+        data_path = self.root / "userdata"
+        (data_path / "Data/worlds/test").mkdir(parents=True)
+        (data_path / "Data/worlds/test/world.json").write_text("{}")
+        (data_path / "Data/systems/dnd5e").mkdir(parents=True)
+        self.state.current_data_path = str(data_path)
+        self.assertEqual(self.helper.tier_moves(), [])
+
+        fast = self.root / "nvme"
+        self.helper.charm_config = {"worlds_path": str(fast)}
+        self.assertEqual(
+            self.helper.tier_moves(),
+            [("Data/worlds", data_path / "Data/worlds", fast / "worlds")],
+        )
+        self.helper.relocate_tiers()
+        self.assertEqual(os.readlink(str(data_path / "Data/worlds")), str(fast / "worlds"))
+        self.assertEqual((data_path / "Data/worlds/test/world.json").read_text(), "{}")
+        self.assertTrue((data_path / "Data/systems/dnd5e").is_dir())
+        self.assertFalse(self.helper.tier_journal.exists())
+        self.assertEqual(self.helper.tier_moves(), [])
+
+        bulk = self.root / "bulk"
+        self.helper.charm_config["assets_path"] = str(bulk)
+        self.helper.relocate_tiers()
+        self.assertTrue((bulk / "assets").is_dir())
+        self.assertTrue((data_path / "Data/assets").is_symlink())
+
+        del self.helper.charm_config["worlds_path"]
+        self.helper.relocate_tiers()
+        self.assertFalse((data_path / "Data/worlds").is_symlink())
+        self.assertEqual((data_path / "Data/worlds/test/world.json").read_text(), "{}")
+        self.assertFalse((fast / "worlds").exists())
+        self.assertTrue((data_path / "Data/assets").is_symlink())
+
+    @mock.patch("os.rename")
+    def test_relocate_tiers_resume(self, rename):
+        """Test an interrupted relocation resumes without losing data."""
+        data_path = self.root / "userdata"
+        (data_path / "Data/worlds/test").mkdir(parents=True)
+        (data_path / "Data/worlds/test/world.json").write_text("{}")
+        self.state.current_data_path = str(data_path)
+        self.helper.charm_config = {"worlds_path": str(self.root / "nvme")}
+        rename.side_effect = OSError("interrupted")
+        with self.assertRaises(OSError):
+            self.helper.relocate_tiers()
+        self.assertTrue(self.helper.tier_journal.exists())
+        self.assertEqual((data_path / "Data/worlds/test/world.json").read_text(), "{}")
+        rename.side_effect = os.replace
+        self.helper.relocate_tiers()
+        self.assertEqual((data_path / "Data/worlds/test/world.json").read_text(), "{}")
+        self.assertTrue((data_path / "Data/worlds").is_symlink())
+
+    @mock.patch("lib_foundry.fetch")
+    def test_tiers_walked(self, fetch):
+        """Test compaction, backups, restores and sizes reach into a relocated tier."""
+        data_path = self.root / "userdata"
+        world = data_path / "Data/worlds/test"
+        (world / "data").mkdir(parents=True)
+        (world / "data/actors.db").write_text('{"_id":"a","n":1}\n{"_id":"a","n":2}\n')
+        (world / "world.json").write_text("{}")
+        self.state.current_data_path = str(data_path)
+        tier = self.root / "nvme"
+        self.helper.charm_config = {"worlds_path": str(tier), "backup_path": str(self.root / "backups")}
+        self.helper.relocate_tiers()
+        self.assertTrue((data_path / "Data/worlds").is_symlink())
+        self.assertEqual(self.helper.compact_databases()["files"], 1)
+        self.assertEqual((tier / "worlds/test/data/actors.db").read_text().count("\n"), 1)
+        self.assertEqual(tree_size(data_path, TIER_SUBTREES), tree_size(tier))
+
+        snapshot, stats = self.helper.backup_data()
+        self.assertEqual(stats["files"], 2)
+        (world / "world.json").unlink()
+        (world / "data/actors.db").write_text("changed")
+        self.helper.restore_data(snapshot)
+        self.assertTrue((data_path / "Data/worlds").is_symlink())
+        self.assertEqual((tier / "worlds/test/world.json").read_text(), "{}")
+        self.assertEqual((tier / "worlds/test/data/actors.db").read_text().count("\n"), 1)
+
+    @mock.patch("os.cpu_count", return_value=64)
+    def test_runtime_tuning_auto(self, cpu_count):
+        """Test auto tuning is derived from and bounded by the host."""
+        self.helper.charm_config = {"node_heap_size": "auto", "uv_threadpool_size": "auto"}
+        with mock.patch.object(FoundryHelper, "host_memory_mb", return_value=512):
+            tuning = self.helper.runtime_tuning()
+        self.assertEqual(tuning["heap_size_mb"], 512)
+        self.assertEqual(tuning["uv_threadpool_size"], 64)
+        # The heap is shared with as many instances as configured room for,
+        # however many run
+        for instances in ("", "one", "one two three"):
+            self.helper.charm_config = {
+                "node_heap_size": "auto",
+                "auto_heap_instances": 3,
+                "instances": instances,
+            }
+            with mock.patch.object(FoundryHelper, "host_memory_mb", return_value=16384):
+                self.assertEqual(self.helper.runtime_tuning()["heap_size_mb"], 2048)
+        self.helper.charm_config = {"node_heap_size": "lots"}
+        self.assertIsNone(self.helper.runtime_tuning()["heap_size_mb"])
+
+    def test_install_precompress(self):
+        """Test static assets of each release are precompressed."""
+        script = "function roll() { return Math.random(); }\n" * 200
+        self.helper.charm_config = {"precompress_assets": True}
+        self.helper.install_zip(
+            self.make_zip("a.zip", {"resources/app/public/scripts/foundry.js": script})
+        )
+        self.assertTrue(
+            (self.helper.current_path / "resources/app/public/scripts/foundry.js.gz").exists()
+        )
+        precompressed = self.helper.read_manifest(self.helper.current_release)["precompressed"]
+        self.assertEqual(precompressed["files"], 1)
+        self.helper.install_zip(
+            self.make_zip(
+                "b.zip",
+                {"resources/app/public/scripts/foundry.js": script, "resources/app/main.js": "main"},
+            )
+        )
+        precompressed = self.helper.read_manifest(self.helper.current_release)["precompressed"]
+        self.assertEqual(precompressed["linked"], 1)
+
+    def test_install_bad_zip(self):
+        """Test a corrupt resource raises BadZipFile."""
+        zip_path = self.root / "bad.zip"
+        zip_path.write_bytes(b"not a zip")
+        with self.assertRaises(zipfile.BadZipFile):
+            self.helper.install_zip(zip_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+import mock
+from lib_images import ImageOptimiser, pillow_available
+
+
+def fake_optimise(source, target, max_dimension, quality, dry_run=False):
+    """Stand in for the transcode, halving the size of each image."""
+    size = os.stat(str(source)).st_size
+
+    if not dry_run:
+        Path(target).write_bytes(b"w" * (size // 2))
+
+    return {"size": size, "width": 1, "height": 1, "output_size": size // 2, "written": not dry_run}
+
+
+class TestImageOptimiser(unittest.TestCase):
+    def setUp(self):
+        """Setup a data path with images in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name)
+        self.data_path = self.root / "userdata"
+        (self.data_path / "Data/maps").mkdir(parents=True)
+        (self.data_path / "Data/maps/cave.png").write_bytes(b"p" * 4096)
+        (self.data_path / "Data/maps/token.png").write_bytes(b"t" * 16)
+        (self.data_path / "Data/notes.txt").write_bytes(b"n" * 4096)
+        self.optimiser = ImageOptimiser(self.data_path, self.root / "index.json", workers=1)
+
+    @mock.patch("lib_images.optimise_image", side_effect=fake_optimise)
+    def test_run_incremental(self, optimise_image):
+        """Test reruns only transcode new or changed images."""
+        report = self.optimiser.run(1024, 4096, 85, dry_run=True)
+        self.assertEqual(report["optimised"], 1)
+        self.assertEqual(report["bytes_saved"], 2048)
+        self.assertFalse((self.data_path / "Data/maps/cave.png.webp").exists())
+        self.assertFalse((self.root / "index.json").exists())
+
+        report = self.optimiser.run(1024, 4096, 85)
+        self.assertEqual(report["optimised"], 1)
+        self.assertTrue((self.data_path / "Data/maps/cave.png.webp").exists())
+        self.assertEqual((self.data_path / "Data/maps/cave.png").read_bytes(), b"p" * 4096)
+
+        os.utime(str(self.data_path / "Data/maps/cave.png"), (1000000000, 1000000000))
+        report = self.optimiser.run(1024, 4096, 85)
+        self.assertEqual(report["unchanged"], 1)
+        self.assertEqual(optimise_image.call_count, 2)
+
+        (self.data_path / "Data/maps/cave.png").write_bytes(b"q" * 8192)
+        report = self.optimiser.run(1024, 4096, 85)
+        self.assertEqual(report["bytes_saved"], 4096)
+        # Changed settings redo every image
+        report = self.optimiser.run(1024, 2048, 85)
+        self.assertEqual(report["optimised"], 1)
+        self.assertEqual(optimise_image.call_count, 4)
+
+    def test_candidates_follow(self):
+        """Test images in a followed symlinked directory are found under the data path."""
+        tier = self.root / "tier"
+        tier.mkdir()
+        (tier / "portrait.jpg").write_bytes(b"j" * 4096)
+        os.symlink(str(tier), str(self.data_path / "Data/assets"))
+        found = [path for path, _ in self.optimiser.candidates(1024)]
+        self.assertNotIn(self.data_path / "Data/assets/portrait.jpg", found)
+        self.optimiser.follow = ["Data/assets"]
+        found = [path for path, _ in self.optimiser.candidates(1024)]
+        self.assertIn(self.data_path / "Data/assets/portrait.jpg", found)
+
+    @unittest.skipUnless(pillow_available(), "Pillow is not installed")
+    def test_optimise_image(self):
+        """Test images are resized and transcoded to WebP."""
+        from lib_images import optimise_image
+        from PIL import Image
+
+        source = self.data_path / "Data/maps/noise.png"
+        Image.frombytes("RGB", (1024, 512), os.urandom(1024 * 512 * 3)).save(str(source))
+        target = self.data_path / "Data/maps/noise.png.webp"
+        result = optimise_image(source, target, 256, 80)
+        self.assertTrue(result["written"])
+        with Image.open(str(target)) as image:
+            self.assertEqual(image.size, (256, 128))
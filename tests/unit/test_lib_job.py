@@ -0,0 +1,49 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+import mock
+from lib_job import BackgroundJob
+
+
+class TestBackgroundJob(unittest.TestCase):
+    def setUp(self):
+        """Setup a job using a temporary job directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.job = BackgroundJob("install", job_dir=Path(self.tmpdir.name) / "jobs")
+
+    @mock.patch("lib_job.subprocess.check_call")
+    def test_start(self, check_call):
+        """Test starting a job records its params and runs a transient unit."""
+        self.job.start("/charm/src/foundry_job.py", {"zip_path": "/tmp/foundry.zip"})
+        self.assertEqual(self.job.params(), {"zip_path": "/tmp/foundry.zip"})
+        command = check_call.call_args[0][0]
+        self.assertEqual(command[:4], ["systemd-run", "--unit", "foundryvtt-install-job", "--collect"])
+        self.assertEqual(command[-2:], ["/charm/src/foundry_job.py", "install"])
+
+    @mock.patch("lib_job.subprocess.check_call")
+    def test_status(self, check_call):
+        """Test polling a job through to completion."""
+        self.assertIsNone(self.job.status())
+        self.job.start("/charm/src/foundry_job.py", {})
+        with mock.patch.object(BackgroundJob, "unit_active", return_value=True):
+            self.job.report("Installing dependencies")
+            self.assertEqual(self.job.status()["state"], "running")
+            self.assertEqual(self.job.status()["message"], "Installing dependencies")
+        self.job.update(state="done", result={"current_data_path": "/opt/foundry/userdata"})
+        self.assertEqual(self.job.status()["result"]["current_data_path"], "/opt/foundry/userdata")
+        self.job.clear()
+        self.assertIsNone(self.job.status())
+
+    @mock.patch("lib_job.subprocess.check_call")
+    def test_status_exited(self, check_call):
+        """Test a running job whose unit has gone away is reported failed."""
+        self.job.start("/charm/src/foundry_job.py", {})
+        with mock.patch.object(BackgroundJob, "unit_active", return_value=False):
+            self.assertEqual(self.job.status()["state"], "failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.request
+
+import setuppath  # noqa:F401
+import mock
+from lib_metrics import (
+    Collector,
+    established_connections,
+    format_metrics,
+    metrics_server,
+    record_operation,
+)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        """Start a stand-in for the Foundry process."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name)
+        self.process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        self.addCleanup(self.process.wait)
+        self.addCleanup(self.process.kill)
+        self.operations_file = self.root / "operations.json"
+        self.collector = Collector(
+            "foundryvtt.service",
+            30000,
+            str(self.root),
+            operations_file=self.operations_file,
+            pid_function=lambda service: self.process.pid,
+            probe_function=lambda host, port: True,
+            tree_size_function=lambda path: 1234,
+        )
+
+    def test_record_operation(self):
+        """Test operations add up in their counters."""
+        record_operation("extract", 2.0, 100, path=self.operations_file)
+        record_operation("extract", 1.0, 50, path=self.operations_file)
+        operations = json.loads(self.operations_file.read_text())
+        self.assertEqual(operations["extract"], {"count": 2, "seconds": 3.0, "bytes": 150})
+
+    @mock.patch("lib_metrics.cold_starts", return_value=[])
+    def test_collect(self, cold_starts):
+        """Test process, data and operation metrics are collected from the stand-in."""
+        record_operation("start", 4.0, path=self.operations_file)
+        text = self.collector.metrics()
+        self.assertIn("foundryvtt_up 1.0", text)
+        self.assertRegex(text, r"foundryvtt_resident_memory_bytes [1-9]")
+        self.assertRegex(text, r"foundryvtt_open_fds [1-9]")
+        self.assertIn("foundryvtt_data_bytes 1234.0", text)
+        self.assertIn('foundryvtt_charm_operations_total{operation="start"} 1.0', text)
+        self.assertIn('foundryvtt_charm_operation_seconds_total{operation="start"} 4.0', text)
+
+    @mock.patch("lib_metrics.cold_starts", return_value=[])
+    def test_collect_cached(self, cold_starts):
+        """Test scrapes within the cache period don't collect again."""
+        with mock.patch.object(self.collector, "collect", return_value=[]) as collect:
+            self.collector.metrics()
+            self.collector.metrics()
+        collect.assert_called_once_with()
+
+    @mock.patch("lib_metrics.cold_starts", return_value=[])
+    def test_collect_stopped(self, cold_starts):
+        """Test a stopped service is reported down without process metrics."""
+        self.collector.pid_function = lambda service: None
+        text = self.collector.metrics()
+        self.assertIn("foundryvtt_up 0.0", text)
+        self.assertNotIn("foundryvtt_resident_memory_bytes", text)
+
+    def test_established_connections(self):
+        """Test only established connections to the port are counted."""
+        (self.root / "net").mkdir()
+        (self.root / "net" / "tcp").write_text(
+            "  sl  local_address rem_address   st\n"
+            "   0: 0100007F:7530 0100007F:A001 01\n"
+            "   1: 00000000:7530 00000000:0000 0A\n"
+            "   2: 0100007F:1F90 0100007F:A002 01\n"
+        )
+        self.assertEqual(established_connections(30000, proc=str(self.root)), 1)
+
+    def test_format_metrics(self):
+        """Test the text format escapes label values."""
+        text = format_metrics([("m", "gauge", "Help.", [({"a": 'x"y'}, 1)])])
+        self.assertEqual(text, '# HELP m Help.\n# TYPE m gauge\nm{a="x\\"y"} 1.0\n')
+
+    def test_metrics_server(self):
+        """Test metrics are served on localhost unless another address is given."""
+        server = metrics_server(self.collector, 0)
+        self.addCleanup(server.server_close)
+        self.assertEqual(server.server_address[0], "127.0.0.1")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            self.assertIn("foundryvtt_data_bytes", response.read().decode())
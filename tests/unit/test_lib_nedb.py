@@ -0,0 +1,43 @@
+import json
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+from lib_nedb import compact_tree, load
+
+
+class TestNeDB(unittest.TestCase):
+    def setUp(self):
+        """Setup a world database in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name)
+        (self.root / "Data/worlds/test/data").mkdir(parents=True)
+        self.db = self.root / "Data/worlds/test/data/tokens.db"
+        lines = [{"_id": "a", "x": step, "name": "Göblin"} for step in range(100)]
+        lines += [
+            {"_id": "b", "x": 0},
+            {"$$indexCreated": {"fieldName": "name", "unique": False, "sparse": False}},
+            {"_id": "c", "x": 0},
+            {"$$deleted": True, "_id": "b"},
+        ]
+        self.db.write_text("".join(json.dumps(line) + "\n" for line in lines))
+
+    def test_compact(self):
+        """Test each document is collapsed to its latest version."""
+        before = load(self.db)
+        report = compact_tree(self.root)
+        self.assertEqual(report["files"], 1)
+        self.assertEqual(report["documents"], 2)
+        self.assertLess(report["bytes_after"], report["bytes_before"])
+        self.assertEqual(load(self.db), before)
+        self.assertEqual(len(self.db.read_text().splitlines()), 3)
+        self.assertEqual(load(self.db)[0]["a"], {"_id": "a", "x": 99, "name": "Göblin"})
+
+    def test_compact_corrupt(self):
+        """Test a database NeDB would refuse to load is left alone."""
+        self.db.write_text('{"_id": "a"}\nnot json\n')
+        report = compact_tree(self.root)
+        self.assertEqual(report["failed"], [str(self.db)])
+        self.assertEqual(self.db.read_text(), '{"_id": "a"}\nnot json\n')
@@ -0,0 +1,74 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+import socket
+import tempfile
+import threading
+import unittest
+
+import setuppath  # noqa:F401
+import mock
+from lib_probe import cold_starts, probe, record_cold_start, wait_until_ready
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    """Answer like Foundry does once it is serving."""
+
+    def do_GET(self):  # noqa: N802
+        self.send_response(302)
+        self.send_header("Location", "/join")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestProbe(unittest.TestCase):
+    def test_probe(self):
+        """Test a listening HTTP server is ready and a closed port is not."""
+        server = HTTPServer(("127.0.0.1", 0), RedirectHandler)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        self.assertTrue(probe("127.0.0.1", server.server_port))
+
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        self.assertFalse(probe("127.0.0.1", port))
+
+    @mock.patch("time.sleep")
+    def test_wait_until_ready_backoff(self, sleep):
+        """Test probing backs off exponentially up to a maximum delay."""
+        results = [False] * 7 + [True]
+        seconds, attempts = wait_until_ready("127.0.0.1", 1, 60, lambda host, port: results.pop(0))
+        self.assertEqual(attempts, 8)
+        self.assertIsNotNone(seconds)
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertEqual(delays, [0.25, 0.5, 1, 2, 4, 5, 5])
+
+    def test_wait_until_ready_timeout(self):
+        """Test None is returned for the seconds when Foundry never becomes ready."""
+        seconds, attempts = wait_until_ready("127.0.0.1", 1, 0, lambda host, port: False)
+        self.assertIsNone(seconds)
+        self.assertEqual(attempts, 1)
+
+    def test_record_cold_start(self):
+        """Test cold starts are appended and read back."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_path = Path(tmpdir) / "cold-starts.jsonl"
+            record_cold_start({"seconds": 2.5, "release": "a"}, log_path)
+            record_cold_start({"seconds": 1.5, "release": "b"}, log_path)
+            self.assertEqual([start["seconds"] for start in cold_starts(log_path)], [2.5, 1.5])
+
+    def test_cold_starts_torn_line(self):
+        """Test a line torn by a hook killed mid-write is skipped."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_path = Path(tmpdir) / "cold-starts.jsonl"
+            log_path.write_text('{"seconds": 2.5}\n{"seconds": 1.')
+            self.assertEqual(cold_starts(log_path), [{"seconds": 2.5}])
+            record_cold_start({"seconds": 1.5}, log_path)
+            self.assertEqual([start["seconds"] for start in cold_starts(log_path)], [2.5, 1.5])
+            self.assertEqual([path.name for path in Path(tmpdir).iterdir()], ["cold-starts.jsonl"])
@@ -0,0 +1,61 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+from lib_profile import HookProfiler, profiled
+
+
+class Handler:
+    """Stand in for a charm with a profiled handler."""
+
+    def __init__(self, profiler):
+        """Initialize with a profiler."""
+        self.profiler = profiler
+
+    @profiled
+    def on_install(self, event):
+        """Run two phases."""
+        with self.profiler.phase("install_zip"):
+            pass
+        with self.profiler.phase("add_sources"):
+            if event == "fail":
+                raise RuntimeError(event)
+
+
+class TestHookProfiler(unittest.TestCase):
+    def setUp(self):
+        """Setup a profile log in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.log_path = Path(self.tmpdir.name) / "profiles" / "hooks.jsonl"
+
+    def test_disabled(self):
+        """Test nothing is recorded unless profiling is enabled."""
+        Handler(HookProfiler("", log_path=self.log_path)).on_install(None)
+        self.assertFalse(self.log_path.exists())
+
+    def test_timing(self):
+        """Test each handler run records its phases."""
+        profiler = HookProfiler("timing", log_path=self.log_path)
+        Handler(profiler).on_install(None)
+        with self.assertRaises(RuntimeError):
+            Handler(profiler).on_install("fail")
+        profiles = profiler.last(10)
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual(profiles[0]["handler"], "on_install")
+        self.assertEqual(sorted(profiles[0]["phases"]), ["add_sources", "install_zip"])
+        self.assertIsNone(profiles[0]["error"])
+        self.assertEqual(profiles[1]["error"], "RuntimeError")
+        self.assertNotIn("profile", profiles[0])
+        self.assertEqual(len(profiler.last(1)), 1)
+
+    def test_cprofile(self):
+        """Test cprofile mode records the slowest functions."""
+        profiler = HookProfiler("cprofile", log_path=self.log_path)
+        Handler(profiler).on_install(None)
+        self.assertTrue(profiler.last(1)[0]["profile"])
+
+
+if __name__ == "__main__":
+    unittest.main()
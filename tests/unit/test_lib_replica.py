@@ -0,0 +1,33 @@
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+from lib_replica import elect_active, replication_lag, rsync_command
+
+
+class TestReplica(unittest.TestCase):
+    def test_rsync_command(self):
+        """Test the command pulls the module into the data path, throttled when limited."""
+        command = rsync_command("10.0.0.1", "/etc/password", "/data/", bwlimit=1024)
+        self.assertEqual(command[-2:], ["rsync://foundry@10.0.0.1:8730/foundry-data/", "/data/"])
+        self.assertIn("--password-file=/etc/password", command)
+        self.assertIn("--bwlimit=1024", command)
+        self.assertIn("--delay-updates", command)
+        self.assertNotIn("--bwlimit=0", rsync_command("10.0.0.1", "/etc/password", "/data"))
+
+    def test_elect_active(self):
+        """Test the highest epoch wins and ties are settled by unit name."""
+        self.assertIsNone(elect_active({}))
+        self.assertEqual(elect_active({"foundry/0": 1, "foundry/1": 2}), "foundry/1")
+        self.assertEqual(elect_active({"foundry/1": 2, "foundry/0": 2}), "foundry/0")
+
+    def test_replication_lag(self):
+        """Test the lag is the age of the stamp, None before the first sync."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stamp = Path(tmpdir) / "replicated"
+            self.assertIsNone(replication_lag(stamp))
+            stamp.touch()
+            os.utime(str(stamp), (1000, 1000))
+            self.assertEqual(replication_lag(stamp, now=1030), 30)
@@ -0,0 +1,38 @@
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+import setuppath  # noqa:F401
+from lib_tree import walk_tree
+
+
+class TestWalkTree(unittest.TestCase):
+    def setUp(self):
+        """Setup a data path with a subtree placed on a tier by a symlink."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name)
+        self.data_path = self.root / "userdata"
+        (self.data_path / "Data").mkdir(parents=True)
+        (self.data_path / "Data/options.json").write_text("{}")
+        (self.root / "tier/test").mkdir(parents=True)
+        (self.root / "tier/test/world.json").write_text("{}")
+        os.symlink(str(self.root / "tier"), str(self.data_path / "Data/worlds"))
+        os.symlink(str(self.root / "tier"), str(self.data_path / "Data/other"))
+
+    def files(self, **kwargs):
+        """Return the files walked, relative to the data path."""
+        return sorted(
+            str((Path(root) / name).relative_to(self.data_path))
+            for root, _, files in walk_tree(self.data_path, **kwargs)
+            for name in files
+        )
+
+    def test_walk_tree(self):
+        """Test only the followed symlinks are walked, under their link."""
+        self.assertEqual(self.files(), ["Data/options.json"])
+        self.assertEqual(
+            self.files(follow=["Data/worlds", "Data/missing"]),
+            ["Data/options.json", "Data/worlds/test/world.json"],
+        )